@@ -336,6 +336,14 @@ if [[ "${CLUSTER_TYPE}" = "RAC" ]]; then
   PB_LIST=${PB_LIST/$PB_CONFIG_DB/$PB_CONFIG_RAC_DB}
 fi
 
+# The playbooks of this run share one access token for the Cloud Logging
+# callback plugin instead of fetching a new one each.
+if [[ -z "${ANSIBLE_CLOUD_LOGGING_TOKEN_CACHE}" ]]; then
+  ANSIBLE_CLOUD_LOGGING_TOKEN_CACHE="$(mktemp -t ansible_cloud_logging_token.XXXXXX)"
+  export ANSIBLE_CLOUD_LOGGING_TOKEN_CACHE
+  trap 'rm -f "${ANSIBLE_CLOUD_LOGGING_TOKEN_CACHE}"' EXIT
+fi
+
 for PLAYBOOK in ${PB_LIST}; do
   echo "Running playbook: ${PLAYBOOK}"
   ansible-playbook ${INVENTORY_ARG} "${PLAYBOOK}" "${ANSIBLE_ARGS[@]}"
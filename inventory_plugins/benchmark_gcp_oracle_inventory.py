@@ -0,0 +1,272 @@
+#!/usr/bin/python3
+"""Benchmarks the gcp_oracle_inventory plugin with a synthetic RAC configuration.
+
+A configuration with --clusters clusters of --nodes nodes each and --vars
+extra top-level variables is written to a temporary file and parsed through
+Ansible's inventory loader. The memory held by the resulting inventory is
+measured with tracemalloc, for the plugin's placement of shared variables on
+groups and, for comparison, with the same variables copied onto every host
+as the plugin used to do.
+
+With --instances, the discovery of a single instance among that many fake
+Compute Engine instances spread over --zones zones is also timed, listing the
+zones one at a time and concurrently, with --latency seconds per page.
+
+With --suite, it instead runs a scale suite: Single Instance and Data Guard
+fleets and RAC clusters with each of --sizes database hosts and --vars common
+variables. For each, it reports the best time of --repeat runs to parse() the
+configuration and to load it with an InventoryManager, and the peak memory
+allocated while parsing. The results are compared with the baseline stored
+in --baseline-file by --save-baseline, and the suite fails if one of them is
+worse by more than --tolerance.
+
+Sample usage:
+
+    python3 inventory_plugins/benchmark_gcp_oracle_inventory.py --nodes 64 --vars 500
+    python3 inventory_plugins/benchmark_gcp_oracle_inventory.py --instances 5000 --zones 4
+    python3 inventory_plugins/benchmark_gcp_oracle_inventory.py --suite --save-baseline
+    python3 inventory_plugins/benchmark_gcp_oracle_inventory.py --suite
+"""
+import argparse
+import json
+import math
+import os
+import sys
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+from unittest import mock
+
+import yaml
+
+from ansible import constants as C
+from ansible.inventory.data import InventoryData
+from ansible.inventory.helpers import get_group_vars
+from ansible.inventory.manager import InventoryManager
+from ansible.parsing.dataloader import DataLoader
+from ansible.plugins.loader import inventory_loader
+
+from fake_compute_client import FakeComputeClient, make_instance, make_instances
+
+PLUGIN_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BASELINE_FILE = os.path.expanduser('~/.ansible/gcp_oracle_inventory_benchmark.json')
+SUITE_TOPOLOGIES = ('si', 'dg', 'rac')
+# The metrics compared with the baseline, lower being better
+SUITE_METRICS = ('parse_ms', 'manager_ms', 'peak_mib')
+
+
+def make_config(clusters, nodes, variables):
+    """Returns a RAC configuration with the given number of clusters, nodes and variables."""
+    config = {'ora_cluster_type': 'RAC', 'ora_version': '19.3.0.0.0'}
+    config.update(make_common_vars(variables))
+    config['cluster_config_json'] = [{
+        'scan_name': f'scan-{c}',
+        'scan_port': 1521,
+        'cluster_name': f'cluster-{c}',
+        'nodes': [{
+            'node_name': f'node-{c}-{n}',
+            'host_ip': f'10.{c}.{n // 256}.{n % 256}',
+            'vip_name': f'node-{c}-{n}-vip',
+            'vip_ip': f'10.{c + 128}.{n // 256}.{n % 256}',
+        } for n in range(nodes)],
+    } for c in range(clusters)]
+    return config
+
+
+def flatten(inventory):
+    """Copies the group variables onto every host, as per-host placement did."""
+    for host in inventory.hosts.values():
+        for key, value in get_group_vars(host.get_groups()).items():
+            host.set_variable(key, value)
+    for group in inventory.groups.values():
+        group.vars = {}
+
+
+def run(config_file, per_host):
+    """Parses the configuration and returns (seconds, bytes held, variables stored)."""
+    plugin = inventory_loader.get('gcp_oracle_inventory')
+    loader = DataLoader()
+    tracemalloc.start()
+    started = time.perf_counter()
+    inventory = InventoryData()
+    plugin.parse(inventory, loader, config_file)
+    elapsed = time.perf_counter() - started
+    if per_host:
+        flatten(inventory)
+    held = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    stored = sum(len(h.vars) for h in inventory.hosts.values())
+    stored += sum(len(g.vars) for g in inventory.groups.values())
+    return elapsed, held, stored
+
+
+def run_discovery(config_file, instances, max_workers, latency):
+    """Parses the discovery configuration and returns (seconds, pages listed)."""
+    with open(config_file) as f:
+        config = yaml.safe_load(f)
+    config['discovery']['max_workers'] = max_workers
+    with open(config_file, 'w') as f:
+        yaml.safe_dump(config, f)
+    plugin = inventory_loader.get('gcp_oracle_inventory')
+    plugin.compute_client = FakeComputeClient(instances, latency=latency)
+    started = time.perf_counter()
+    plugin.parse(InventoryData(), DataLoader(), config_file)
+    return time.perf_counter() - started, plugin.compute_client.pages
+
+
+def make_common_vars(variables):
+    """Returns the given number of variables shared by all hosts."""
+    return {f'bench_var_{i}': f'value-{i}-' + 'x' * 32 for i in range(variables)}
+
+
+def make_suite_config(topology, hosts, variables, nodes_per_cluster):
+    """Returns a configuration with the given number of database hosts.
+
+    Single Instance and Data Guard configurations with more than one host are
+    fleets of as many deployments, RAC ones are clusters of up to
+    nodes_per_cluster nodes.
+    """
+    if topology == 'rac':
+        return make_config(math.ceil(hosts / nodes_per_cluster), min(hosts, nodes_per_cluster), variables)
+
+    def deployment(i):
+        config = {'instance_hostname': f'db-{i}', 'instance_ip_addr': f'10.0.{i // 256}.{i % 256}'}
+        if topology == 'dg':
+            config.update(ora_cluster_type='DG', primary_ip_addr=f'10.1.{i // 256}.{i % 256}')
+        return config
+
+    common = dict(make_common_vars(variables), ora_version='19.3.0.0.0')
+    if hosts == 1:
+        return dict(common, **deployment(0))
+    return {'fleet': {'defaults': common, 'deployments': {f'd{i}': deployment(i) for i in range(hosts)}}}
+
+
+def measure(config_file, repeat):
+    """Returns the best parse() and InventoryManager times in ms, and the peak MiB allocated by parse()."""
+    loader = DataLoader()
+    parse_times, manager_times = [], []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        inventory_loader.get('gcp_oracle_inventory').parse(InventoryData(), loader, config_file)
+        parse_times.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        with mock.patch.object(C, 'INVENTORY_ENABLED', ['gcp_oracle_inventory']):
+            InventoryManager(loader=loader, sources=[config_file])
+        manager_times.append(time.perf_counter() - started)
+
+    # Measured apart, as tracing allocations slows parse() down
+    tracemalloc.start()
+    inventory_loader.get('gcp_oracle_inventory').parse(InventoryData(), loader, config_file)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        'parse_ms': min(parse_times) * 1000,
+        'manager_ms': min(manager_times) * 1000,
+        'peak_mib': peak / 2**20,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Returns the descriptions of the results worse than the baseline by more than tolerance."""
+    regressions = []
+    for case, metrics in results.items():
+        for metric in SUITE_METRICS:
+            reference = baseline.get(case, {}).get(metric)
+            if reference and metrics[metric] > reference * (1 + tolerance):
+                regressions.append(f'{case} {metric}: {metrics[metric]:.2f} vs {reference:.2f} '
+                                   f'(+{metrics[metric] / reference - 1:.0%})')
+    return regressions
+
+
+def run_suite(args, tmpdir):
+    """Runs the scale suite and returns the exit status."""
+    results = {}
+    print(f'{"case":>10} {"parse ms":>10} {"manager ms":>11} {"peak MiB":>9}')
+    for topology in SUITE_TOPOLOGIES:
+        for hosts in args.sizes:
+            config_file = os.path.join(tmpdir, f'gcp_oracle.yml.{topology}-{hosts}')
+            with open(config_file, 'w') as f:
+                yaml.safe_dump(make_suite_config(topology, hosts, args.vars, args.nodes_per_cluster), f)
+            case = f'{topology}-{hosts}'
+            results[case] = measure(config_file, args.repeat)
+            print(f'{case:>10} {results[case]["parse_ms"]:10.1f} {results[case]["manager_ms"]:11.1f} '
+                  f'{results[case]["peak_mib"]:9.2f}')
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline_file)), exist_ok=True)
+        with open(args.baseline_file, 'w') as f:
+            json.dump({'vars': args.vars, 'results': results}, f, indent=2, sort_keys=True)
+        print(f'baseline saved to {args.baseline_file}')
+        return 0
+    if not os.path.exists(args.baseline_file):
+        print(f'no baseline in {args.baseline_file}, run with --save-baseline to store one')
+        return 0
+    with open(args.baseline_file) as f:
+        baseline = json.load(f)
+    if baseline.get('vars') != args.vars:
+        print(f'the baseline was measured with --vars {baseline.get("vars")}, not compared')
+        return 0
+    regressions = compare(results, baseline['results'], args.tolerance)
+    for regression in regressions:
+        print(f'regression: {regression}')
+    if not regressions:
+        print(f'no regression against {args.baseline_file} (tolerance {args.tolerance:.0%})')
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clusters', type=int, default=1, help='Number of RAC clusters.')
+    parser.add_argument('--nodes', type=int, default=64, help='Number of nodes per cluster.')
+    parser.add_argument('--vars', type=int, default=500, help='Number of extra top-level variables.')
+    parser.add_argument('--instances', type=int, default=0, help='Number of fake instances to discover from.')
+    parser.add_argument('--zones', type=int, default=4, help='Number of zones of the fake instances.')
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds taken by each page of instances.')
+    parser.add_argument('--suite', action='store_true', help='Run the scale suite instead.')
+    parser.add_argument('--sizes', type=lambda value: [int(size) for size in value.split(',')],
+                        default=[1, 10, 100, 1000, 4000], help='Comma-separated numbers of database hosts of the suite.')
+    parser.add_argument('--nodes-per-cluster', type=int, default=16, help='Maximum number of nodes of the RAC clusters of the suite.')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of timed runs per suite case, the best one counting.')
+    parser.add_argument('--baseline-file', default=DEFAULT_BASELINE_FILE, help='File storing the baseline of the suite.')
+    parser.add_argument('--save-baseline', action='store_true', help='Store the suite results as the baseline.')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Slowdown over the baseline reported as a regression.')
+    args = parser.parse_args()
+
+    inventory_loader.add_directory(PLUGIN_DIR)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        if args.suite:
+            sys.exit(run_suite(args, tmpdir))
+        config_file = os.path.join(tmpdir, 'gcp_oracle.yml')
+        with open(config_file, 'w') as f:
+            yaml.safe_dump(make_config(args.clusters, args.nodes, args.vars), f)
+
+        print(f'{args.clusters} cluster(s) x {args.nodes} nodes, {args.vars} variables')
+        results = {}
+        for label, per_host in (('per-host', True), ('grouped', False)):
+            elapsed, held, stored = run(config_file, per_host)
+            results[label] = held
+            print(f'{label:>8}: {elapsed * 1000:8.1f} ms to parse, {held / 2**20:8.2f} MiB held, '
+                  f'{stored} variables stored')
+        print(f'memory reduction: {1 - results["grouped"] / results["per-host"]:.0%}')
+
+        if args.instances:
+            zones = [f'zone-{z}' for z in range(args.zones)]
+            instances = make_instances(args.instances, zones) + [make_instance('discovered-db', zones[0], '10.255.0.1')]
+            config_file = os.path.join(tmpdir, 'gcp_oracle.yml.discovery')
+            with open(config_file, 'w') as f:
+                yaml.safe_dump({'instance_hostname': 'discovered-db', 'ora_version': '19.3.0.0.0',
+                                'discovery': {'project': 'fake-project', 'zones': zones}}, f)
+            print(f'discovery among {len(instances)} instances in {args.zones} zones, {args.latency * 1000:.0f} ms per page')
+            for label, max_workers in (('serial', 1), ('parallel', args.zones)):
+                elapsed, pages = run_discovery(config_file, instances, max_workers, args.latency)
+                print(f'{label:>8}: {elapsed * 1000:8.1f} ms to parse, {pages} pages listed')
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""A fake Compute Engine client for the discovery of gcp_oracle_inventory.
+
+FakeComputeClient serves pages of instance resources from a list held in
+memory, like ComputeClient does from the Compute Engine API, so that tests
+and benchmarks can run discovery against thousands of instances without
+credentials. An optional latency is slept on every page to mimic the API.
+"""
+import threading
+import time
+
+
+def make_instance(name, zone, ip, labels=None, metadata=None, public_ip=None):
+    """Returns a Compute Engine instance resource with the fields discovery reads."""
+    interface = {'networkIP': ip}
+    if public_ip:
+        interface['accessConfigs'] = [{'natIP': public_ip}]
+    return {
+        'name': name,
+        'zone': f'https://www.googleapis.com/compute/v1/projects/fake-project/zones/{zone}',
+        'status': 'RUNNING',
+        'labels': dict(labels or {}),
+        'metadata': {'items': [{'key': key, 'value': value} for key, value in (metadata or {}).items()]},
+        'networkInterfaces': [interface],
+    }
+
+
+def make_instances(count, zones, labels=None):
+    """Returns count instances spread over the zones, with the given labels."""
+    return [make_instance(f'vm-{i:06d}', zones[i % len(zones)], f'10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}', labels)
+            for i in range(count)]
+
+
+class FakeComputeClient:
+    """Lists instances held in memory, page by page.
+
+    Attributes:
+      pages: Number of pages served.
+      max_concurrency: Highest number of requests served at the same time.
+    """
+
+    def __init__(self, instances, page_size=500, latency=0.0):
+        self.page_size = page_size
+        self.latency = latency
+        self.pages = 0
+        self.max_concurrency = 0
+        self._concurrency = 0
+        self._lock = threading.Lock()
+        self._instances_by_zone = {}
+        for instance in instances:
+            zone = instance['zone'].rsplit('/', 1)[-1]
+            self._instances_by_zone.setdefault(zone, []).append(instance)
+
+    def list_instances(self, project, zone, labels, page_token=None):
+        """Returns a page of the instances of a zone that have all the given labels."""
+        with self._lock:
+            self._concurrency += 1
+            self.max_concurrency = max(self.max_concurrency, self._concurrency)
+        try:
+            if self.latency:
+                time.sleep(self.latency)
+            instances = [instance for instance in self._instances_by_zone.get(zone, [])
+                         if all(instance['labels'].get(key) == value for key, value in labels.items())]
+            start = int(page_token or 0)
+            page = {'items': instances[start:start + self.page_size]}
+            if start + self.page_size < len(instances):
+                page['nextPageToken'] = str(start + self.page_size)
+            return page
+        finally:
+            with self._lock:
+                self._concurrency -= 1
+                self.pages += 1
@@ -11,17 +11,368 @@ DOCUMENTATION = r'''
       config_file:
         description: Path to the YAML configuration file
         required: true
+    extends_documentation_fragment:
+      - inventory_cache
+    notes:
+      - Configuration shared by the hosts of a deployment is set once as group
+        variables, except for variables also defined in a group_vars file next
+        to the inventory or the playbooks, which stay host variables so that
+        they keep taking precedence over those defaults.
+      - With the inventory cache enabled, the hosts, groups and variables built
+        from a configuration file are cached under a key derived from the
+        file's content hash and modification time, so later runs against the
+        same, unchanged file skip reading and validating it.
+      - The configuration of each deployment is checked once against the rules
+        of validate-config.yml, and the violations found are set in the
+        C(config_violations) group variable for that playbook to report.
+      - With a C(discovery) section, the addresses of the database hosts and
+        the nodes of RAC clusters missing from the configuration are taken from
+        the Compute Engine instances with the given labels. The zones are
+        listed concurrently, and with the inventory cache enabled the instances
+        found are cached for C(discovery.cache_ttl) seconds.
 '''
 
-from ansible.plugins.inventory import BaseInventoryPlugin
+from ansible.plugins.inventory import BaseInventoryPlugin, Cacheable
 from ansible.errors import AnsibleParserError
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import ipaddress
+import json
+import re
+import threading
+import time
 import yaml
 import os
 
 DEFAULT_HOSTGROUP_NAME = 'dbasm'
+# Holds the first database host of each deployment
+FIRST_HOSTGROUP_NAME = 'dbasm_first'
+RESERVED_GROUP_NAMES = ('all', 'ungrouped', DEFAULT_HOSTGROUP_NAME, FIRST_HOSTGROUP_NAME, 'primary')
+DEPLOYMENT_NAME_RE = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+# The toolkit's playbooks, and their group_vars, live one level above this plugin
+TOOLKIT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+GROUP_VARS_EXTENSIONS = ('', '.yml', '.yaml', '.json')
 
-class InventoryModule(BaseInventoryPlugin):
+# Mirrors version_map in group_vars/all.yml
+VERSION_MAP = {
+    '26': '23.26.1.0.0',
+    '23': '23.0.0.0.0',
+    '21': '21.3.0.0.0',
+    '19': '19.3.0.0.0',
+    '18': '18.0.0.0.0',
+    '12': '12.2.0.1.0',
+    '12.2': '12.2.0.1.0',
+    '12.1': '12.1.0.2.0',
+    '11': '11.2.0.4.0',
+}
+HOSTNAME_PATTERN = r'^[a-zA-Z0-9]([a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?(\.[a-zA-Z0-9]([a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?)*$'
+SECRET_PATTERN = r'^projects/[^/]+/secrets/[^/]+/versions/[^/]+$'
+OBJECT_NAME_PATTERN = r'^[a-zA-Z][a-zA-Z0-9_$]*$'
+HOSTNAME_RE = re.compile(HOSTNAME_PATTERN)
+IPV4_LIKE_RE = re.compile(r'^[0-9.]+$')
+REDO_LOG_COUNT_RE = re.compile(r'^[0-9]+$')
+# Oracle < 12.2 with Grid Infrastructure limits host names to 30 characters
+LEGACY_GI_VERSION = (12, 2, 0, 1, 0)
+LEGACY_GI_HOSTNAME_LENGTH = 30
+
+
+def _to_int(value):
+    '''Return value as an integer, or 0 if it is not a number, like the int filter'''
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        try:
+            return int(float(value))
+        except (TypeError, ValueError):
+            return 0
+
+
+def _to_bool(value):
+    '''Return value as a boolean like the bool filter'''
+    return str(value).lower() in ('yes', 'on', '1', 'true', '1.0', 'y', 't')
+
+
+def _version(value):
+    '''Return the numeric components of a version, to compare versions'''
+    return tuple(int(part) for part in re.findall(r'[0-9]+', str(value)))
+
+
+def _is_set(value):
+    '''Return whether a setting has a non-empty value'''
+    return value is not None and value != ''
+
+
+def _is_address(value):
+    '''Return whether value is an IP address, or a host name'''
+    try:
+        ipaddress.ip_address(str(value))
+        return True
+    except ValueError:
+        return not IPV4_LIKE_RE.match(str(value)) and bool(HOSTNAME_RE.match(str(value)))
+
+
+class ConfigSettings(dict):
+    '''Settings of a deployment, formatting missing ones as empty in messages'''
+
+    def __missing__(self, key):
+        return ''
+
+
+def _compile_rules(rules):
+    '''Compile a rule schema into (names, predicate, message, condition) tuples.
+
+    Each rule of the schema is a (names, check, message, condition) tuple:
+    names is a setting, a tuple of settings checked one by one, or None for a
+    check of the settings as a whole; check is a regular expression the value
+    must match, a tuple of the allowed values, a range of allowed integers or
+    a predicate; the message is formatted with the settings and the checked
+    {value}; the rule only applies when the condition, if any, is true.
+    '''
+    compiled = []
+    for names, check, message, condition in rules:
+        if isinstance(check, str):
+            predicate = lambda value, regex=re.compile(check): value is not None and regex.match(str(value)) is not None
+        elif isinstance(check, range):
+            predicate = lambda value, allowed=check: _to_int(value) in allowed
+        elif isinstance(check, tuple):
+            predicate = lambda value, allowed=check: value in allowed
+        else:
+            predicate = check
+        if isinstance(names, str):
+            names = (names,)
+        compiled.append((names, predicate, message, condition))
+    return compiled
+
+
+def check_rules(rules, settings):
+    '''Return the messages of the compiled rules the settings violate, in a single pass'''
+    violations = []
+    for names, predicate, message, condition in rules:
+        if condition is not None and not condition(settings):
+            continue
+        if names is None:
+            if not predicate(settings):
+                violations.append(message.format_map(settings))
+            continue
+        for name in names:
+            value = settings.get(name)
+            if not predicate(value):
+                violations.append(message.format_map(ConfigSettings(settings, value='' if value is None else value)))
+    return violations
+
+
+# The rules of validate-config.yml checked against each deployment's
+# configuration, with the settings group_vars/all.yml derives from it
+CONFIG_RULES = _compile_rules((
+    ('ora_version', r'^(26|23\.26\.1\.0\.0|23(\.0\.0\.0\.0)?|21(\.3\.0\.0\.0)?|19(\.3\.0\.0\.0)?|18(\.0\.0\.0\.0)?|12(\.[12])?(\.2\.0\.1\.0|\.1\.0\.2\.0)?|11(\.2\.0\.4\.0)?)$',
+     "Invalid ora-version '{value}'.", None),
+    ('oracle_rel', r'^(base|latest|[0-9]{,2}\.[0-9]{,2}\.[0-9]{,2}\.[0-9]{,2}\.[0-9]{,6})$',
+     "Invalid ora-release '{value}'.", None),
+    ('ora_edition', ('EE', 'SE', 'SE2', 'FREE'),
+     "Invalid ora-edition '{value}'. Must be one of: EE, SE, SE2, FREE.",
+     lambda s: 'ora_edition' in s),
+    ('cluster_type', ('NONE', 'RAC', 'DG'),
+     "Invalid cluster-type '{value}'. Must be one of: NONE, RAC, DG.", None),
+    ('ora_swlib_bucket', r'^(gs://|https?://)',
+     "Invalid ora-swlib-bucket '{value}'. Must be defined and start with gs:// or http(s)://.",
+     lambda s: s['oracle_edition'] != 'FREE'),
+    ('swlib_mount_type', ('gcs', 'gcsfuse', 'nfs', 'gcsdirect', 'gcstransfer'),
+     "Invalid ora-swlib-type '{value}'. Must be one of: gcs, gcsfuse, nfs, gcsdirect, gcstransfer.", None),
+    ('ora_disk_management', ('asmlib', 'asmudev', 'udev', 'fs'),
+     "Invalid ora-disk-management '{value}'. Must be one of: asmlib, asmudev, udev, fs.", None),
+    (None, lambda s: s['ora_disk_management'] != 'fs',
+     "RAC deployments require shared storage and cannot use the 'fs' disk management type.",
+     lambda s: s['cluster_type'] == 'RAC'),
+    (None, lambda s: s['cluster_type'] == 'NONE',
+     "Oracle Free Edition ('FREE') only supports Single-Instance deployments. 'cluster-type' must be 'NONE'.",
+     lambda s: s.get('ora_edition') == 'FREE'),
+    ('db_type', ('multipurpose', 'data_warehousing', 'oltp'),
+     "Invalid ora-db-type '{value}'. Must be one of: multipurpose, data_warehousing, oltp.", None),
+    (None, lambda s: s['oracle_edition'] == 'EE' and _is_set(s.get('primary_ip_addr')),
+     "Data Guard deployments require Enterprise Edition and a defined primary-ip-addr.",
+     lambda s: s['cluster_type'] == 'DG'),
+    (None, lambda s: not any(str(s[name]).startswith('+') for name in ('data_destination', 'reco_destination', 'backup_dest')),
+     "Cannot specify an ASM diskgroup when ora-disk-mgmt is FS.",
+     lambda s: s['ora_disk_management'] == 'fs'),
+    (('data_destination', 'reco_destination'), r'^(\/|\+)?[a-zA-Z0-9/_-]+$',
+     "Invalid format for {value}. Must be a valid path or ASM diskgroup.", None),
+    ('db_password_secret', SECRET_PATTERN,
+     "Invalid db-password-secret format.",
+     lambda s: _is_set(s['db_password_secret'])),
+    ('oracle_metrics_secret', SECRET_PATTERN,
+     "Invalid oracle-metrics-secret format.",
+     lambda s: _is_set(s['oracle_metrics_secret'])),
+    ('install_workload_agent', _to_bool,
+     "install-workload-agent must be true when oracle-metrics-secret is defined.",
+     lambda s: _is_set(s['oracle_metrics_secret'])),
+    ('ora_data_guard_protection_mode', ('Maximum Performance', 'Maximum Availability', 'Maximum Protection'),
+     "Invalid data-guard-protection-mode. Must be one of: 'Maximum Performance', 'Maximum Availability', or 'Maximum Protection'.",
+     lambda s: _is_set(s.get('ora_data_guard_protection_mode'))),
+    (('db_name', 'listener_name', 'pdb_prefix'), OBJECT_NAME_PATTERN,
+     "Invalid format for {value}.", None),
+    ('listener_port', range(1024, 65536),
+     "Listener port must be between 1024 and 65535.", None),
+    ('pdb_count', lambda value: _to_int(value) >= 0,
+     "PDB count must be a non-negative number.", None),
+    ('ora_redo_log_size', r'^[0-9]+MB$',
+     "Redo log size '{value}' must be in the format '100MB'.",
+     lambda s: 'ora_redo_log_size' in s),
+    (None, lambda s: REDO_LOG_COUNT_RE.match(str(s['ora_redo_log_count'])) and 'ora_redo_log_location' in s,
+     "Redo log count '{ora_redo_log_count}' must be a number and --ora-redo-log-location must be specified.",
+     lambda s: 'ora_redo_log_count' in s),
+    ('ora_redo_log_location', r'^(?:\+[\w.-]+|/[\w./-]+)(?:\s*,\s*(?:\+[\w.-]+|/[\w./-]+))*$',
+     "Redo log location '{value}' must be a coma-separated list of directories.",
+     lambda s: 'ora_redo_log_location' in s),
+    ('gcs_backup_bucket', lambda value: not str(value).endswith('/'),
+     "gcs_backup_bucket must not end with a slash.",
+     lambda s: 'gcs_backup_bucket' in s and 'gcs_backup_config' in s and s['gcs_backup_config'] != 'manual'),
+    ('gcs_backup_config', r'^[a-zA-Z0-9]+$',
+     "Invalid gcs-backup-config format. Must match '^[a-zA-Z0-9]+$'.",
+     lambda s: 'gcs_backup_config' in s and s['backup_dest'] != '/mnt'),
+    # Letters, digits and punctuation on both sides of the colon
+    ('_nfs_backup_mount', r'^[!-~]*:[!-~]*$',
+     "Invalid nfs-backup-mount format. Must match '^[[:alnum:][:punct:]]*:[[:alnum:][:punct:]]*$'.",
+     lambda s: _is_set(s.get('_nfs_backup_mount'))),
+    ('db_domain', r'^$|^[A-Za-z][A-Za-z0-9._-]{0,127}$',
+     "Invalid db_domain format.", None),
+    (('rman_db_bu_redundancy', 'rman_arch_redundancy', 'rman_archs_online_days'), lambda value: _to_int(value) >= 0,
+     "Invalid backup redundancy value for {value}. Must be a non-negative integer.", None),
+    ('_nfs_backup_config', ('nfsv3', 'nfsv4'),
+     "Invalid nfs-backup-config. Must be nfsv3 or nfsv4.",
+     lambda s: _is_set(s.get('_nfs_backup_config'))),
+    ('compatible_rdbms', r'^[0-9][0-9]\.[0-9].*',
+     "Invalid compatible-rdbms format.",
+     lambda s: 'compatible_rdbms' in s and str(s['compatible_rdbms']) != '0'),
+    ('swap_blk_device', r'^/dev/.+',
+     "Invalid swap-blk-device format. Must be a device path.",
+     lambda s: _is_set(s.get('swap_blk_device'))),
+    ('charset', r'^[A-Z0-9]+$',
+     "Invalid db-charset format.", None),
+    ('ncharset', r'^[A-Z0-9]+$',
+     "Invalid db-ncharset format.", None),
+    ('instance_hostname', HOSTNAME_PATTERN,
+     "Invalid instance-hostname format.",
+     lambda s: s['cluster_type'] != 'RAC'),
+    ('instance_ip_addr', _is_set,
+     "instance-ip-addr must not be empty.",
+     lambda s: s['cluster_type'] != 'RAC'),
+    ('instance_ip_addr', _is_address,
+     "Invalid instance-ip-addr '{value}'. Must be an IP address or host name.",
+     lambda s: s['cluster_type'] != 'RAC' and _is_set(s.get('instance_ip_addr'))),
+    ('instance_ssh_user', r'^[a-z_][a-z0-9_-]{0,31}$',
+     "Invalid instance-ssh-user format.", None),
+    ('ntp_pref', HOSTNAME_PATTERN,
+     "Invalid ntp-pref format.",
+     lambda s: 'ntp_pref' in s),
+    (None, lambda s: _version(s['compatible_rdbms']) <= _version(s['oracle_ver']),
+     "compatible-rdbms '{compatible_rdbms}' cannot be a higher version than ora-version '{ora_version}'.",
+     lambda s: 'compatible_rdbms' in s and str(s['compatible_rdbms']) != '0'),
+    ('primary_ip_addr', _is_set,
+     "primary-ip-addr must not be empty",
+     lambda s: 'primary_ip_addr' in s),
+    ('primary_ip_addr', _is_address,
+     "Invalid primary-ip-addr '{value}'. Must be an IP address or host name.",
+     lambda s: _is_set(s.get('primary_ip_addr'))),
+    (None, lambda s: s.get('instance_ip_addr') != s['primary_ip_addr'],
+     "instance-ip-addr and primary-ip-addr cannot be the same.",
+     lambda s: 'primary_ip_addr' in s),
+    ('ar_repo_url', lambda value: not value,
+     "Artifact Registry repositories (--ar-repo-url) are not supported with the Oracle Database free edition.",
+     lambda s: s.get('ora_edition') == 'FREE'),
+    ('container_db', _to_bool,
+     "Oracle 21c and newer (including 23ai/26ai) require a Container Database. Set 'ora-db-container' to true.",
+     lambda s: _version(s['oracle_ver']) >= (21,)),
+    (None, lambda s: not ('ora_asm_disks' in s and 'ora_asm_disks_json' in s),
+     "The variables 'ora-asm-disks' and 'ora-asm-disks-json' are mutually exclusive. Please specify only one.",
+     lambda s: s['gi_install']),
+    (None, lambda s: 'ora_asm_disks' in s or 'ora_asm_disks_json' in s,
+     "You must specify an ASM disk configuration using either 'ora-asm-disks' or 'ora-asm-disks-json'.",
+     lambda s: s['ora_disk_management'] in ('asmlib', 'asmudev')),
+    ('ora_asm_disks_json', lambda value: isinstance(value, list),
+     "Invalid ora-asm-disks-json format. Must be a valid list.",
+     lambda s: s['ora_disk_management'] in ('asmlib', 'asmudev') and _is_set(s.get('ora_asm_disks_json'))),
+    (None, lambda s: not ('ora_data_mounts' in s and 'ora_data_mounts_json' in s),
+     "The variables 'ora-data-mounts' and 'ora-data-mounts-json' are mutually exclusive. Please specify only one.", None),
+    (None, lambda s: 'ora_data_mounts' in s or 'ora_data_mounts_json' in s,
+     "You must specify a storage configuration using either 'ora-data-mounts' or 'ora-data-mounts-json'.", None),
+    ('ora_data_mounts_json', lambda value: isinstance(value, list),
+     "Invalid ora-data-mounts-json format. Must be a valid list.",
+     lambda s: _is_set(s.get('ora_data_mounts_json'))),
+))
+
+# The rules of validate-config.yml checked against each database host, with
+# the host name as inventory_hostname
+HOST_RULES = _compile_rules((
+    ('inventory_hostname', lambda value: len(value) <= LEGACY_GI_HOSTNAME_LENGTH,
+     "For legacy Oracle versions (< 12.2) using Grid Infrastructure (ASM), the hostname '{value}' must not exceed 30 characters due to OLR/ADR buffer limits. Current length: {inventory_hostname_length}.",
+     lambda s: s['gi_install'] and _version(s['oracle_ver']) < LEGACY_GI_VERSION),
+))
+
+# Discovery of the database hosts with the Compute Engine API
+COMPUTE_API_URL = 'https://compute.googleapis.com/compute/v1'
+COMPUTE_READONLY_SCOPE = 'https://www.googleapis.com/auth/compute.readonly'
+DISCOVERY_DEPLOYMENT_LABEL = 'oracle-toolkit-deployment'
+DISCOVERY_ROLE_LABEL = 'oracle-toolkit-role'
+DISCOVERY_CLUSTER_LABEL = 'oracle-toolkit-cluster'
+DISCOVERY_VIP_NAME_KEY = 'oracle-toolkit-vip-name'
+DISCOVERY_VIP_IP_KEY = 'oracle-toolkit-vip-ip'
+DISCOVERY_PAGE_SIZE = 500
+DISCOVERY_CACHE_TTL = 300
+DISCOVERY_MAX_WORKERS = 8
+
+
+class ComputeClient(object):
+    '''Lists instances with the Compute Engine API, using the application default credentials'''
+
+    def __init__(self, timeout=30):
+        self.timeout = timeout
+        self._session = None
+        self._lock = threading.Lock()
+
+    def _get_session(self):
+        '''Return the authorized session, created on the first request'''
+        with self._lock:
+            if self._session is None:
+                # google-auth is only needed when discovery is used
+                import google.auth
+                from google.auth.transport.requests import AuthorizedSession
+                credentials, _ = google.auth.default(scopes=[COMPUTE_READONLY_SCOPE])
+                self._session = AuthorizedSession(credentials)
+            return self._session
+
+    def list_instances(self, project, zone, labels, page_token=None):
+        '''Return a page of the instances of a zone that have all the given labels'''
+        params = {'maxResults': DISCOVERY_PAGE_SIZE}
+        if labels:
+            params['filter'] = ' '.join('(labels.%s = "%s")' % item for item in sorted(labels.items()))
+        if page_token:
+            params['pageToken'] = page_token
+        response = self._get_session().get('%s/projects/%s/zones/%s/instances' % (COMPUTE_API_URL, project, zone),
+                                           params=params, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+
+def _get_instance_record(instance, use_public_ip):
+    '''Return the name, zone, labels, metadata and IP address of an instance resource'''
+    interface = (instance.get('networkInterfaces') or [{}])[0]
+    if use_public_ip:
+        ip = ((interface.get('accessConfigs') or [{}])[0]).get('natIP')
+    else:
+        ip = interface.get('networkIP')
+    return {
+        'name': instance['name'],
+        'zone': instance.get('zone', '').rsplit('/', 1)[-1],
+        'labels': instance.get('labels') or {},
+        'metadata': {item['key']: item.get('value') for item in (instance.get('metadata') or {}).get('items') or []},
+        'ip': ip,
+    }
+
+
+class InventoryModule(BaseInventoryPlugin, Cacheable):
     NAME = 'gcp_oracle_inventory'
+    # Lists the instances for discovery, a ComputeClient unless set, e.g. by tests
+    compute_client = None
 
     def verify_file(self, path):
         '''Return true/false if this is possibly a valid file for this plugin to consume'''
@@ -35,9 +386,85 @@ class InventoryModule(BaseInventoryPlugin):
         '''Return dynamic inventory from parsing the YAML file'''
         super(InventoryModule, self).parse(inventory, loader, path, cache)
 
-        self._read_config_data(path)
-        self._validate_config_data()
-        self._populate_inventory()
+        # The configuration file holds the deployment, not plugin options;
+        # the cache options come from ansible.cfg or the environment.
+        self.set_options(direct={'plugin': self.NAME, 'config_file': path})
+        user_cache_setting = self.get_option('cache')
+        attempt_to_read_cache = user_cache_setting and cache
+        cache_needs_update = user_cache_setting and not cache
+
+        group_vars_files = self._get_group_vars_files(path)
+        if user_cache_setting:
+            self.load_cache_plugin()
+            cache_key = self._get_config_cache_key(path, group_vars_files)
+        layout = None
+        if attempt_to_read_cache:
+            try:
+                layout = self._cache[cache_key]
+            except KeyError:
+                cache_needs_update = True
+            # A layout built from discovered instances expires along with them
+            if layout is not None and 'expires' in layout and layout['expires'] <= time.time():
+                layout = None
+                cache_needs_update = True
+
+        if layout is None:
+            self._read_config_data(path)
+            discovery = self.config_data.pop('discovery', None)
+            expires = None
+            if discovery is not None:
+                expires = self._discover_hosts(discovery, user_cache_setting, attempt_to_read_cache)
+            self._validate_config_data()
+            self._host_only_vars = self._get_group_vars_names(group_vars_files)
+            self._layout = {'groups': {}, 'hosts': {}}
+            self._populate_inventory()
+            layout = self._layout
+            if expires is not None:
+                layout['expires'] = expires
+        if cache_needs_update:
+            self._cache[cache_key] = layout
+        self._apply_layout(layout)
+
+    def _get_config_cache_key(self, path, group_vars_files):
+        '''Return a cache key that changes with the content and mtime of the file'''
+        try:
+            with open(path, 'rb') as f:
+                digest = hashlib.sha256(f.read())
+            mtime = os.stat(path).st_mtime_ns
+        except OSError as e:
+            raise AnsibleParserError('Error reading YAML configuration file: %s' % e)
+        # The variables kept on hosts depend on the group_vars files too
+        for group_vars_file, stat in group_vars_files:
+            digest.update(('%s:%d:%d\0' % (group_vars_file, stat.st_size, stat.st_mtime_ns)).encode())
+        return '%s_%s_%d' % (self.NAME, digest.hexdigest()[:32], mtime)
+
+    def _get_group_vars_files(self, path):
+        '''Return the group_vars files, and their stat, loaded along with this inventory'''
+        files = {}
+        for basedir in (os.path.dirname(os.path.abspath(path)), TOOLKIT_DIR):
+            for root, dirs, names in os.walk(os.path.join(basedir, 'group_vars'), followlinks=True):
+                for name in names:
+                    if os.path.splitext(name)[1] in GROUP_VARS_EXTENSIONS:
+                        group_vars_file = os.path.realpath(os.path.join(root, name))
+                        try:
+                            files[group_vars_file] = os.stat(group_vars_file)
+                        except OSError:
+                            continue
+        return sorted(files.items())
+
+    def _get_group_vars_names(self, group_vars_files):
+        '''Return the names of the variables defined in group_vars files'''
+        names = set()
+        for group_vars_file, _ in group_vars_files:
+            try:
+                with open(group_vars_file, 'r') as f:
+                    data = yaml.safe_load(f)
+            except Exception:
+                # Ansible reports broken group_vars files itself
+                continue
+            if isinstance(data, dict):
+                names.update(data)
+        return names
 
     def _read_config_data(self, path):
         '''Read the YAML configuration file'''
@@ -49,119 +476,439 @@ class InventoryModule(BaseInventoryPlugin):
         except Exception as e:
             raise AnsibleParserError('Error reading YAML configuration file: %s' % e)
 
+    def _validate_discovery_data(self, discovery):
+        '''Validate the discovery settings, reporting all errors together'''
+        if not isinstance(discovery, dict):
+            raise AnsibleParserError("'discovery' must be a mapping.")
+        errors = []
+        if not isinstance(discovery.get('project'), str) or not discovery['project']:
+            errors.append("Missing required variable 'project' for discovery.")
+        zones = discovery.get('zones')
+        if not isinstance(zones, list) or not zones or not all(isinstance(zone, str) for zone in zones):
+            errors.append("'discovery.zones' must be a non-empty list of zones.")
+        if not isinstance(discovery.get('labels') or {}, dict):
+            errors.append("'discovery.labels' must be a mapping of labels.")
+        for option, minimum in (('cache_ttl', 0), ('max_workers', 1)):
+            value = discovery.get(option)
+            if value is not None and (not isinstance(value, int) or isinstance(value, bool) or value < minimum):
+                errors.append("'discovery.%s' must be an integer of at least %d." % (option, minimum))
+        if errors:
+            raise AnsibleParserError('\n'.join(errors))
+
+    def _get_compute_client(self):
+        '''Return the client listing the instances for discovery'''
+        if self.compute_client is None:
+            self.compute_client = ComputeClient()
+        return self.compute_client
+
+    def _get_discovery_cache_key(self, discovery):
+        '''Return a cache key for the instances found with the given discovery settings'''
+        settings = {key: discovery.get(key) for key in ('project', 'zones', 'labels', 'use_public_ip')}
+        digest = hashlib.sha256(json.dumps(settings, sort_keys=True).encode())
+        return '%s_discovery_%s' % (self.NAME, digest.hexdigest()[:32])
+
+    def _list_zone_instances(self, client, discovery, zone):
+        '''Return the records of the instances of a zone, following its pages'''
+        instances = []
+        page_token = None
+        while True:
+            try:
+                page = client.list_instances(discovery['project'], zone, discovery.get('labels') or {}, page_token)
+            except Exception as e:
+                raise AnsibleParserError('Error listing the instances of zone %s: %s' % (zone, e))
+            instances.extend(_get_instance_record(instance, discovery.get('use_public_ip', False))
+                             for instance in page.get('items', []))
+            page_token = page.get('nextPageToken')
+            if not page_token:
+                return instances
+
+    def _list_instances(self, discovery):
+        '''Return the records of the instances of all zones, listing the zones concurrently'''
+        client = self._get_compute_client()
+        zones = discovery['zones']
+        max_workers = min(len(zones), discovery.get('max_workers', DISCOVERY_MAX_WORKERS))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            zone_instances = list(executor.map(lambda zone: self._list_zone_instances(client, discovery, zone), zones))
+        return sorted((instance for instances in zone_instances for instance in instances),
+                      key=lambda instance: instance['name'])
+
+    def _get_discovered_instances(self, discovery, use_cache, read_cache):
+        '''Return the discovered instances and the time they expire, from the cache while they are fresh'''
+        ttl = discovery.get('cache_ttl', DISCOVERY_CACHE_TTL)
+        now = time.time()
+        if use_cache:
+            cache_key = self._get_discovery_cache_key(discovery)
+            if read_cache:
+                try:
+                    cached = self._cache[cache_key]
+                except KeyError:
+                    cached = None
+                if cached is not None and cached['fetched'] + ttl > now:
+                    return cached['instances'], cached['fetched'] + ttl
+        instances = self._list_instances(discovery)
+        if use_cache:
+            self._cache[cache_key] = {'fetched': now, 'instances': instances}
+        return instances, now + ttl
+
+    def _discover_hosts(self, discovery, use_cache, read_cache):
+        '''Complete the configuration with the discovered hosts, returning the time they expire'''
+        self._validate_discovery_data(discovery)
+        instances, expires = self._get_discovered_instances(discovery, use_cache, read_cache)
+
+        fleet = self.config_data.get('fleet')
+        if fleet is None:
+            self.config_data, errors = self._fill_discovered_hosts(self.config_data, instances)
+        else:
+            errors = []
+            # An invalid fleet is reported by _validate_config_data
+            deployments = fleet.get('deployments') if isinstance(fleet, dict) else None
+            defaults = (fleet.get('defaults') or {}) if isinstance(fleet, dict) else None
+            if isinstance(deployments, dict) and isinstance(defaults, dict):
+                for name, config in deployments.items():
+                    if not isinstance(config, dict):
+                        continue
+                    selected = [instance for instance in instances
+                                if instance['labels'].get(DISCOVERY_DEPLOYMENT_LABEL) == str(name).lower()]
+                    deployments[name], deployment_errors = self._fill_discovered_hosts({**defaults, **config}, selected)
+                    errors.extend("Deployment '%s': %s" % (name, error) for error in deployment_errors)
+        if errors:
+            raise AnsibleParserError('\n'.join(errors))
+        return expires
+
+    def _fill_discovered_hosts(self, config, instances):
+        '''Return the configuration with the hosts it lacks taken from the instances, and the errors found'''
+        config = dict(config)
+        errors = []
+        databases = [instance for instance in instances if instance['labels'].get(DISCOVERY_ROLE_LABEL) != 'primary']
+
+        if config.get('ora_cluster_type') == 'RAC':
+            clusters = config.get('cluster_config_json')
+            if isinstance(clusters, list):
+                config['cluster_config_json'] = [
+                    dict(cluster, nodes=self._get_discovered_nodes(cluster, databases, len(clusters) == 1))
+                    if isinstance(cluster, dict) and 'nodes' not in cluster else cluster
+                    for cluster in clusters]
+            return config, errors
+
+        if 'instance_ip_addr' not in config:
+            if 'instance_hostname' in config:
+                matches = [instance for instance in databases if instance['name'] == config['instance_hostname']]
+            else:
+                matches = databases
+            if len(matches) == 1:
+                config.setdefault('instance_hostname', matches[0]['name'])
+                config['instance_ip_addr'] = matches[0]['ip']
+            else:
+                errors.append("Discovery found %d database instances, expected one. Set 'instance_hostname' or narrow 'discovery.labels'." % len(matches))
+        if config.get('ora_cluster_type') == 'DG' and 'primary_ip_addr' not in config:
+            primaries = [instance for instance in instances if instance['labels'].get(DISCOVERY_ROLE_LABEL) == 'primary']
+            if len(primaries) == 1:
+                config['primary_ip_addr'] = primaries[0]['ip']
+            else:
+                errors.append("Discovery found %d instances labelled %s=primary, expected one." % (len(primaries), DISCOVERY_ROLE_LABEL))
+        return config, errors
+
+    def _get_discovered_nodes(self, cluster, instances, only_cluster):
+        '''Return the nodes of a RAC cluster, the instances labelled with its name'''
+        cluster_name = str(cluster.get('cluster_name', '')).lower()
+        nodes = []
+        for instance in instances:
+            label = instance['labels'].get(DISCOVERY_CLUSTER_LABEL)
+            # The instances of a single cluster do not need the cluster label
+            if label != cluster_name and not (only_cluster and label is None):
+                continue
+            node = {
+                'node_name': instance['name'],
+                'host_ip': instance['ip'],
+                'vip_name': instance['metadata'].get(DISCOVERY_VIP_NAME_KEY, '%s-vip' % instance['name']),
+            }
+            if DISCOVERY_VIP_IP_KEY in instance['metadata']:
+                node['vip_ip'] = instance['metadata'][DISCOVERY_VIP_IP_KEY]
+            nodes.append(node)
+        return nodes
+
+    def _get_deployments(self):
+        '''Return the name and configuration of each deployment, the name of a single one being None'''
+        fleet = self.config_data.get('fleet')
+        if fleet is None:
+            return [(None, self.config_data)]
+        defaults = fleet.get('defaults') or {}
+        return [(name, {**defaults, **config}) for name, config in fleet['deployments'].items()]
+
+    def _get_database_hostnames(self, config):
+        '''Return the names of the database hosts of a deployment'''
+        if config.get('ora_cluster_type') == 'RAC':
+            return [node['node_name'] for cluster in config['cluster_config_json'] for node in cluster['nodes']]
+        return [config['instance_hostname']]
+
     def _validate_config_data(self):
-        '''Validate that all required configuration variables are present'''
-        cluster_type = self.config_data.get('ora_cluster_type')
+        '''Validate that all required configuration variables are present, reporting all missing ones together'''
+        if 'fleet' in self.config_data:
+            errors = self._validate_fleet_data()
+        else:
+            errors = self._validate_deployment_data(self.config_data)
+        if errors:
+            raise AnsibleParserError('\n'.join(errors))
+
+    def _validate_fleet_data(self):
+        '''Return the errors of the deployments of a fleet, including hosts they share'''
+        fleet = self.config_data['fleet']
+        errors = []
+        extra_keys = sorted(set(self.config_data) - {'fleet'})
+        if extra_keys:
+            errors.append("Unexpected top-level variables in a fleet configuration: %s. Set variables shared by all deployments in 'fleet.defaults'." % ', '.join(extra_keys))
+        if not isinstance(fleet, dict) or not isinstance(fleet.get('deployments'), dict) or not fleet['deployments']:
+            return errors + ["'fleet' must have a non-empty 'deployments' mapping."]
+        if not isinstance(fleet.get('defaults') or {}, dict):
+            return errors + ["'fleet.defaults' must be a mapping."]
+        for name, config in fleet['deployments'].items():
+            if not isinstance(name, str) or not DEPLOYMENT_NAME_RE.match(name) or name in RESERVED_GROUP_NAMES:
+                errors.append("Invalid deployment name '%s': it must be a valid group name made of letters, digits and underscores." % name)
+            if not isinstance(config, dict):
+                errors.append("Deployment '%s' must be a mapping of variables." % name)
+        if errors:
+            return errors
+
+        deployment_of_host = {}
+        for name, config in self._get_deployments():
+            deployment_errors = self._validate_deployment_data(config)
+            errors.extend("Deployment '%s': %s" % (name, error) for error in deployment_errors)
+            if deployment_errors:
+                continue
+            for hostname in self._get_database_hostnames(config):
+                if hostname in deployment_of_host:
+                    errors.append("Host '%s' is declared by both deployments '%s' and '%s'." % (hostname, deployment_of_host[hostname], name))
+                deployment_of_host.setdefault(hostname, name)
+        return errors
+
+    def _validate_deployment_data(self, config):
+        '''Return the errors of the configuration variables of a single deployment'''
+        cluster_type = config.get('ora_cluster_type')
+        errors = []
 
         if cluster_type == 'RAC':
-            if 'cluster_config_json' not in self.config_data:
-                raise AnsibleParserError("Missing required variable 'cluster_config_json' for RAC installation.")
-            cluster_config = self.config_data['cluster_config_json']
+            if 'cluster_config_json' not in config:
+                return ["Missing required variable 'cluster_config_json' for RAC installation."]
+            cluster_config = config['cluster_config_json']
             if not isinstance(cluster_config, list) or not cluster_config:
-                raise AnsibleParserError("'cluster_config_json' must be a non-empty list for RAC installation.")
+                return ["'cluster_config_json' must be a non-empty list for RAC installation."]
             for i, cluster in enumerate(cluster_config):
                 if 'nodes' not in cluster or not isinstance(cluster['nodes'], list) or not cluster['nodes']:
-                    raise AnsibleParserError("Each cluster in 'cluster_config_json' must have a non-empty 'nodes' list. Check cluster #%d." % (i+1))
+                    errors.append("Each cluster in 'cluster_config_json' must have a non-empty 'nodes' list. Check cluster #%d." % (i+1))
+                    continue
                 for j, node in enumerate(cluster['nodes']):
                     if 'node_name' not in node:
-                        raise AnsibleParserError("Missing 'node_name' for node #%d in cluster #%d." % (j+1, i+1))
+                        errors.append("Missing 'node_name' for node #%d in cluster #%d." % (j+1, i+1))
                     if 'host_ip' not in node:
-                        raise AnsibleParserError("Missing 'host_ip' for node #%d in cluster #%d." % (j+1, i+1))
+                        errors.append("Missing 'host_ip' for node #%d in cluster #%d." % (j+1, i+1))
 
         elif cluster_type == 'DG':
             required_vars = ['instance_hostname', 'instance_ip_addr', 'primary_ip_addr']
             for var in required_vars:
-                if var not in self.config_data:
-                    raise AnsibleParserError("Missing required variable '%s' for Data Guard installation." % var)
+                if var not in config:
+                    errors.append("Missing required variable '%s' for Data Guard installation." % var)
         else: # Single Instance
             required_vars = ['instance_hostname', 'instance_ip_addr']
             for var in required_vars:
-                if var not in self.config_data:
-                    raise AnsibleParserError("Missing required variable '%s' for Single Instance installation." % var)
+                if var not in config:
+                    errors.append("Missing required variable '%s' for Single Instance installation." % var)
+        return errors
 
-    def _populate_inventory(self):
-        '''Populate the inventory based on the user-provided cluster-type'''
-        if self.config_data.get('ora_cluster_type') == 'RAC':
-            self._populate_rac_inventory()
-        elif self.config_data.get('ora_cluster_type') == 'DG':
-            self._populate_dg_inventory()
+    def _get_config_settings(self, config):
+        '''Return the configuration with the settings group_vars/all.yml derives from it'''
+        settings = ConfigSettings(config)
+        # Settings given in the configuration override those of group_vars/all.yml
+        derive = settings.setdefault
+        derive('oracle_edition', config.get('ora_edition') or 'EE')
+        derive('cluster_type', config.get('ora_cluster_type') or 'NONE')
+        if 'ora_version' in config:
+            derive('oracle_ver', VERSION_MAP.get(str(config['ora_version'])) or config['ora_version'])
         else:
-            self._populate_si_inventory()
+            derive('oracle_ver', '19.3.0.0.0')
+        derive('oracle_rel', config.get('ora_release') or 'latest')
+        derive('swlib_mount_type', str(config.get('ora_swlib_type') or 'gcs').lower())
+        free_edition = settings['oracle_edition'] == 'FREE'
+        derive('ora_disk_management', 'fs' if free_edition else str(config.get('ora_disk_mgmt') or 'udev').lower())
+        derive('gi_install', not free_edition and settings['ora_disk_management'] != 'fs')
+        derive('db_type', str(config.get('ora_db_type') or 'multipurpose').lower())
+        derive('data_destination', config.get('ora_data_destination') or 'DATA')
+        derive('reco_destination', config.get('ora_reco_destination') or 'RECO')
+        derive('backup_dest', config.get('_backup_dest') or '')
+        derive('db_password_secret', str(config.get('_db_password_secret') or '').lower())
+        derive('oracle_metrics_secret', config.get('_oracle_metrics_secret') or '')
+        derive('install_workload_agent', str(config.get('_install_workload_agent', False)).lower())
+        derive('db_name', 'FREE' if free_edition else config.get('ora_db_name') or 'ORCL')
+        derive('db_domain', config.get('ora_db_domain') or '')
+        derive('listener_name', config.get('ora_listener_name') or 'LISTENER')
+        derive('listener_port', config.get('ora_listener_port') or '1521')
+        derive('pdb_prefix', config.get('ora_pdb_name_prefix') or 'PDB')
+        derive('pdb_count', config.get('ora_pdb_count') or '1')
+        derive('charset', config.get('ora_db_charset') or 'AL32UTF8')
+        derive('ncharset', config.get('ora_db_ncharset') or 'AL16UTF16')
+        derive('rman_db_bu_redundancy', config.get('backup_redundancy') or '2')
+        derive('rman_arch_redundancy', config.get('archive_redundancy') or '2')
+        derive('rman_archs_online_days', config.get('archive_online_days') or '7')
+        derive('container_db', config['ora_db_container'] if 'ora_db_container' in config
+               else _version(settings['oracle_ver']) >= (21,))
+        derive('instance_ssh_user', config.get('_instance_ssh_user') or os.environ.get('USER', ''))
+        return settings
 
-    def _populate_si_inventory(self):
+    def _check_config_rules(self, config, hostnames):
+        '''Return the violations of the rules of validate-config.yml by a deployment and its database hosts'''
+        settings = self._get_config_settings(config)
+        violations = check_rules(CONFIG_RULES, settings)
+        for hostname in hostnames:
+            violations.extend(check_rules(HOST_RULES, ConfigSettings(
+                settings, inventory_hostname=hostname, inventory_hostname_length=len(hostname))))
+        return violations
+
+    def _add_group(self, group, variables=None, parent=None):
+        '''Add a group, its variables and its parent group to the layout'''
+        entry = self._layout['groups'].setdefault(group, {'vars': {}, 'children': []})
+        if variables:
+            entry['vars'].update(variables)
+        if parent:
+            self._add_group(parent)
+            if group not in self._layout['groups'][parent]['children']:
+                self._layout['groups'][parent]['children'].append(group)
+
+    def _add_host(self, hostname, group, variables):
+        '''Add a host, its group and its variables to the layout'''
+        self._add_group(group)
+        entry = self._layout['hosts'].setdefault(hostname, {'groups': [], 'vars': {}})
+        if group not in entry['groups']:
+            entry['groups'].append(group)
+        entry['vars'].update(variables)
+
+    def _apply_layout(self, layout):
+        '''Populate the inventory from a layout built by _populate_inventory'''
+        for group, entry in layout['groups'].items():
+            self.inventory.add_group(group)
+            for key, value in entry['vars'].items():
+                self.inventory.groups[group].set_variable(key, value)
+        for group, entry in layout['groups'].items():
+            for child in entry['children']:
+                self.inventory.add_child(group, child)
+        for hostname, entry in layout['hosts'].items():
+            for group in entry['groups']:
+                self.inventory.add_host(hostname, group=group)
+            host = self.inventory.get_host(hostname)
+            for key, value in entry['vars'].items():
+                host.set_variable(key, value)
+
+    def _populate_inventory(self):
+        '''Build the inventory layout of each deployment based on its cluster-type'''
+        for name, config in self._get_deployments():
+            group, primary_group, primary_host = DEFAULT_HOSTGROUP_NAME, 'primary', 'primary1'
+            if name is not None:
+                # Namespace the groups and hosts of each deployment of a fleet. Its
+                # database hosts stay in 'dbasm', through '<name>_dbasm', for the playbooks.
+                group = '%s_%s' % (name, DEFAULT_HOSTGROUP_NAME)
+                self._add_group(group, parent=DEFAULT_HOSTGROUP_NAME)
+                self._add_group(group, parent=name)
+                config = dict(config, deployment_name=name, deployment_group=group)
+                if config.get('ora_cluster_type') == 'DG':
+                    primary_group, primary_host = '%s_primary' % name, '%s_primary1' % name
+                    self._add_group(primary_group, parent='primary')
+                    self._add_group(primary_group, parent=name)
+                    config['primary_host'] = primary_host
+
+            if config.get('ora_cluster_type') == 'RAC':
+                hostnames = self._populate_rac_inventory(config, group)
+            elif config.get('ora_cluster_type') == 'DG':
+                hostnames = self._populate_dg_inventory(config, group, primary_group, primary_host)
+            else:
+                hostnames = self._populate_si_inventory(config, group)
+
+            # Ansible lists the hosts of child groups in no particular order, so the
+            # database hosts are also put directly in their groups to keep their order
+            for hostname in hostnames:
+                self._add_host(hostname, group, {})
+                self._add_host(hostname, DEFAULT_HOSTGROUP_NAME, {})
+
+            # The first database host of each deployment runs the plays done once per deployment
+            self._add_host(hostnames[0], FIRST_HOSTGROUP_NAME, {})
+
+            # validate-config.yml reports these instead of checking each rule on each host
+            self._add_group(group, {'config_violations': self._check_config_rules(config, hostnames)})
+
+    def _populate_si_inventory(self, config, group):
         '''Populate a single instance inventory'''
-        self.inventory.add_group(DEFAULT_HOSTGROUP_NAME)
-        hostname = self.config_data.get('instance_hostname')
-        ssh_host = self.config_data.get('instance_ip_addr')
-        self.inventory.add_host(hostname, group=DEFAULT_HOSTGROUP_NAME)
-        host = self.inventory.get_host(hostname)
-        host.set_variable('ansible_ssh_host', ssh_host)
-        self._set_common_variables(hostname)
-
-    def _populate_dg_inventory(self):
+        hostname = config.get('instance_hostname')
+        ssh_host = config.get('instance_ip_addr')
+        self._add_host(hostname, group, {'ansible_ssh_host': ssh_host})
+        self._set_common_variables(group, [hostname], config)
+        return [hostname]
+
+    def _populate_dg_inventory(self, config, group, primary_group, primary_host):
         '''Populate a Data Guard inventory'''
         # Standby host (uses instance_hostname and instance_ip_addr from gcp_oracle.yml)
-        self.inventory.add_group(DEFAULT_HOSTGROUP_NAME)
-        standby_hostname = self.config_data.get('instance_hostname')
-        standby_ssh_host = self.config_data.get('instance_ip_addr')
-        self.inventory.add_host(standby_hostname, group=DEFAULT_HOSTGROUP_NAME)
-        standby_host = self.inventory.get_host(standby_hostname)
-        standby_host.set_variable('ansible_ssh_host', standby_ssh_host)
-        standby_host.set_variable('is_standby_node', True)
-        self._set_common_variables(standby_hostname)
-
-        # Primary host (hardcoded as 'primary1', uses primary_ip_addr from gcp_oracle.yml)
-        self.inventory.add_group('primary')
-        primary_ssh_host = self.config_data.get('primary_ip_addr')
-        self.inventory.add_host('primary1', group='primary')
-        primary_host = self.inventory.get_host('primary1')
-        primary_host.set_variable('ansible_ssh_host', primary_ssh_host)
-        primary_host.set_variable('is_primary_node', True)
+        standby_hostname = config.get('instance_hostname')
+        standby_ssh_host = config.get('instance_ip_addr')
+        self._add_host(standby_hostname, group, {
+            'ansible_ssh_host': standby_ssh_host,
+            'is_standby_node': True,
+        })
+        self._set_common_variables(group, [standby_hostname], config)
+
+        # Primary host ('primary1' unless namespaced in a fleet, uses primary_ip_addr from gcp_oracle.yml)
+        primary_ssh_host = config.get('primary_ip_addr')
+        self._add_host(primary_host, primary_group, {
+            'ansible_ssh_host': primary_ssh_host,
+            'is_primary_node': True,
+        })
 
         # Explicitly set connection vars for both hosts
-        ssh_user = self.config_data.get('_instance_ssh_user')
-        ssh_key = self.config_data.get('_instance_ssh_key')
+        connection_vars = {}
+        ssh_user = config.get('_instance_ssh_user')
+        ssh_key = config.get('_instance_ssh_key')
         if ssh_user:
-            standby_host.set_variable('ansible_ssh_user', ssh_user)
-            primary_host.set_variable('ansible_ssh_user', ssh_user)
+            connection_vars['ansible_ssh_user'] = ssh_user
         if ssh_key:
-            standby_host.set_variable('ansible_ssh_private_key_file', ssh_key)
-            primary_host.set_variable('ansible_ssh_private_key_file', ssh_key)
+            connection_vars['ansible_ssh_private_key_file'] = ssh_key
+        self._add_host(standby_hostname, group, connection_vars)
+        self._add_host(primary_host, primary_group, connection_vars)
+        return [standby_hostname]
 
-
-    def _populate_rac_inventory(self):
+    def _populate_rac_inventory(self, config, group):
         '''Populate a RAC inventory'''
-        self.inventory.add_group(DEFAULT_HOSTGROUP_NAME)
-        cluster_config = self.config_data.get('cluster_config_json', [])
+        self._add_group(group)
+        cluster_config = config.get('cluster_config_json', [])
+
+        # Remove the large cluster_config_json from the common vars
+        common_vars = {k: v for k, v in config.items() if k != 'cluster_config_json'}
 
-        # Remove the large cluster_config_json from each host
-        common_vars = {k: v for k, v in self.config_data.items() if k != 'cluster_config_json'}
+        hostnames = []
+        for i, cluster in enumerate(cluster_config):
+            # Each cluster gets a child group of the deployment's group holding its cluster-wide parameters
+            cluster_group = '%s_cluster_%d' % (group, i + 1)
+            self._add_group(cluster_group, {k: v for k, v in cluster.items() if k != 'nodes'},
+                            parent=group)
 
-        for cluster in cluster_config:
             for node in cluster.get('nodes', []):
                 hostname = node.get('node_name')
                 ssh_host = node.get('host_ip')
-                self.inventory.add_host(hostname, group=DEFAULT_HOSTGROUP_NAME)
-                host = self.inventory.get_host(hostname)
+                hostnames.append(hostname)
 
                 # Set node-specific vars from the cluster config
-                host.set_variable('ansible_ssh_host', ssh_host)
-                host.set_variable('vip_name', node.get('vip_name'))
-                host.set_variable('vip_ip', node.get('vip_ip'))
-
-                # Set common vars from the top-level config
-                for key, value in common_vars.items():
-                    host.set_variable(key, value)
-
-            # Set cluster-wide parameters as group variables for the 'dbasm' group
-            for key, value in cluster.items():
-                if key != 'nodes':
-                    self.inventory.groups[DEFAULT_HOSTGROUP_NAME].set_variable(key, value)
-
-    def _set_common_variables(self, hostname):
-        '''Set common variables for a host'''
-        host = self.inventory.get_host(hostname)
-        if host:
-            # Set all config values as host variables
-            for key, value in self.config_data.items():
-                host.set_variable(key, value)
+                self._add_host(hostname, cluster_group, {
+                    'ansible_ssh_host': ssh_host,
+                    'vip_name': node.get('vip_name'),
+                    'vip_ip': node.get('vip_ip'),
+                })
+
+        # Set common vars from the top-level config
+        self._set_common_variables(group, hostnames, common_vars)
+        return hostnames
+
+    def _set_common_variables(self, group, hostnames, variables):
+        '''Set common variables once on the group of the given hosts'''
+        self._add_group(group, {k: v for k, v in variables.items() if k not in self._host_only_vars})
+
+        # Inventory group variables rank below group_vars files, so variables
+        # those files also define stay on the hosts to keep overriding them
+        host_vars = {k: v for k, v in variables.items() if k in self._host_only_vars}
+        for hostname in hostnames:
+            entry = self._layout['hosts'].get(hostname)
+            if entry:
+                entry['vars'].update(host_vars)
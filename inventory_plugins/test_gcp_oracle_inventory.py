@@ -2,16 +2,33 @@ import unittest
 from unittest.mock import patch
 import os
 import json
+import shutil
+import tempfile
+import time
+import yaml
 
-from gcp_oracle_inventory import InventoryModule
+from ansible import constants as C
 from ansible.errors import AnsibleParserError
+from ansible.inventory.data import InventoryData
+from ansible.inventory.helpers import get_group_vars
 from ansible.inventory.manager import InventoryManager
 from ansible.parsing.dataloader import DataLoader
+from ansible.plugins.loader import inventory_loader
+from ansible.utils.vars import combine_vars
+from ansible.vars.manager import VariableManager
+
+from fake_compute_client import FakeComputeClient, make_instance, make_instances
+from gcp_oracle_inventory import (DEFAULT_HOSTGROUP_NAME, DISCOVERY_CLUSTER_LABEL, DISCOVERY_DEPLOYMENT_LABEL,
+                                  DISCOVERY_ROLE_LABEL, DISCOVERY_VIP_IP_KEY, DISCOVERY_VIP_NAME_KEY, VERSION_MAP)
+
+TOOLKIT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 class TestGcpOracleInventory(unittest.TestCase):
 
     def setUp(self):
-        self.inventory_module = InventoryModule()
+        # Load through the plugin loader so the plugin has its option definitions
+        inventory_loader.add_directory(os.path.dirname(os.path.abspath(__file__)))
+        self.inventory_module = inventory_loader.get('gcp_oracle_inventory')
         self.loader = DataLoader()
         self.testdata_path = os.path.join(os.path.dirname(__file__), 'testdata')
         self.maxDiff = None
@@ -56,13 +73,44 @@ class TestGcpOracleInventory(unittest.TestCase):
 
         return result
 
+    def _get_resolved_hostvars(self, config_name=None, config_data=None):
+        """
+        Returns the variables each host resolves to with the toolkit's
+        group_vars applied, limited to the variables set by the inventory,
+        for a test input or the given configuration.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        os.symlink(os.path.join(TOOLKIT_DIR, 'group_vars'), os.path.join(tmpdir, 'group_vars'))
+        config_file = os.path.join(tmpdir, 'gcp_oracle.yml.test')
+        if config_data is None:
+            shutil.copy(os.path.join(self.testdata_path, 'inputs', f'{config_name}.yml'), config_file)
+        else:
+            with open(config_file, 'w') as f:
+                json.dump(config_data, f)
+
+        with patch.object(C, 'INVENTORY_ENABLED', ['gcp_oracle_inventory']):
+            inventory = InventoryManager(loader=self.loader, sources=[config_file])
+        variable_manager = VariableManager(loader=self.loader, inventory=inventory)
+
+        result = {}
+        for host in inventory.get_hosts():
+            inventory_vars = set(host.vars)
+            for group in host.get_groups():
+                inventory_vars.update(group.vars)
+            # Remove implicit variables that change between environments
+            inventory_vars.difference_update(('inventory_file', 'inventory_dir'))
+            resolved = variable_manager.get_vars(host=host)
+            result[host.name] = {key: resolved[key] for key in sorted(inventory_vars)}
+        return result
+
     def _run_test_case(self, config_name):
         """
         Runs a test case by parsing an inventory config and comparing
         the result to an expected JSON output file.
         """
         # Each test run needs a fresh inventory object
-        inventory = InventoryManager(loader=self.loader, sources=[])
+        inventory = InventoryData()
         self.inventory_module.inventory = inventory
 
         config_file = os.path.join(self.testdata_path, 'inputs', f'{config_name}.yml')
@@ -99,12 +147,89 @@ class TestGcpOracleInventory(unittest.TestCase):
     def test_rac_inventory(self):
         self._run_test_case('rac')
 
+    def test_resolved_hostvars(self):
+        """
+        Tests that placing shared configuration on groups leaves every host
+        with the same resolved variables as setting them on each host did,
+        including those that group_vars/all.yml also defines.
+        """
+        for config_name in ('single_instance', 'data_guard_primary', 'data_guard_standby', 'rac'):
+            with self.subTest(config_name=config_name):
+                expected_json_file = os.path.join(self.testdata_path, 'resolved', f'{config_name}.json')
+                with open(expected_json_file, 'r') as f:
+                    expected_hostvars = json.load(f)
+                self.assertDictEqual(self._get_resolved_hostvars(config_name), expected_hostvars)
+
+    def test_rac_clusters_keep_their_own_settings(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        config_file = os.path.join(tmpdir, 'gcp_oracle.yml')
+        with open(config_file, 'w') as f:
+            json.dump({
+                'ora_cluster_type': 'RAC',
+                'cluster_config_json': [
+                    {'scan_name': 'scan-a', 'nodes': [{'node_name': 'a1', 'host_ip': '10.0.0.1'}]},
+                    {'scan_name': 'scan-b', 'nodes': [{'node_name': 'b1', 'host_ip': '10.0.1.1'}]},
+                ],
+            }, f)
+        inventory = InventoryData()
+        self.inventory_module.parse(inventory, self.loader, config_file)
+
+        for hostname, scan_name in (('a1', 'scan-a'), ('b1', 'scan-b')):
+            host = inventory.get_host(hostname)
+            self.assertEqual(get_group_vars(host.get_groups())['scan_name'], scan_name)
+            self.assertIn(host, inventory.groups[DEFAULT_HOSTGROUP_NAME].get_hosts())
+        self.assertNotIn('scan_name', inventory.groups[DEFAULT_HOSTGROUP_NAME].get_vars())
+
+    def test_fleet_inventory(self):
+        self._run_test_case('fleet')
+
+    def test_fleet_deployments_resolve_as_single_deployments(self):
+        """
+        Tests that the database hosts of each deployment of a fleet resolve
+        the same variables as when the deployment is described alone.
+        """
+        with open(os.path.join(self.testdata_path, 'inputs', 'fleet.yml'), 'r') as f:
+            fleet = yaml.safe_load(f)['fleet']
+        fleet_hostvars = self._get_resolved_hostvars('fleet')
+
+        for name, config in fleet['deployments'].items():
+            with self.subTest(deployment=name):
+                single_hostvars = self._get_resolved_hostvars(config_data=dict(fleet['defaults'], **config))
+                # The Data Guard primary is namespaced in a fleet
+                single_hostvars.pop('primary1', None)
+                for hostname, expected_hostvars in single_hostvars.items():
+                    hostvars = dict(fleet_hostvars[hostname])
+                    self.assertEqual(hostvars.pop('deployment_name'), name)
+                    self.assertEqual(hostvars.pop('deployment_group'), f'{name}_dbasm')
+                    if 'primary_host' in hostvars:
+                        self.assertEqual(hostvars.pop('primary_host'), f'{name}_primary1')
+                    self.assertDictEqual(hostvars, expected_hostvars)
+
+    def test_invalid_fleet_raises_error(self):
+        hr = {'instance_hostname': 'hr-db', 'instance_ip_addr': '10.0.1.1'}
+        cases = [
+            ({'fleet': {'deployments': {}}}, "'fleet' must have a non-empty 'deployments' mapping."),
+            ({'fleet': {'deployments': {'hr': hr}}, 'db_name': 'HR'}, "Unexpected top-level variables in a fleet configuration: db_name."),
+            ({'fleet': {'deployments': {'hr-prod': hr}}}, "Invalid deployment name 'hr-prod'"),
+            ({'fleet': {'deployments': {'dbasm': hr}}}, "Invalid deployment name 'dbasm'"),
+            ({'fleet': {'deployments': {'hr': hr, 'hr2': hr}}}, "Host 'hr-db' is declared by both deployments 'hr' and 'hr2'."),
+            ({'fleet': {'deployments': {'crm': {'ora_cluster_type': 'DG', 'instance_hostname': 'crm', 'instance_ip_addr': '10.0.3.2'}}}},
+             "Deployment 'crm': Missing required variable 'primary_ip_addr'"),
+        ]
+        for config_data, message in cases:
+            with self.subTest(message=message):
+                self.inventory_module.config_data = config_data
+                with self.assertRaises(AnsibleParserError) as cm:
+                    self.inventory_module._validate_config_data()
+                self.assertIn(message, str(cm.exception))
+
     def test_data_guard_inventory_variable_separation(self):
         """
         Tests that for a Data Guard setup, the primary host does not get
         standby-specific variables incorrectly copied to it.
         """
-        inventory = InventoryManager(loader=self.loader, sources=[])
+        inventory = InventoryData()
         self.inventory_module.inventory = inventory
         config_file = os.path.join(self.testdata_path, 'inputs', 'data_guard_standby.yml')
 
@@ -117,8 +242,9 @@ class TestGcpOracleInventory(unittest.TestCase):
         self.assertIsNotNone(primary_host, "Primary host 'primary1' should exist")
         self.assertIsNotNone(standby_host, "Standby host 'standby-1' should exist")
 
-        primary_vars = primary_host.get_vars()
-        standby_vars = standby_host.get_vars()
+        # Shared configuration is set on the hosts' groups
+        primary_vars = combine_vars(get_group_vars(primary_host.get_groups()), primary_host.get_vars())
+        standby_vars = combine_vars(get_group_vars(standby_host.get_groups()), standby_host.get_vars())
 
         # 1. Verify Primary Host
         # It should have its own SSH host IP
@@ -144,7 +270,7 @@ class TestGcpOracleInventory(unittest.TestCase):
         self.assertNotIn('is_primary_node', standby_vars)
 
     def test_malformed_yaml_raises_error(self):
-        inventory = InventoryManager(loader=self.loader, sources=[])
+        inventory = InventoryData()
         self.inventory_module.inventory = inventory
         config_file = os.path.join(self.testdata_path, 'inputs', 'malformed.yml')
         with self.assertRaises(AnsibleParserError) as cm:
@@ -152,7 +278,7 @@ class TestGcpOracleInventory(unittest.TestCase):
         self.assertIn('Invalid YAML configuration: Expected a dictionary but got', str(cm.exception))
 
     def test_missing_si_vars_raises_error(self):
-        inventory = InventoryManager(loader=self.loader, sources=[])
+        inventory = InventoryData()
         self.inventory_module.inventory = inventory
         self.inventory_module.config_data = {'ora_cluster_type': 'SI', 'instance_ip_addr': '1.1.1.1'}
         with self.assertRaises(AnsibleParserError) as cm:
@@ -160,7 +286,7 @@ class TestGcpOracleInventory(unittest.TestCase):
         self.assertIn("Missing required variable 'instance_hostname'", str(cm.exception))
 
     def test_missing_dg_vars_raises_error(self):
-        inventory = InventoryManager(loader=self.loader, sources=[])
+        inventory = InventoryData()
         self.inventory_module.inventory = inventory
         self.inventory_module.config_data = {'ora_cluster_type': 'DG', 'instance_hostname': 'test', 'instance_ip_addr': '1.1.1.1'}
         with self.assertRaises(AnsibleParserError) as cm:
@@ -168,9 +294,287 @@ class TestGcpOracleInventory(unittest.TestCase):
         self.assertIn("Missing required variable 'primary_ip_addr'", str(cm.exception))
 
     def test_missing_rac_vars_raises_error(self):
-        inventory = InventoryManager(loader=self.loader, sources=[])
+        inventory = InventoryData()
         self.inventory_module.inventory = inventory
         self.inventory_module.config_data = {'ora_cluster_type': 'RAC'}
         with self.assertRaises(AnsibleParserError) as cm:
             self.inventory_module._validate_config_data()
         self.assertIn("Missing required variable 'cluster_config_json'", str(cm.exception))
+
+    def test_missing_vars_are_reported_together(self):
+        self.inventory_module.config_data = {'ora_cluster_type': 'DG', 'instance_ip_addr': '1.1.1.1'}
+        with self.assertRaises(AnsibleParserError) as cm:
+            self.inventory_module._validate_config_data()
+        self.assertIn("Missing required variable 'instance_hostname'", str(cm.exception))
+        self.assertIn("Missing required variable 'primary_ip_addr'", str(cm.exception))
+
+    def test_config_violations_are_reported_together(self):
+        config_data = {
+            'instance_hostname': 'db-1',
+            'instance_ip_addr': '10.0.0.300',
+            'primary_ip_addr': '10.0.0.1',
+            '_instance_ssh_user': 'ansible',
+            'ora_cluster_type': 'DG',
+            'ora_edition': 'SE2',
+            'ora_version': '19',
+            'ora_swlib_bucket': 'my-bucket',
+            'ora_db_name': '1ORCL',
+            'ora_listener_port': 80,
+            'ora_redo_log_size': '1G',
+            'ora_disk_mgmt': 'fs',
+            '_backup_dest': '+RECO',
+            'gcs_backup_config': 'auto',
+            'gcs_backup_bucket': 'gs://backups/',
+            '_nfs_backup_config': 'nfsv2',
+            'compatible_rdbms': '21.0.0',
+        }
+        inventory = InventoryData()
+        self.inventory_module.inventory = inventory
+        config_file = os.path.join(tempfile.mkdtemp(), 'gcp_oracle.yml')
+        self.addCleanup(shutil.rmtree, os.path.dirname(config_file))
+        with open(config_file, 'w') as f:
+            yaml.safe_dump(config_data, f)
+        self.inventory_module.parse(inventory, self.loader, config_file)
+
+        self.assertEqual(inventory.groups[DEFAULT_HOSTGROUP_NAME].vars['config_violations'], [
+            "Invalid ora-swlib-bucket 'my-bucket'. Must be defined and start with gs:// or http(s)://.",
+            "Data Guard deployments require Enterprise Edition and a defined primary-ip-addr.",
+            "Cannot specify an ASM diskgroup when ora-disk-mgmt is FS.",
+            "Invalid format for 1ORCL.",
+            "Listener port must be between 1024 and 65535.",
+            "Redo log size '1G' must be in the format '100MB'.",
+            "gcs_backup_bucket must not end with a slash.",
+            "Invalid nfs-backup-config. Must be nfsv3 or nfsv4.",
+            "Invalid instance-ip-addr '10.0.0.300'. Must be an IP address or host name.",
+            "compatible-rdbms '21.0.0' cannot be a higher version than ora-version '19'.",
+            "You must specify a storage configuration using either 'ora-data-mounts' or 'ora-data-mounts-json'.",
+        ])
+
+    def test_valid_config_has_no_violations(self):
+        config = {
+            'instance_hostname': 'db-1',
+            'instance_ip_addr': '10.0.0.2',
+            '_instance_ssh_user': 'ansible',
+            'ora_version': '21',
+            'ora_swlib_bucket': 'gs://swlib',
+            'ora_disk_mgmt': 'asmudev',
+            'ora_asm_disks_json': [{'diskgroup': 'DATA', 'disks': [{'name': 'DATA1', 'blk_device': '/dev/sdc'}]}],
+            'ora_data_mounts_json': [{'purpose': 'software', 'blk_device': '/dev/sdb', 'mount_point': '/u01'}],
+            'ora_data_destination': '+DATA',
+            'ora_redo_log_count': '3',
+            'ora_redo_log_location': '+DATA, /u02/redo',
+            'compatible_rdbms': '19.0.0',
+            '_db_password_secret': 'projects/p/secrets/s/versions/1',
+        }
+        self.assertEqual(self.inventory_module._check_config_rules(config, ['db-1']), [])
+
+        # A container database is required from Oracle 21c
+        config['ora_db_container'] = False
+        self.assertEqual(self.inventory_module._check_config_rules(config, ['db-1']), [
+            "Oracle 21c and newer (including 23ai/26ai) require a Container Database. Set 'ora-db-container' to true.",
+        ])
+
+    def test_legacy_grid_infrastructure_hostnames_are_checked_per_host(self):
+        config = {
+            'ora_cluster_type': 'RAC',
+            'ora_version': '12.1',
+            '_instance_ssh_user': 'ansible',
+            'ora_swlib_bucket': 'gs://swlib',
+            'ora_asm_disks': 'asm.json',
+            'ora_data_mounts': 'mounts.json',
+        }
+        hostnames = ['node-1', 'a-very-long-rac-node-name-of-32-c']
+        self.assertEqual(self.inventory_module._check_config_rules(config, hostnames), [
+            "For legacy Oracle versions (< 12.2) using Grid Infrastructure (ASM), the hostname "
+            "'a-very-long-rac-node-name-of-32-c' must not exceed 30 characters due to OLR/ADR buffer limits. Current length: 33.",
+        ])
+
+    def test_version_map_matches_group_vars(self):
+        with open(os.path.join(TOOLKIT_DIR, 'group_vars', 'all.yml'), 'r') as f:
+            group_vars = yaml.safe_load(f)
+        self.assertDictEqual(VERSION_MAP, group_vars['version_map'])
+
+    def test_inventory_cache_is_keyed_by_config_content(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        config_file = os.path.join(cache_dir, 'gcp_oracle.yml')
+        shutil.copy(os.path.join(self.testdata_path, 'inputs', 'rac.yml'), config_file)
+        expected_json_file = os.path.join(self.testdata_path, 'snapshots', 'rac.json')
+        with open(expected_json_file, 'r') as f:
+            expected_inventory = json.load(f)
+
+        def parse():
+            # A fresh plugin per run, as each ansible-playbook invocation has
+            plugin = inventory_loader.get('gcp_oracle_inventory')
+            inventory = InventoryData()
+            with patch.object(type(plugin), '_read_config_data',
+                              wraps=plugin._read_config_data) as read_config:
+                plugin.parse(inventory, self.loader, config_file)
+            plugin.update_cache_if_changed()
+            return self._get_inventory_as_dict(inventory), read_config.called
+
+        with patch.dict(os.environ, {'ANSIBLE_INVENTORY_CACHE': 'true',
+                                     'ANSIBLE_INVENTORY_CACHE_PLUGIN': 'jsonfile',
+                                     'ANSIBLE_INVENTORY_CACHE_CONNECTION': cache_dir}):
+            generated_inventory, read_config = parse()
+            self.assertTrue(read_config)
+            self.assertDictEqual(generated_inventory, expected_inventory)
+
+            # An unchanged file is served from the cache
+            generated_inventory, read_config = parse()
+            self.assertFalse(read_config)
+            self.assertDictEqual(generated_inventory, expected_inventory)
+
+            # Touching the file invalidates the cached inventory
+            stat = os.stat(config_file)
+            os.utime(config_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+            generated_inventory, read_config = parse()
+            self.assertTrue(read_config)
+
+            # So does editing it
+            with open(config_file, 'a') as f:
+                f.write('ora_db_name: CACHED\n')
+            generated_inventory, read_config = parse()
+            self.assertTrue(read_config)
+            self.assertEqual(generated_inventory['_meta']['groupvars']['dbasm']['ora_db_name'], 'CACHED')
+
+    def _parse_discovered_config(self, config_data, compute_client):
+        """
+        Parses the given configuration, whose discovery lists the instances
+        of the given client, and returns the inventory.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        config_file = os.path.join(tmpdir, 'gcp_oracle.yml')
+        with open(config_file, 'w') as f:
+            yaml.safe_dump(config_data, f, sort_keys=False)
+        plugin = inventory_loader.get('gcp_oracle_inventory')
+        plugin.compute_client = compute_client
+        inventory = InventoryData()
+        plugin.parse(inventory, self.loader, config_file)
+        if plugin.get_option('cache'):
+            plugin.update_cache_if_changed()
+        return inventory
+
+    def test_discovery_builds_fleet_from_instance_labels(self):
+        """
+        Tests that discovering the hosts of tests/inputs/fleet.yml among
+        thousands of instances yields the same inventory as listing them.
+        """
+        with open(os.path.join(self.testdata_path, 'inputs', 'fleet.yml'), 'r') as f:
+            config_data = yaml.safe_load(f)
+        deployments = config_data['fleet']['deployments']
+        for name in ('hr', 'crm'):
+            for key in ('instance_hostname', 'instance_ip_addr', 'primary_ip_addr'):
+                deployments[name].pop(key, None)
+        del deployments['finance']['cluster_config_json'][0]['nodes']
+        zones = ['us-central1-a', 'us-central1-b', 'us-central1-c', 'us-central1-f']
+        config_data['discovery'] = {'project': 'fake-project', 'zones': zones, 'labels': {'oracle-toolkit': 'managed'}}
+
+        managed = {'oracle-toolkit': 'managed'}
+        instances = make_instances(3000, zones, dict(managed, **{DISCOVERY_DEPLOYMENT_LABEL: 'other'}))
+        instances += make_instances(1000, zones)
+        instances += [
+            make_instance('hr-db', zones[0], '10.0.1.1', dict(managed, **{DISCOVERY_DEPLOYMENT_LABEL: 'hr'})),
+            make_instance('fin-node2', zones[2], '10.0.2.3', dict(managed, **{DISCOVERY_DEPLOYMENT_LABEL: 'finance'}),
+                          {DISCOVERY_VIP_IP_KEY: '10.0.2.4'}),
+            make_instance('fin-node1', zones[1], '10.0.2.1', dict(managed, **{DISCOVERY_DEPLOYMENT_LABEL: 'finance'}),
+                          {DISCOVERY_VIP_IP_KEY: '10.0.2.2'}),
+            make_instance('crm-standby', zones[3], '10.0.3.2', dict(managed, **{DISCOVERY_DEPLOYMENT_LABEL: 'crm'})),
+            make_instance('crm-primary', zones[0], '10.0.3.1',
+                          dict(managed, **{DISCOVERY_DEPLOYMENT_LABEL: 'crm', DISCOVERY_ROLE_LABEL: 'primary'})),
+        ]
+        client = FakeComputeClient(instances, page_size=100, latency=0.01)
+        inventory = self._parse_discovered_config(config_data, client)
+
+        with open(os.path.join(self.testdata_path, 'snapshots', 'fleet.json'), 'r') as f:
+            expected_inventory = json.load(f)
+        self.assertDictEqual(self._get_inventory_as_dict(inventory), expected_inventory)
+        # Each zone holds 751 or 752 managed instances, so 8 pages per zone
+        self.assertEqual(client.pages, 32)
+        self.assertGreater(client.max_concurrency, 1)
+
+    def test_discovery_builds_rac_clusters_from_instance_labels(self):
+        config_data = {
+            'ora_cluster_type': 'RAC',
+            'discovery': {'project': 'fake-project', 'zones': ['us-central1-a'], 'use_public_ip': True},
+            'cluster_config_json': [
+                {'cluster_name': 'rac-a', 'scan_name': 'scan-a'},
+                {'cluster_name': 'rac-b', 'scan_name': 'scan-b', 'nodes': [{'node_name': 'b1', 'host_ip': '10.0.1.1'}]},
+            ],
+        }
+        client = FakeComputeClient([
+            make_instance('a2', 'us-central1-a', '10.0.0.2', {DISCOVERY_CLUSTER_LABEL: 'rac-a'}, public_ip='34.0.0.2'),
+            make_instance('a1', 'us-central1-a', '10.0.0.1', {DISCOVERY_CLUSTER_LABEL: 'rac-a'},
+                          {DISCOVERY_VIP_NAME_KEY: 'a1-virtual', DISCOVERY_VIP_IP_KEY: '34.0.0.11'}, public_ip='34.0.0.1'),
+            make_instance('c1', 'us-central1-a', '10.0.2.1', {DISCOVERY_CLUSTER_LABEL: 'rac-c'}, public_ip='34.0.2.1'),
+        ])
+        inventory = self._parse_discovered_config(config_data, client)
+
+        self.assertEqual([host.name for host in inventory.groups['dbasm_cluster_1'].get_hosts()], ['a1', 'a2'])
+        self.assertEqual([host.name for host in inventory.groups['dbasm_cluster_2'].get_hosts()], ['b1'])
+        self.assertNotIn('c1', inventory.hosts)
+        self.assertEqual(inventory.get_host('a1').vars['ansible_ssh_host'], '34.0.0.1')
+        self.assertEqual(inventory.get_host('a1').vars['vip_name'], 'a1-virtual')
+        self.assertEqual(inventory.get_host('a1').vars['vip_ip'], '34.0.0.11')
+        self.assertEqual(inventory.get_host('a2').vars['vip_name'], 'a2-vip')
+
+    def test_discovery_errors_are_reported_together(self):
+        zones = ['us-central1-a']
+        config_data = {'fleet': {
+            'defaults': {'ora_cluster_type': 'DG'},
+            'deployments': {'hr': {}, 'crm': {}},
+        }, 'discovery': {'project': 'fake-project', 'zones': zones}}
+        client = FakeComputeClient([
+            make_instance('hr-1', zones[0], '10.0.1.1', {DISCOVERY_DEPLOYMENT_LABEL: 'hr'}),
+            make_instance('hr-2', zones[0], '10.0.1.2', {DISCOVERY_DEPLOYMENT_LABEL: 'hr'}),
+            make_instance('crm-1', zones[0], '10.0.3.2', {DISCOVERY_DEPLOYMENT_LABEL: 'crm'}),
+        ])
+        with self.assertRaises(AnsibleParserError) as cm:
+            self._parse_discovered_config(config_data, client)
+        self.assertEqual(str(cm.exception).splitlines(), [
+            "Deployment 'hr': Discovery found 2 database instances, expected one. Set 'instance_hostname' or narrow 'discovery.labels'.",
+            "Deployment 'hr': Discovery found 0 instances labelled oracle-toolkit-role=primary, expected one.",
+            "Deployment 'crm': Discovery found 0 instances labelled oracle-toolkit-role=primary, expected one.",
+        ])
+
+        config_data['discovery'] = {'zones': [], 'cache_ttl': -1}
+        with self.assertRaises(AnsibleParserError) as cm:
+            self._parse_discovered_config(config_data, client)
+        self.assertEqual(str(cm.exception).splitlines(), [
+            "Missing required variable 'project' for discovery.",
+            "'discovery.zones' must be a non-empty list of zones.",
+            "'discovery.cache_ttl' must be an integer of at least 0.",
+        ])
+
+    def test_discovered_instances_are_cached_for_their_ttl(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        zones = ['us-central1-a', 'us-central1-b']
+        config_data = {
+            'instance_hostname': 'db-2',
+            'discovery': {'project': 'fake-project', 'zones': zones, 'cache_ttl': 60},
+        }
+        client = FakeComputeClient([
+            make_instance('db-1', zones[0], '10.0.0.1'),
+            make_instance('db-2', zones[1], '10.0.0.2'),
+        ])
+
+        with patch.dict(os.environ, {'ANSIBLE_INVENTORY_CACHE': 'true',
+                                     'ANSIBLE_INVENTORY_CACHE_PLUGIN': 'jsonfile',
+                                     'ANSIBLE_INVENTORY_CACHE_CONNECTION': cache_dir}):
+            inventory = self._parse_discovered_config(config_data, client)
+            self.assertEqual(inventory.get_host('db-2').vars['ansible_ssh_host'], '10.0.0.2')
+            self.assertEqual(client.pages, 2)
+
+            # Fresh instances are served from the cache, even for an edited configuration
+            config_data['ora_db_name'] = 'EDITED'
+            inventory = self._parse_discovered_config(config_data, client)
+            self.assertEqual(inventory.groups[DEFAULT_HOSTGROUP_NAME].vars['ora_db_name'], 'EDITED')
+            self.assertEqual(client.pages, 2)
+
+            # Once the TTL has passed, the instances are listed again
+            with patch('time.time', return_value=time.time() + 61):
+                inventory = self._parse_discovered_config(config_data, client)
+            self.assertEqual(inventory.get_host('db-2').vars['ansible_ssh_host'], '10.0.0.2')
+            self.assertEqual(client.pages, 4)
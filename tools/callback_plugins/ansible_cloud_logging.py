@@ -2,17 +2,27 @@
 
 from __future__ import annotations  # required for annotations in TypeDicts
 
+import array
 import atexit
+import bisect
+import collections
 import datetime
 import getpass
 import os
 import queue
 import json
+import math
+import random
 import sys
+import tempfile
 import threading
-from typing import Any, Dict, Optional, TypedDict
+import time
+from typing import Any, Dict, Iterator, Optional, TYPE_CHECKING, TypedDict
 import uuid
 
+if TYPE_CHECKING:
+  import sqlite3
+
 import ansible
 from ansible import context
 
@@ -24,24 +34,81 @@ from ansible import context
 # See more details here: https://docs.ansible.com/ansible/latest/dev_guide/developing_module_utilities.html#using-and-developing-module-utilities.
 from ansible.module_utils.parsing import convert_bool
 from ansible.plugins import callback
-from ansible_collections.google.cloud.plugins.module_utils.gcp_utils import GcpSession
 
 
 MAX_RESULT_SIZE = 256 * 1024  # 256 KB
+MAX_ERROR_MESSAGE_SIZE = 8 * 1024  # 8 KB
+# entries:write rejects requests larger than 10 MB, keep a safety margin for
+# the request envelope.
+MAX_BATCH_BYTES = 9 * 1024 * 1024  # 9 MB
+LOGGING_WRITE_URL = "https://logging.googleapis.com/v2/entries:write"
+# Responses to entries:write that are worth retrying, everything else is
+# reported and dropped right away.
+RETRYABLE_STATUS_CODES = frozenset({408, 429, 500, 502, 503, 504})
+LOGGING_WRITE_SCOPE = "https://www.googleapis.com/auth/logging.write"
+# Access tokens are refreshed this long before they expire, so that a token
+# does not expire while a request is retried.
+TOKEN_REFRESH_MARGIN_SECONDS = 300
+# Outcomes of a write request: the entries were accepted, permanently rejected
+# (a status outside RETRYABLE_STATUS_CODES), or not delivered because of a
+# transient or transport error that outlasted the retries.
+WRITE_OK = "ok"
+WRITE_REJECTED = "rejected"
+WRITE_FAILED = "failed"
 
 DOCUMENTATION = """
   name: ansible_cloud_logging
   type: aggregate
   options:
     project:
-      description: The Google Cloud project ID where logs will be sent.
-      required: true
+      description: The Google Cloud project ID where logs will be sent. If
+        unset, the plugin disables itself and does not log anything, unless
+        another sink is selected.
       type: str
       env:
         - name: ANSIBLE_CLOUD_LOGGING_PROJECT
       ini:
         - section: cloud_logging
           key: project
+    sink:
+      description: Where log entries are written to. C(cloud_logging) sends
+        them to Cloud Logging. C(http) posts the same requests to sink_url,
+        e.g. a local collector. C(file) appends them as JSON lines to
+        sink_path, and C(stdout) prints them.
+      type: str
+      default: cloud_logging
+      choices: [cloud_logging, http, file, stdout]
+      env:
+        - name: ANSIBLE_CLOUD_LOGGING_SINK
+      ini:
+        - section: cloud_logging
+          key: sink
+    sink_url:
+      description: URL the http sink posts entries:write requests to.
+      type: str
+      env:
+        - name: ANSIBLE_CLOUD_LOGGING_SINK_URL
+      ini:
+        - section: cloud_logging
+          key: sink_url
+    sink_path:
+      description: JSONL file the file sink appends log entries to.
+      type: path
+      env:
+        - name: ANSIBLE_CLOUD_LOGGING_SINK_PATH
+      ini:
+        - section: cloud_logging
+          key: sink_path
+    token_cache_file:
+      description: If set, the access token for Cloud Logging is cached in
+        this file, so that consecutive playbooks, e.g. of one install-oracle.sh
+        run, share it instead of fetching a new one each.
+      type: path
+      env:
+        - name: ANSIBLE_CLOUD_LOGGING_TOKEN_CACHE
+      ini:
+        - section: cloud_logging
+          key: token_cache_file
     log_name:
       description: LOG_ID of the log entry name.
       type: str
@@ -80,9 +147,488 @@ DOCUMENTATION = """
       ini:
         - section: cloud_logging
           key: enable_async_logging
+    enable_batching:
+      description: If True, the background thread groups queued log messages
+        into a single entries:write request. A batch is flushed when it reaches
+        batch_max_entries, batch_max_bytes or batch_linger_seconds, whichever
+        comes first. Only used when enable_async_logging is True.
+      type: bool
+      default: True
+      env:
+        - name: ANSIBLE_CLOUD_LOGGING_ENABLE_BATCHING
+      ini:
+        - section: cloud_logging
+          key: enable_batching
+    batch_max_entries:
+      description: Maximum number of log entries sent in a single entries:write request.
+      type: int
+      default: 500
+      env:
+        - name: ANSIBLE_CLOUD_LOGGING_BATCH_MAX_ENTRIES
+      ini:
+        - section: cloud_logging
+          key: batch_max_entries
+    batch_max_bytes:
+      description: Maximum size in bytes of the serialized entries of a single
+        entries:write request. Values above the Cloud Logging request limit
+        are capped to 9 MB.
+      type: int
+      default: 5242880
+      env:
+        - name: ANSIBLE_CLOUD_LOGGING_BATCH_MAX_BYTES
+      ini:
+        - section: cloud_logging
+          key: batch_max_bytes
+    batch_linger_seconds:
+      description: Maximum time in seconds the background thread waits for
+        more log messages before flushing a partially filled batch.
+      type: float
+      default: 1.0
+      env:
+        - name: ANSIBLE_CLOUD_LOGGING_BATCH_LINGER_SECONDS
+      ini:
+        - section: cloud_logging
+          key: batch_linger_seconds
+    queue_max_entries:
+      description: Maximum number of log messages held in memory by the async
+        queue before queue_overflow_policy applies.
+      type: int
+      default: 10000
+      env:
+        - name: ANSIBLE_CLOUD_LOGGING_QUEUE_MAX_ENTRIES
+      ini:
+        - section: cloud_logging
+          key: queue_max_entries
+    queue_max_bytes:
+      description: Maximum size in bytes of the serialized log messages held in
+        memory by the async queue before queue_overflow_policy applies.
+      type: int
+      default: 67108864
+      env:
+        - name: ANSIBLE_CLOUD_LOGGING_QUEUE_MAX_BYTES
+      ini:
+        - section: cloud_logging
+          key: queue_max_bytes
+    queue_overflow_policy:
+      description: What to do with a log message when the async queue is full.
+        C(block) waits until the background thread has made room,
+        C(drop_task_start) drops the oldest task start messages first and
+        C(spill) writes messages to a temporary file in spill_dir until the
+        queue has been drained. Dropped and spilled messages are counted in
+        the logging_stats of the PLAYBOOK_END message.
+      type: str
+      default: block
+      choices: ['block', 'drop_task_start', 'spill']
+      env:
+        - name: ANSIBLE_CLOUD_LOGGING_QUEUE_OVERFLOW_POLICY
+      ini:
+        - section: cloud_logging
+          key: queue_overflow_policy
+    spill_dir:
+      description: Directory for the spill file of the C(spill) overflow
+        policy. Defaults to the system temporary directory.
+      type: path
+      env:
+        - name: ANSIBLE_CLOUD_LOGGING_SPILL_DIR
+      ini:
+        - section: cloud_logging
+          key: spill_dir
+    sender_workers:
+      description: Number of background threads sending log messages when
+        async logging is enabled. Messages are distributed by host, so the
+        messages of a host are still sent in order, and the PLAYBOOK_START and
+        PLAYBOOK_END messages are sent before and after all other messages.
+      type: int
+      default: 4
+      env:
+        - name: ANSIBLE_CLOUD_LOGGING_SENDER_WORKERS
+      ini:
+        - section: cloud_logging
+          key: sender_workers
+    retry_max_attempts:
+      description: Maximum number of attempts for an entries:write request that
+        fails with a transient error (HTTP 408, 429, 5xx or a connection
+        error). Other errors are not retried.
+      type: int
+      default: 8
+      env:
+        - name: ANSIBLE_CLOUD_LOGGING_RETRY_MAX_ATTEMPTS
+      ini:
+        - section: cloud_logging
+          key: retry_max_attempts
+    retry_initial_backoff_seconds:
+      description: Upper bound of the randomized delay before the first retry.
+        The bound doubles with every retry up to retry_max_backoff_seconds. A
+        Retry-After header sent by the API takes precedence.
+      type: float
+      default: 0.5
+      env:
+        - name: ANSIBLE_CLOUD_LOGGING_RETRY_INITIAL_BACKOFF_SECONDS
+      ini:
+        - section: cloud_logging
+          key: retry_initial_backoff_seconds
+    retry_max_backoff_seconds:
+      description: Maximum delay between two attempts of an entries:write request.
+      type: float
+      default: 30.0
+      env:
+        - name: ANSIBLE_CLOUD_LOGGING_RETRY_MAX_BACKOFF_SECONDS
+      ini:
+        - section: cloud_logging
+          key: retry_max_backoff_seconds
+    request_timeout_seconds:
+      description: Timeout of a single attempt of an entries:write request,
+        e.g. on a hung connection.
+      type: float
+      default: 30.0
+      env:
+        - name: ANSIBLE_CLOUD_LOGGING_REQUEST_TIMEOUT_SECONDS
+      ini:
+        - section: cloud_logging
+          key: request_timeout_seconds
+    drain_timeout_seconds:
+      description: Maximum time spent at the end of the playbook on sending
+        the log messages still queued and the playbook end message. Messages
+        that are unsent by then are kept in the journal if journal_dir is
+        set, and written to an overflow file in overflow_dir otherwise. 0
+        waits until all messages have been sent or have failed.
+      type: float
+      default: 120.0
+      env:
+        - name: ANSIBLE_CLOUD_LOGGING_DRAIN_TIMEOUT_SECONDS
+      ini:
+        - section: cloud_logging
+          key: drain_timeout_seconds
+    overflow_dir:
+      description: Directory for the overflow files of log messages that
+        could not be sent within drain_timeout_seconds. Defaults to the
+        system temporary directory.
+      type: path
+      env:
+        - name: ANSIBLE_CLOUD_LOGGING_OVERFLOW_DIR
+      ini:
+        - section: cloud_logging
+          key: overflow_dir
+    retry_deadline_seconds:
+      description: Maximum time spent on an entries:write request including
+        all retries. When it has passed, the log messages of the request are
+        reported as failed. Each attempt times out after
+        request_timeout_seconds or when the deadline is reached, and a
+        request is given up if write_requests_per_minute would delay it past
+        the deadline. This also bounds how long Ansible waits
+        for a log message when async logging is disabled.
+      type: float
+      default: 60.0
+      env:
+        - name: ANSIBLE_CLOUD_LOGGING_RETRY_DEADLINE_SECONDS
+      ini:
+        - section: cloud_logging
+          key: retry_deadline_seconds
+    write_requests_per_minute:
+      description: Client-side limit of entries:write requests per minute,
+        shared by all sender workers. Set it to the share of the project's
+        Cloud Logging write quota available to Ansible. 0 disables the limit.
+      type: int
+      default: 0
+      env:
+        - name: ANSIBLE_CLOUD_LOGGING_WRITE_REQUESTS_PER_MINUTE
+      ini:
+        - section: cloud_logging
+          key: write_requests_per_minute
+    journal_dir:
+      description: Directory of the local journal. If set, every log message
+        is appended to a journal before it is sent and marked as sent once
+        Cloud Logging has accepted it, so that messages lost to a crash of
+        the controller or to ignored API errors can be uploaded later. The
+        journal is disabled if unset.
+      type: path
+      env:
+        - name: ANSIBLE_CLOUD_LOGGING_JOURNAL_DIR
+      ini:
+        - section: cloud_logging
+          key: journal_dir
+    journal_segment_max_bytes:
+      description: Size in bytes after which the journal starts a new segment
+        file. Segments are deleted once all their messages have been sent.
+      type: int
+      default: 16777216
+      env:
+        - name: ANSIBLE_CLOUD_LOGGING_JOURNAL_SEGMENT_MAX_BYTES
+      ini:
+        - section: cloud_logging
+          key: journal_segment_max_bytes
+    journal_fsync_interval_seconds:
+      description: Minimum time in seconds between two fsync calls on the
+        journal. Messages written since the last fsync can be lost if the
+        controller host crashes. 0 syncs every message.
+      type: float
+      default: 1.0
+      env:
+        - name: ANSIBLE_CLOUD_LOGGING_JOURNAL_FSYNC_INTERVAL_SECONDS
+      ini:
+        - section: cloud_logging
+          key: journal_fsync_interval_seconds
+    journal_replay:
+      description: If True, unsent messages found in the journals of earlier
+        playbook executions are uploaded by a background thread when the
+        playbook starts.
+      type: bool
+      default: True
+      env:
+        - name: ANSIBLE_CLOUD_LOGGING_JOURNAL_REPLAY
+      ini:
+        - section: cloud_logging
+          key: journal_replay
+    profile_top_n:
+      description: Number of slowest tasks listed in the profile section of the
+        playbook end message. Set to 0 to leave out the profile.
+      type: int
+      default: 20
+      env:
+        - name: ANSIBLE_CLOUD_LOGGING_PROFILE_TOP_N
+      ini:
+        - section: cloud_logging
+          key: profile_top_n
+    history_db:
+      description: If set, task durations of every playbook execution are
+        stored in this SQLite database and compared with earlier executions
+        of the same playbook and deployment. Slowdowns are reported at the end
+        of the playbook and in the playbook end message.
+      type: path
+      env:
+        - name: ANSIBLE_CLOUD_LOGGING_HISTORY_DB
+      ini:
+        - section: cloud_logging
+          key: history_db
+    history_baseline_runs:
+      description: Number of earlier executions the task durations are
+        compared with.
+      type: int
+      default: 10
+      env:
+        - name: ANSIBLE_CLOUD_LOGGING_HISTORY_BASELINE_RUNS
+      ini:
+        - section: cloud_logging
+          key: history_baseline_runs
+    history_slowdown_threshold:
+      description: Minimum slowdown of a task relative to the mean of its
+        baseline that is reported, e.g. 0.2 for 20% slower.
+      type: float
+      default: 0.2
+      env:
+        - name: ANSIBLE_CLOUD_LOGGING_HISTORY_SLOWDOWN_THRESHOLD
+      ini:
+        - section: cloud_logging
+          key: history_slowdown_threshold
+    profile_dir:
+      description: If set, the profile of each playbook execution is also
+        written to a JSON file named after the playbook and the execution ID in
+        this directory.
+      type: path
+      env:
+        - name: ANSIBLE_CLOUD_LOGGING_PROFILE_DIR
+      ini:
+        - section: cloud_logging
+          key: profile_dir
+    trace_file:
+      description: If set, the playbook execution is also exported as
+        OpenTelemetry trace spans, nested playbook, play, task and host, and
+        appended to this file in the OTLP/JSON format, one line per play.
+      type: path
+      env:
+        - name: ANSIBLE_CLOUD_LOGGING_TRACE_FILE
+      ini:
+        - section: cloud_logging
+          key: trace_file
+    trace_url:
+      description: If set, the trace spans are sent to this OTLP/HTTP traces
+        endpoint of a local collector, e.g. http://127.0.0.1:4318/v1/traces.
+      type: str
+      env:
+        - name: ANSIBLE_CLOUD_LOGGING_TRACE_URL
+      ini:
+        - section: cloud_logging
+          key: trace_url
+    metrics_file:
+      description: If set, metrics of the logging pipeline, e.g. queue depth,
+        send latency, bytes sent, errors and retries, are written to this file
+        in the Prometheus text format while the playbook runs, for the
+        textfile collector of the node exporter.
+      type: path
+      env:
+        - name: ANSIBLE_CLOUD_LOGGING_METRICS_FILE
+      ini:
+        - section: cloud_logging
+          key: metrics_file
+    metrics_interval_seconds:
+      description: Time between two updates of the metrics_file.
+      type: float
+      default: 15.0
+      env:
+        - name: ANSIBLE_CLOUD_LOGGING_METRICS_INTERVAL_SECONDS
+      ini:
+        - section: cloud_logging
+          key: metrics_interval_seconds
+    metrics_port:
+      description: If not 0, the metrics of the logging pipeline are served on
+        http://127.0.0.1:<metrics_port>/metrics while the playbook runs.
+      type: int
+      default: 0
+      env:
+        - name: ANSIBLE_CLOUD_LOGGING_METRICS_PORT
+      ini:
+        - section: cloud_logging
+          key: metrics_port
 """
 
 
+class _RawJSON(str):
+  """A string holding serialized JSON that _encode_entry() embeds as is."""
+
+
+# Compact separators keep entries small, the default ", " and ": " add two
+# bytes per item.
+_json_encode = json.JSONEncoder(separators=(",", ":"), default=str).encode
+# Replaced by the serialized result in the LogEntry JSON, so that results
+# serialized by _serialize_result() are not serialized a second time.
+_RAW_JSON_PLACEHOLDER = f"ansible_cloud_logging_raw_json_{uuid.uuid4().hex}"
+
+
+def _min_json_size(obj: Any, limit: int) -> int:
+  """Returns a lower bound of the size of obj serialized as JSON.
+
+  Only string lengths and container sizes are added up, nothing is
+  serialized. Counting stops as soon as the bound exceeds limit.
+
+  Args:
+    obj: A JSON serializable object.
+    limit: Size after which counting stops.
+
+  Returns:
+    A lower bound of the serialized size, or a value larger than limit.
+  """
+  size = 0
+  stack = [obj]
+  while stack and size <= limit:
+    o = stack.pop()
+    if isinstance(o, str):
+      size += len(o) + 2
+    elif isinstance(o, dict):
+      size += 1 + 2 * len(o)
+      stack.extend(o.keys())
+      stack.extend(o.values())
+    elif isinstance(o, (list, tuple)):
+      size += 1 + len(o)
+      stack.extend(o)
+    else:
+      size += 1
+  return size
+
+
+def _tail(text: str, max_chars: int) -> str:
+  """Returns the end of text, marking that the beginning has been cut off."""
+  if len(text) <= max_chars:
+    return text
+  kept = max(0, max_chars - 64)
+  return f"[... {len(text) - kept} characters truncated ...]\n" + text[len(text) - kept:]
+
+
+def _serialize_result(result: dict[str, Any], budget: int = MAX_RESULT_SIZE) -> _RawJSON:
+  """Serializes a task result as JSON of at most budget bytes.
+
+  The values are serialized one by one and serialization stops as soon as
+  the budget is exceeded, so a large result is never serialized in full.
+  An oversized result is replaced by a truncated one that keeps the fields
+  needed to debug a failure: the small status fields such as rc and msg,
+  and the tails of stderr and stdout, where tools like OPatch, DBCA or
+  cluvfy print their errors.
+
+  Args:
+    result: The task result.
+    budget: Maximum size of the serialized result in bytes.
+
+  Returns:
+    The serialized result.
+  """
+  parts = {}
+  size = 1
+  for key, value in result.items():
+    remaining = budget - size
+    if _min_json_size(value, remaining) > remaining:
+      break
+    part = _json_encode(str(key)) + ":" + _json_encode(value)
+    size += len(part) + 1
+    if size > budget:
+      break
+    parts[key] = part
+  else:
+    return _RawJSON("{" + ",".join(parts.values()) + "}")
+  return _truncate_result(result, parts, budget)
+
+
+# Kept in a truncated result if they fit, in this order.
+_RESULT_STATUS_KEYS = (
+    "rc", "failed", "changed", "skipped", "unreachable", "msg", "cmd",
+    "start", "end", "delta",
+)
+# Long text fields of which a truncated result keeps the end, in this order.
+_RESULT_TAIL_KEYS = ("stderr", "module_stderr", "exception", "stdout", "module_stdout")
+
+
+def _truncate_result(
+    result: dict[str, Any], parts: dict[str, str], budget: int
+) -> _RawJSON:
+  """Builds the serialized, truncated version of an oversized result.
+
+  Args:
+    result: The task result.
+    parts: Already serialized "key":value pairs of result.
+    budget: Maximum size of the serialized result in bytes.
+
+  Returns:
+    The serialized, truncated result.
+  """
+  omitted = [
+      str(k) for k in result
+      if k not in _RESULT_STATUS_KEYS and k not in _RESULT_TAIL_KEYS
+  ]
+  kept = [
+      _json_encode("warning") + ":" + _json_encode(
+          f"Result truncated because it exceeded {budget} bytes"
+      ),
+      _json_encode("omitted_keys") + ":" + _json_encode(omitted),
+  ]
+  size = 1 + sum(len(p) + 1 for p in kept)
+  for key in _RESULT_STATUS_KEYS:
+    if key not in result:
+      continue
+    part = parts.get(key)
+    if part is None:
+      value = result[key]
+      if isinstance(value, str):
+        value = _tail(value, (budget - size) // 8)
+      part = _json_encode(key) + ":" + _json_encode(value)
+    if size + len(part) + 1 <= budget:
+      kept.append(part)
+      size += len(part) + 1
+  tails = [k for k in _RESULT_TAIL_KEYS if isinstance(result.get(k), str)]
+  for i, key in enumerate(tails):
+    # Split what is left between the remaining fields, earlier ones first.
+    share = (budget - size) // (len(tails) - i)
+    text = result[key]
+    max_chars = share - len(key) - 8
+    while max_chars > 0:
+      part = _json_encode(key) + ":" + _json_encode(_tail(text, max_chars))
+      if len(part) + 1 <= share:
+        kept.append(part)
+        size += len(part) + 1
+        break
+      # Escaped characters take more than one byte, try a shorter tail.
+      max_chars = max_chars * share // (len(part) + 1) - 1
+  return _RawJSON("{" + ",".join(kept) + "}")
+
+
+
 def _print_uuid(execution_id: str) -> None:
   """Prints the UUID of the logging entry.
 
@@ -128,86 +674,1678 @@ class PlaybookStartMessage(TypedDict):
   base_dir: str
 
 
-class PlaybookTaskStartMessage(TypedDict):
-  """Defines the serializable message for a playbook task start event.
+class PlaybookTaskStartMessage(TypedDict):
+  """Defines the serializable message for a playbook task start event.
+
+  params:
+    id: Unique ID of the playbook execution.
+    event_type: Type of the event.
+    task_id: Unique ID of the task.
+    name: Name of the task.
+    host: Hostname of the host where the task is executed.
+    start_time: Timestamp when the task execution started.
+    end_time: Timestamp when the task execution ended.
+    status: Status of the task (OK, FAILED, SKIPPED, etc.)
+    result: Dictionary containing the execution result.
+  """
+  id: str
+  event_type: str
+  task_id: str
+  name: str
+  host: str
+  start_time: str
+  # WLM fields
+  deployment_name: str
+  state: str
+  timestamp: str
+  step_name: str
+
+
+# Not supported by WLM
+class PlaybookTaskEndMessage(TypedDict):
+  """Defines the serializable message for a playbook task event.
+
+  params:
+    id: Unique ID of the playbook execution.
+    event_type: Type of the event.
+    task_id: Unique ID of the task.
+    name: Name of the task.
+    host: Hostname of the host where the task is executed.
+    start_time: Timestamp when the task execution started.
+    end_time: Timestamp when the task execution ended.
+    status: Status of the task (OK, FAILED, SKIPPED, etc.)
+    result: Execution result, already serialized to a JSON object by
+      _serialize_result() and embedded in the log entry as is.
+    error_message: either result.stderr or result.msg depending on what ansible module failed.
+    loop_stats: Loop items and retries of the task aggregated by _LoopStats,
+      empty if the task had neither.
+  """
+
+  id: str
+  event_type: str
+  task_id: str
+  name: str
+  host: str
+  start_time: str
+  end_time: str
+  status: str
+  result: _RawJSON
+  error_message: str
+  loop_stats: dict[str, Any]
+
+
+class PlaybookEndMessage(TypedDict):
+  """Defines the serializable message for a playbook end event.
+
+  params:
+    id: Unique ID of the playbook execution.
+    event_type: Type of the event.
+    user: Username of the user executing the playbook.
+    start_time: Timestamp when the playbook execution started.
+    end_time: Timestamp when the playbook execution ended.
+    stats: Dictionary containing summary statistics.
+    logging_stats: Counters of log messages dropped or spilled by the plugin.
+    logging_metrics: Requests, bytes and send latency percentiles of the
+      plugin, as summarized by PipelineMetrics.
+    profile: Task durations aggregated by TaskProfiler.
+    regressions: Tasks that were significantly slower than in earlier
+      executions, as reported by PerformanceHistory.
+  """
+
+  id: str
+  event_type: str
+  user: str
+  start_time: str
+  end_time: str
+  stats: dict[str, Any]
+  logging_stats: dict[str, int]
+  logging_metrics: dict[str, Any]
+  profile: dict[str, Any]
+  regressions: list[dict[str, Any]]
+  # WLM fields
+  deployment_name: str
+  state: str
+  timestamp: str
+  playbook_stats: dict[str, Any]
+  file_name: str
+
+
+class _TaskRecord:
+  """State kept for a running task between its start and its result.
+
+  Name, role and host strings are interned, so that the records of a task
+  running on many hosts share them.
+
+  Attributes:
+    task_id: Unique ID of the task.
+    name: Name of the task.
+    role: Name of the role the task belongs to, empty for playbook tasks.
+    host: Hostname of the host where the task is executed.
+    start_time: Timestamp when the task execution started.
+    started: time.monotonic() when the task execution started.
+    loop: _LoopStats of the task, None until the first item or retry.
+  """
+
+  __slots__ = (
+      "task_id", "name", "role", "host", "start_time", "started", "loop"
+  )
+
+  def __init__(
+      self,
+      task_id: str,
+      name: str,
+      role: str,
+      host: str,
+      start_time: str,
+      started: float,
+  ):
+    self.task_id = task_id
+    self.name = sys.intern(name)
+    self.role = sys.intern(role)
+    self.host = sys.intern(host)
+    self.start_time = start_time
+    self.started = started
+    self.loop = None
+
+
+class _LoopStats:
+  """Aggregates the loop items and retries of a task on a host.
+
+  Ansible runs the items of a loop one after the other on each host, so the
+  duration of an item is the time since the previous item, or since the
+  start of the task for the first one.
+
+  Attributes:
+    counts: Number of items by status.
+    durations: Duration of each item in seconds.
+    retries: Number of retries of the task or of its items.
+    last: time.monotonic() of the last item result.
+  """
+
+  __slots__ = ("counts", "durations", "retries", "last")
+
+  STATUSES = ("ok", "failed", "skipped")
+
+  def __init__(self, started: float):
+    self.counts = dict.fromkeys(self.STATUSES, 0)
+    self.durations = array.array("d")
+    self.retries = 0
+    self.last = started
+
+  def add_item(self, status: str, now: float) -> None:
+    """Adds the result of an item.
+
+    Args:
+      status: The status of the item (ok, failed or skipped).
+      now: time.monotonic() when the result was received.
+    """
+    self.counts[status] += 1
+    self.durations.append(now - self.last)
+    self.last = now
+
+  def report(self) -> dict[str, Any]:
+    """Returns the aggregates as a JSON serializable dictionary."""
+    report = {"items": len(self.durations), **self.counts}
+    if self.durations:
+      durations = sorted(self.durations)
+      report["item_duration_seconds"] = {
+          "p50": round(_percentile(durations, 50), 3),
+          "p90": round(_percentile(durations, 90), 3),
+          "p99": round(_percentile(durations, 99), 3),
+          "max": round(durations[-1], 3),
+      }
+    report["retries"] = self.retries
+    return report
+
+
+def _percentile(values: list[float], p: float) -> float:
+  """Returns the p-th percentile of sorted values by the nearest-rank method."""
+  return values[max(0, math.ceil(len(values) * p / 100) - 1)]
+
+
+class TaskProfiler:
+  """Aggregates task durations for the profile in the playbook end message.
+
+  Durations are measured with time.monotonic(), so that they are not affected
+  by changes of the system clock. Only aggregates are kept: the slowest tasks
+  in a bounded heap, totals per role and host, and the slowest host of every
+  task.
+
+  With the default linear strategy, a task only ends once it ended on all
+  hosts, so the playbook waits for the slowest host of each task. The sum of
+  these durations is the critical path, and a host's share of it shows how
+  long the playbook was waiting for that host.
+
+  Attributes:
+    top_n: Number of slowest tasks in the report.
+    slowest: Min-heap of the top_n slowest task executions.
+    roles: Count and total duration per role.
+    hosts: Count and total duration per host.
+    critical: Duration, host and name of the slowest execution per task ID.
+  """
+
+  NO_ROLE = "(playbook)"
+
+  def __init__(self, top_n: int = 20):
+    self.top_n = top_n
+    self.slowest = []
+    self.roles = {}
+    self.hosts = {}
+    self.critical = {}
+    self._seq = 0
+
+  def add(self, record: _TaskRecord, status: str, duration: float) -> None:
+    """Adds the execution of a task on a host.
+
+    Args:
+      record: The _TaskRecord of the task execution.
+      status: The status of the task (ok, failed, skipped, etc.)
+      duration: Duration of the task execution in seconds.
+    """
+    role = record.role or self.NO_ROLE
+    for totals, key in ((self.roles, role), (self.hosts, record.host)):
+      t = totals.get(key)
+      if t is None:
+        totals[key] = [1, duration]
+      else:
+        t[0] += 1
+        t[1] += duration
+    slowest = self.critical.get(record.task_id)
+    if slowest is None or duration > slowest[0]:
+      self.critical[record.task_id] = (duration, record.host, record.name)
+    if self.top_n > 0:
+      # The sequence number breaks ties, tuples of equal durations would
+      # otherwise compare the names.
+      self._seq += 1
+      item = (duration, self._seq, record.name, role, record.host, status)
+      import heapq
+
+      if len(self.slowest) < self.top_n:
+        heapq.heappush(self.slowest, item)
+      elif duration > self.slowest[0][0]:
+        heapq.heapreplace(self.slowest, item)
+
+  def task_durations(self) -> dict[str, float]:
+    """Returns the time the playbook waited for each task, by task name.
+
+    This is the duration of the slowest host of each task. Tasks with the
+    same name, e.g. of a role included several times, are added up.
+    """
+    durations = {}
+    for duration, _, name in self.critical.values():
+      durations[name] = durations.get(name, 0.0) + duration
+    return durations
+
+  def report(self) -> dict[str, Any]:
+    """Returns the profile as a JSON serializable dictionary."""
+    critical_hosts = {}
+    critical_path = 0.0
+    for duration, host, _ in self.critical.values():
+      critical_path += duration
+      c = critical_hosts.setdefault(host, [0, 0.0])
+      c[0] += 1
+      c[1] += duration
+    hosts = {}
+    for host, (count, total) in sorted(self.hosts.items()):
+      tasks, seconds = critical_hosts.get(host, (0, 0.0))
+      hosts[host] = {
+          "tasks": count,
+          "total_seconds": round(total, 3),
+          "critical_path_tasks": tasks,
+          "critical_path_seconds": round(seconds, 3),
+      }
+    return {
+        "critical_path_seconds": round(critical_path, 3),
+        "slowest_tasks": [
+            {
+                "name": name,
+                "role": role,
+                "host": host,
+                "status": status,
+                "duration_seconds": round(duration, 3),
+            }
+            for duration, _, name, role, host, status in sorted(
+                self.slowest, reverse=True
+            )
+        ],
+        "roles": {
+            role: {"tasks": count, "total_seconds": round(total, 3)}
+            for role, (count, total) in sorted(
+                self.roles.items(), key=lambda r: -r[1][1]
+            )
+        },
+        "hosts": hosts,
+    }
+
+
+class PerformanceHistory:
+  """Stores task durations across playbook executions in SQLite.
+
+  Durations are keyed by deployment name, playbook file name and task name.
+  The durations of a new execution are compared with the last baseline_runs
+  executions of the same playbook and deployment before they are stored. A
+  task is reported as a regression if it is slower than the mean of its
+  baseline by more than the threshold, and by more than HISTORY_Z_SCORE
+  standard deviations, so that tasks with noisy durations are not reported
+  for every slow run.
+
+  Only the last HISTORY_MAX_RUNS executions of each playbook and deployment
+  are kept.
+
+  Attributes:
+    path: Path of the SQLite database.
+    baseline_runs: Number of earlier executions in the baseline.
+    threshold: Minimum relative slowdown that is reported.
+  """
+
+  HISTORY_MIN_RUNS = 3
+  HISTORY_MAX_RUNS = 100
+  HISTORY_MIN_SECONDS = 1.0
+  HISTORY_Z_SCORE = 3.0
+  # Durations of the whole playbook are stored under this task name.
+  PLAYBOOK_TASK = "(playbook)"
+
+  _SCHEMA = """
+      CREATE TABLE IF NOT EXISTS runs (
+          execution_id TEXT PRIMARY KEY,
+          deployment_name TEXT NOT NULL,
+          file_name TEXT NOT NULL,
+          end_time TEXT NOT NULL
+      );
+      CREATE INDEX IF NOT EXISTS runs_playbook
+          ON runs (deployment_name, file_name);
+      CREATE TABLE IF NOT EXISTS task_durations (
+          execution_id TEXT NOT NULL
+              REFERENCES runs (execution_id) ON DELETE CASCADE,
+          task_name TEXT NOT NULL,
+          duration_seconds REAL NOT NULL
+      );
+      CREATE INDEX IF NOT EXISTS task_durations_execution
+          ON task_durations (execution_id);
+  """
+
+  def __init__(self, path: str, baseline_runs: int = 10, threshold: float = 0.2):
+    self.path = path
+    self.baseline_runs = baseline_runs
+    self.threshold = threshold
+
+  def _connect(self) -> sqlite3.Connection:
+    # sqlite3 and statistics are only imported when history_db is set, they
+    # add noticeably to the startup of every playbook otherwise.
+    import sqlite3
+
+    os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+    # Playbooks of parallel deployments may share the database, the timeout
+    # makes them wait for each other's transactions.
+    conn = sqlite3.connect(self.path, timeout=30)
+    conn.execute("PRAGMA foreign_keys = ON")
+    conn.executescript(self._SCHEMA)
+    return conn
+
+  def baseline(
+      self, conn: sqlite3.Connection, deployment_name: str, file_name: str
+  ) -> dict[str, list[float]]:
+    """Returns the durations of the last executions, by task name."""
+    rows = conn.execute(
+        """
+        SELECT t.task_name, t.duration_seconds
+        FROM task_durations t
+        JOIN (SELECT execution_id FROM runs
+              WHERE deployment_name = ? AND file_name = ?
+              ORDER BY rowid DESC LIMIT ?) r
+        USING (execution_id)
+        """,
+        (deployment_name, file_name, self.baseline_runs),
+    )
+    baseline = {}
+    for name, duration in rows:
+      baseline.setdefault(name, []).append(duration)
+    return baseline
+
+  def compare(
+      self, durations: dict[str, float], baseline: dict[str, list[float]]
+  ) -> list[dict[str, Any]]:
+    """Returns the tasks that are significantly slower than their baseline.
+
+    Args:
+      durations: Durations of the current execution, by task name.
+      baseline: Durations of earlier executions, by task name.
+
+    Returns:
+      A list of regressions, the largest slowdown in seconds first.
+    """
+    regressions = []
+    for name, duration in durations.items():
+      history = baseline.get(name, ())
+      if len(history) < self.HISTORY_MIN_RUNS or duration < self.HISTORY_MIN_SECONDS:
+        continue
+      import statistics
+
+      mean = statistics.fmean(history)
+      stdev = statistics.stdev(history)
+      if duration <= mean * (1 + self.threshold):
+        continue
+      if stdev > 0 and (duration - mean) / stdev < self.HISTORY_Z_SCORE:
+        continue
+      regressions.append({
+          "task": name,
+          "duration_seconds": round(duration, 3),
+          "baseline_mean_seconds": round(mean, 3),
+          "baseline_stdev_seconds": round(stdev, 3),
+          "baseline_runs": len(history),
+          "slowdown": round(duration / mean - 1, 3) if mean else None,
+      })
+    regressions.sort(
+        key=lambda r: r["baseline_mean_seconds"] - r["duration_seconds"]
+    )
+    return regressions
+
+  def record(
+      self,
+      deployment_name: str,
+      file_name: str,
+      execution_id: str,
+      end_time: str,
+      durations: dict[str, float],
+  ) -> list[dict[str, Any]]:
+    """Compares the durations of an execution with its baseline and stores them.
+
+    Args:
+      deployment_name: Name of the deployment the playbook ran for.
+      file_name: File name of the playbook.
+      execution_id: Unique ID of the playbook execution.
+      end_time: Timestamp when the playbook execution ended.
+      durations: Durations of the execution, by task name.
+
+    Returns:
+      The regressions found by compare().
+    """
+    conn = self._connect()
+    try:
+      with conn:
+        regressions = self.compare(
+            durations, self.baseline(conn, deployment_name, file_name)
+        )
+        conn.execute(
+            "INSERT INTO runs VALUES (?, ?, ?, ?)",
+            (execution_id, deployment_name, file_name, end_time),
+        )
+        conn.executemany(
+            "INSERT INTO task_durations VALUES (?, ?, ?)",
+            [(execution_id, n, d) for n, d in durations.items()],
+        )
+        conn.execute(
+            """
+            DELETE FROM runs
+            WHERE deployment_name = ? AND file_name = ? AND rowid NOT IN (
+                SELECT rowid FROM runs
+                WHERE deployment_name = ? AND file_name = ?
+                ORDER BY rowid DESC LIMIT ?)
+            """,
+            (deployment_name, file_name) * 2 + (self.HISTORY_MAX_RUNS,),
+        )
+    finally:
+      conn.close()
+    return regressions
+
+
+class TraceExporter:
+  """Exports the playbook execution as OpenTelemetry trace spans.
+
+  Spans are nested playbook > play > task > host: a task span covers the
+  task on all hosts, with one child span per host. The trace ID is the
+  execution ID, so traces can be matched with the log entries.
+
+  Spans are encoded as OTLP/JSON ExportTraceServiceRequest messages, one per
+  play, written when the play ends. A trace file holds one message per line,
+  as read by the otlpjsonfile receiver of the OpenTelemetry Collector; a
+  trace URL receives them as OTLP/HTTP requests, e.g.
+  http://127.0.0.1:4318/v1/traces.
+
+  Attributes:
+    path: File the spans are appended to, or None.
+    url: OTLP/HTTP traces endpoint the spans are posted to, or None.
+    trace_id: Trace ID of the playbook execution as 32 hex digits.
+    span_id: Span ID of the playbook span.
+    resource: OTLP resource describing the controller.
+    timeout: Timeout of the requests to url in seconds.
+  """
+
+  SCOPE_NAME = "ansible_cloud_logging"
+  SPAN_KIND_INTERNAL = 1
+  STATUS_CODE_ERROR = 2
+  ERROR_STATUSES = ("failed", "unreachable")
+
+  def __init__(
+      self,
+      execution_id: str,
+      path: Optional[str] = None,
+      url: Optional[str] = None,
+      resource_attributes: Optional[dict[str, Any]] = None,
+      timeout: float = 5.0,
+  ):
+    self.path = path
+    self.url = url
+    self.timeout = timeout
+    self.trace_id = uuid.UUID(execution_id).hex
+    self.span_id = self._new_span_id()
+    self.resource = {"attributes": _otlp_attributes(resource_attributes or {})}
+    # Spans are timed with time.monotonic() like the rest of the plugin, the
+    # offset converts them to nanoseconds since the epoch.
+    self._offset_ns = time.time_ns() - time.monotonic_ns()
+    self._spans = []
+    # The running play as (span_id, name, started), None outside of plays.
+    self._play = None
+    # Task spans of the running play by task ID, as
+    # [span_id, name, role, started, ended, hosts, failed_hosts].
+    self._tasks = {}
+
+  @staticmethod
+  def _new_span_id() -> str:
+    return f"{random.getrandbits(64) or 1:016x}"
+
+  def _nanos(self, monotonic: float) -> str:
+    return str(self._offset_ns + int(monotonic * 1e9))
+
+  def _add_span(
+      self,
+      span_id: str,
+      parent_span_id: str,
+      name: str,
+      started: float,
+      ended: float,
+      attributes: dict[str, Any],
+      error: Optional[str] = None,
+  ) -> None:
+    span = {
+        "traceId": self.trace_id,
+        "spanId": span_id,
+        "parentSpanId": parent_span_id,
+        "name": name,
+        "kind": self.SPAN_KIND_INTERNAL,
+        "startTimeUnixNano": self._nanos(started),
+        "endTimeUnixNano": self._nanos(ended),
+        "attributes": _otlp_attributes(attributes),
+    }
+    if error is not None:
+      span["status"] = {"code": self.STATUS_CODE_ERROR, "message": error}
+    self._spans.append(span)
+
+  def start_play(self, name: str, started: float) -> None:
+    """Ends the running play, if any, and starts a new one.
+
+    Args:
+      name: Name of the play.
+      started: time.monotonic() when the play started.
+    """
+    self._end_play(started)
+    self._flush()
+    self._play = (self._new_span_id(), name, started)
+
+  def _end_play(self, ended: float) -> None:
+    """Ends the spans of the running play and its tasks."""
+    parent = self._play[0] if self._play else self.span_id
+    for span_id, name, role, started, task_ended, hosts, failed in self._tasks.values():
+      self._add_span(
+          span_id,
+          parent,
+          name,
+          started,
+          task_ended,
+          {"ansible.role": role, "ansible.hosts": hosts, "ansible.failed_hosts": failed},
+          f"failed on {failed} of {hosts} hosts" if failed else None,
+      )
+    self._tasks = {}
+    if self._play is not None:
+      span_id, name, started = self._play
+      self._add_span(span_id, self.span_id, name, started, ended, {})
+      self._play = None
+
+  def add_host(
+      self, record: _TaskRecord, status: str, ended: float, error: str = ""
+  ) -> None:
+    """Adds the span of a task on one host.
+
+    Args:
+      record: The _TaskRecord of the task on the host.
+      status: The status of the task (ok, failed, skipped or unreachable).
+      ended: time.monotonic() when the result was received.
+      error: Error message of a failed task.
+    """
+    task = self._tasks.get(record.task_id)
+    if task is None:
+      task = [self._new_span_id(), record.name, record.role, record.started, ended, 0, 0]
+      self._tasks[record.task_id] = task
+    else:
+      task[3] = min(task[3], record.started)
+      task[4] = max(task[4], ended)
+    task[5] += 1
+    failed = status in self.ERROR_STATUSES
+    if failed:
+      task[6] += 1
+    self._add_span(
+        self._new_span_id(),
+        task[0],
+        record.host,
+        record.started,
+        ended,
+        {"ansible.host": record.host, "ansible.task": record.name, "ansible.status": status},
+        (error or status) if failed else None,
+    )
+
+  def finish(
+      self, name: str, started: float, ended: float, attributes: dict[str, Any]
+  ) -> None:
+    """Ends the running play and exports the playbook span.
+
+    Args:
+      name: Name of the playbook.
+      started: time.monotonic() when the playbook started.
+      ended: time.monotonic() when the playbook ended.
+      attributes: Attributes of the playbook span.
+    """
+    self._end_play(ended)
+    self._add_span(self.span_id, "", name, started, ended, attributes)
+    self._flush()
+
+  def _flush(self) -> None:
+    """Exports the finished spans to the trace file and URL."""
+    if not self._spans:
+      return
+    request = json.dumps({
+        "resourceSpans": [{
+            "resource": self.resource,
+            "scopeSpans": [{
+                "scope": {"name": self.SCOPE_NAME},
+                "spans": self._spans,
+            }],
+        }],
+    }, separators=(",", ":"))
+    self._spans = []
+    if self.path:
+      try:
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path, "a") as f:
+          f.write(request + "\n")
+      except OSError as e:
+        print(f"Failed to write trace spans to {self.path}: {e}")
+    if self.url:
+      import urllib.request
+
+      req = urllib.request.Request(
+          self.url,
+          data=request.encode(),
+          headers={"Content-Type": "application/json"},
+      )
+      try:
+        with urllib.request.urlopen(req, timeout=self.timeout) as resp:
+          resp.read()
+      except OSError as e:
+        print(f"Failed to send trace spans to {self.url}: {e}")
+
+
+def _otlp_attributes(attributes: dict[str, Any]) -> list[dict[str, Any]]:
+  """Returns attributes as OTLP/JSON KeyValue list, leaving out empty strings."""
+  encoded = []
+  for key, value in attributes.items():
+    if isinstance(value, bool):
+      encoded.append({"key": key, "value": {"boolValue": value}})
+    elif isinstance(value, int):
+      encoded.append({"key": key, "value": {"intValue": str(value)}})
+    elif value != "":
+      encoded.append({"key": key, "value": {"stringValue": str(value)}})
+  return encoded
+
+
+class _QueuedEntry:
+  """A serialized log entry waiting to be sent.
+
+  Attributes:
+    event_type: The event_type of the payload, used by the overflow policy.
+    data: The LogEntry as a JSON string, None once dropped from the queue.
+    size: The size of data in bytes.
+    shard: The sender worker responsible for the entry.
+    seq: Position of the entry in the order it was queued.
+    journal_id: The number of the entry in the EventJournal, 0 if the
+      journal is disabled.
+  """
+
+  __slots__ = ("event_type", "data", "size", "shard", "seq", "journal_id")
+
+  def __init__(
+      self, event_type: str, data: str, shard: int = 0, journal_id: int = 0
+  ):
+    self.event_type = event_type
+    self.data = data
+    # json.dumps escapes non-ASCII characters, so characters equal bytes.
+    self.size = len(data)
+    self.shard = shard
+    self.seq = 0
+    self.journal_id = journal_id
+
+  def to_line(self) -> bytes:
+    """Returns the entry as a line of the spill file."""
+    return (
+        f"{self.event_type}\t{self.shard}\t{self.journal_id}\t{self.data}\n"
+    ).encode("utf-8")
+
+  @classmethod
+  def from_line(cls, line: bytes) -> _QueuedEntry:
+    """Restores an entry written by to_line()."""
+    event_type, shard, journal_id, data = (
+        line.decode("utf-8").rstrip("\n").split("\t", 3)
+    )
+    return cls(event_type, data, int(shard), int(journal_id))
+
+
+class BoundedEventQueue:
+  """FIFO queue of serialized log entries with an entry and memory cap.
+
+  The queue is split into shards, one per sender worker. Each shard is
+  consumed in order by its worker, while the entry and memory caps apply to
+  all shards together.
+
+  When an entry does not fit into the queue, the overflow policy decides
+  what happens:
+
+    block: put() waits until the consumers have made enough room.
+    drop_task_start: the oldest PLAYBOOK_TASK_START entries are dropped to
+      make room. If that is not enough, an incoming PLAYBOOK_TASK_START entry
+      is dropped as well, any other entry waits as with "block".
+    spill: the entry is appended to a temporary file in spill_dir. While the
+      spill file holds entries, new entries are spilled too, so that the
+      queue stays in order. The consumers read them back once there is room
+      again.
+
+  An entry larger than max_bytes is accepted when the queue is empty, so
+  that it cannot block the queue forever.
+
+  Instead of a sentinel, close() marks the end of the queue: get() returns
+  None once the queue is closed and the shard is drained.
+
+  Attributes:
+    max_entries: Maximum number of entries held in memory.
+    max_bytes: Maximum size of the entries held in memory.
+    overflow_policy: One of OVERFLOW_POLICIES.
+    spill_dir: Directory for the spill file, defaults to the system temp dir.
+    dropped: Number of entries dropped by the drop_task_start policy.
+    spilled: Number of entries written to the spill file.
+    max_depth: Highest number of entries held in memory at once.
+  """
+
+  OVERFLOW_POLICIES = ("block", "drop_task_start", "spill")
+
+  def __init__(
+      self,
+      max_entries: int,
+      max_bytes: int,
+      overflow_policy: str = "block",
+      spill_dir: Optional[str] = None,
+      shards: int = 1,
+  ):
+    if overflow_policy not in self.OVERFLOW_POLICIES:
+      raise ValueError(
+          f"Invalid queue_overflow_policy '{overflow_policy}', expected one of"
+          f" {', '.join(self.OVERFLOW_POLICIES)}"
+      )
+    self.max_entries = max(1, max_entries)
+    self.max_bytes = max(1, max_bytes)
+    self.overflow_policy = overflow_policy
+    self.spill_dir = spill_dir
+    self.dropped = 0
+    self.spilled = 0
+    self.max_depth = 0
+    self._shards = [collections.deque() for _ in range(max(1, shards))]
+    # The PLAYBOOK_TASK_START entries of each shard, in order. Dropped
+    # entries are removed from here and only marked in their shard, so that
+    # dropping an entry does not have to search the queue.
+    self._task_start_shards = [collections.deque() for _ in self._shards]
+    self._count = 0
+    self._bytes = 0
+    self._task_starts = 0
+    self._seq = 0
+    self._closed = False
+    self._cond = threading.Condition()
+    self._spill_file = None
+    self._spill_read_pos = 0
+    self._spill_write_pos = 0
+    self._spill_pending = 0
+
+  def __len__(self) -> int:
+    with self._cond:
+      return self._count + self._spill_pending
+
+  def depth(self) -> tuple[int, int, int]:
+    """Returns the number and size of the entries in memory and spilled entries."""
+    with self._cond:
+      return self._count, self._bytes, self._spill_pending
+
+  def _fits(self, entry: _QueuedEntry) -> bool:
+    if not self._count:
+      return True
+    return (
+        self._count < self.max_entries
+        and self._bytes + entry.size <= self.max_bytes
+    )
+
+  def _append(self, entry: _QueuedEntry) -> None:
+    self._shards[entry.shard].append(entry)
+    self._count += 1
+    self._bytes += entry.size
+    if self._count > self.max_depth:
+      self.max_depth = self._count
+    if entry.event_type == "PLAYBOOK_TASK_START":
+      self._task_starts += 1
+      self._task_start_shards[entry.shard].append(entry)
+    self._cond.notify_all()
+
+  def _drop_task_starts(self, entry: _QueuedEntry) -> None:
+    """Drops the oldest PLAYBOOK_TASK_START entries until entry fits.
+
+    Each drop only looks at the oldest PLAYBOOK_TASK_START entry of every
+    shard. The dropped entry stays in its shard with its data released, and
+    is skipped by get().
+    """
+    while self._task_starts and (
+        self._count + 1 > self.max_entries
+        or self._bytes + entry.size > self.max_bytes
+    ):
+      oldest = min(
+          (starts for starts in self._task_start_shards if starts),
+          key=lambda starts: starts[0].seq,
+      )
+      victim = oldest.popleft()
+      victim.data = None
+      self._count -= 1
+      self._bytes -= victim.size
+      self._task_starts -= 1
+      self.dropped += 1
+
+  def _spill(self, entry: _QueuedEntry) -> None:
+    if self._spill_file is None:
+      self._spill_file = tempfile.TemporaryFile(
+          prefix="ansible_cloud_logging_", suffix=".spill", dir=self.spill_dir
+      )
+    self._spill_file.seek(self._spill_write_pos)
+    self._spill_file.write(entry.to_line())
+    self._spill_write_pos = self._spill_file.tell()
+    self._spill_pending += 1
+    self.spilled += 1
+
+  def _refill(self) -> None:
+    """Moves spilled entries back into memory while they fit."""
+    self._spill_file.seek(self._spill_read_pos)
+    while self._spill_pending:
+      pos = self._spill_file.tell()
+      entry = _QueuedEntry.from_line(self._spill_file.readline())
+      if not self._fits(entry):
+        self._spill_file.seek(pos)
+        break
+      self._seq += 1
+      entry.seq = self._seq
+      self._append(entry)
+      self._spill_pending -= 1
+    self._spill_read_pos = self._spill_file.tell()
+    if not self._spill_pending:
+      # Reuse the file from the start, so disk usage stays bounded by the
+      # largest backlog instead of growing for the whole run.
+      self._spill_file.seek(0)
+      self._spill_file.truncate()
+      self._spill_read_pos = self._spill_write_pos = 0
+
+  def put(self, entry: _QueuedEntry) -> None:
+    """Adds an entry to its shard, applying the overflow policy if the queue is full.
+
+    Args:
+      entry: The entry to add.
+    """
+    with self._cond:
+      if self._spill_pending or not self._fits(entry):
+        if self.overflow_policy == "spill":
+          self._spill(entry)
+          return
+        if self.overflow_policy == "drop_task_start" and self._task_starts:
+          self._drop_task_starts(entry)
+        if not self._fits(entry):
+          if (
+              self.overflow_policy == "drop_task_start"
+              and entry.event_type == "PLAYBOOK_TASK_START"
+          ):
+            self.dropped += 1
+            return
+          while not self._fits(entry):
+            if self._closed:
+              return
+            self._cond.wait()
+      self._seq += 1
+      entry.seq = self._seq
+      self._append(entry)
+
+  def get(
+      self, shard: int = 0, timeout: Optional[float] = None
+  ) -> Optional[_QueuedEntry]:
+    """Removes and returns the oldest entry of a shard.
+
+    Args:
+      shard: The shard to take the entry from.
+      timeout: Maximum time in seconds to wait for an entry. Waits forever
+        if None.
+
+    Returns:
+      The oldest entry, or None if the queue is closed and the shard drained.
+
+    Raises:
+      queue.Empty: No entry arrived within timeout.
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    entries = self._shards[shard]
+    with self._cond:
+      while True:
+        while entries and entries[0].data is None:
+          entries.popleft()
+        if entries:
+          break
+        if self._spill_pending:
+          self._refill()
+          if entries:
+            continue
+        elif self._closed:
+          return None
+        remaining = None if deadline is None else deadline - time.monotonic()
+        if remaining is not None and remaining <= 0:
+          raise queue.Empty
+        self._cond.wait(remaining)
+      entry = entries.popleft()
+      self._count -= 1
+      self._bytes -= entry.size
+      if entry.event_type == "PLAYBOOK_TASK_START":
+        self._task_starts -= 1
+        self._task_start_shards[shard].popleft()
+      self._cond.notify_all()
+      return entry
+
+  def close(self) -> None:
+    """Marks the end of the queue.
+
+    get() returns None once a shard is drained, and put() calls blocked on a
+    full queue return without adding their entry.
+    """
+    with self._cond:
+      self._closed = True
+      self._cond.notify_all()
+      if self._spill_file is not None and not self._spill_pending:
+        self._spill_file.close()
+        self._spill_file = None
+
+  def take_all(self) -> list[_QueuedEntry]:
+    """Closes the queue and removes all its entries, spilled ones included.
+
+    Returns:
+      The entries of all shards in the order they were put, followed by the
+      spilled entries.
+    """
+    with self._cond:
+      self._closed = True
+      taken = sorted(
+          (e for entries in self._shards for e in entries if e.data is not None),
+          key=lambda e: e.seq,
+      )
+      for entries in self._shards + self._task_start_shards:
+        entries.clear()
+      self._count = self._bytes = self._task_starts = 0
+      if self._spill_file is not None:
+        self._spill_file.seek(self._spill_read_pos)
+        for _ in range(self._spill_pending):
+          taken.append(_QueuedEntry.from_line(self._spill_file.readline()))
+        self._spill_pending = 0
+        self._spill_file.close()
+        self._spill_file = None
+      self._cond.notify_all()
+      return taken
+
+
+class EventJournal:
+  """Append-only on-disk journal of the log entries of one playbook execution.
+
+  The journal is a series of JSONL segments named
+  "<execution_id>.<segment>.jsonl" in directory. Each line is either an
+  entry record {"n": <number>, "entry": <LogEntry>} written before the entry
+  is sent, or an acknowledgement record {"ack": [<number>, ...]} written once
+  Cloud Logging has accepted the entries.
+
+  A new segment is started when the current one would grow beyond
+  segment_max_bytes. Segments are deleted as soon as they, and all segments
+  before them, hold no unacknowledged entries, so disk usage is bounded by
+  the backlog of unsent entries plus one segment. Writes are flushed to disk
+  with fsync at most every fsync_interval_seconds, and when a segment is
+  rotated or the journal is closed.
+
+  While a journal is open, it holds an exclusive lock on
+  "<execution_id>.lock". Opening the journal of an earlier execution
+  therefore fails while that execution is still running, and otherwise
+  loads its unacknowledged entries for replay.
+
+  Attributes:
+    directory: The directory holding the journal segments.
+    execution_id: The ID of the playbook execution.
+    segment_max_bytes: Size after which a new segment is started.
+    fsync_interval_seconds: Minimum time between two fsync calls.
+  """
+
+  SEGMENT_SUFFIX = ".jsonl"
+
+  def __init__(
+      self,
+      directory: str,
+      execution_id: str,
+      segment_max_bytes: int = 16 * 1024 * 1024,
+      fsync_interval_seconds: float = 1.0,
+  ):
+    """Opens the journal, loading any segments it already has.
+
+    Raises:
+      OSError: The journal is locked by another process.
+    """
+    self.directory = directory
+    self.execution_id = execution_id
+    self.segment_max_bytes = max(1, segment_max_bytes)
+    self.fsync_interval_seconds = max(0.0, fsync_interval_seconds)
+    os.makedirs(directory, exist_ok=True)
+    self._lock_file = open(
+        os.path.join(directory, f"{execution_id}.lock"), "ab"
+    )
+    import fcntl
+
+    try:
+      fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+      self._lock_file.close()
+      raise
+    self._lock = threading.Lock()
+    self._file = None
+    self._size = 0
+    self._last_sync = time.monotonic()
+    # Unacknowledged entry numbers and the segment holding each of them.
+    self._segment_of = {}
+    self._unacked = collections.Counter()
+    self._segments = []
+    self._recovered = {}
+    self._next_n = 1
+    self._load()
+    self._segment = self._segments[-1] + 1 if self._segments else 0
+
+  @classmethod
+  def execution_ids(cls, directory: str) -> list[str]:
+    """Returns the IDs of the executions with segments in directory."""
+    try:
+      names = os.listdir(directory)
+    except FileNotFoundError:
+      return []
+    return sorted({
+        name.split(".", 1)[0]
+        for name in names
+        if name.endswith(cls.SEGMENT_SUFFIX)
+    })
+
+  def _segment_path(self, segment: int) -> str:
+    return os.path.join(
+        self.directory,
+        f"{self.execution_id}.{segment:06d}{self.SEGMENT_SUFFIX}",
+    )
+
+  def _load(self) -> None:
+    """Reads existing segments of this execution."""
+    prefix = f"{self.execution_id}."
+    for name in os.listdir(self.directory):
+      if name.startswith(prefix) and name.endswith(self.SEGMENT_SUFFIX):
+        index = name[len(prefix):-len(self.SEGMENT_SUFFIX)]
+        if index.isdigit():
+          self._segments.append(int(index))
+    self._segments.sort()
+    acked = set()
+    for segment in self._segments:
+      with open(self._segment_path(segment), "rb") as f:
+        for line in f:
+          try:
+            record = json.loads(line)
+          except ValueError:
+            # A torn write from a crash, the entry was never sent.
+            continue
+          if "ack" in record:
+            acked.update(record["ack"])
+          else:
+            self._recovered[record["n"]] = record["entry"]
+            self._segment_of[record["n"]] = segment
+          self._next_n = max(self._next_n, record.get("n", 0) + 1)
+    for n in acked:
+      self._recovered.pop(n, None)
+      self._segment_of.pop(n, None)
+    self._unacked.update(self._segment_of.values())
+
+  def pending_entries(self) -> list[tuple[int, str]]:
+    """Returns the unacknowledged entries loaded from existing segments.
+
+    Returns:
+      A list of (number, LogEntry JSON string) tuples in journal order.
+    """
+    pending = [
+        (n, json.dumps(entry)) for n, entry in sorted(self._recovered.items())
+    ]
+    self._recovered = {}
+    return pending
+
+  def _write(self, line: bytes) -> None:
+    if self._file is not None and self._size + len(line) > self.segment_max_bytes:
+      self._sync()
+      self._file.close()
+      self._file = None
+      self._segment += 1
+    if self._file is None:
+      self._file = open(self._segment_path(self._segment), "ab")
+      self._segments.append(self._segment)
+      self._size = 0
+    self._file.write(line)
+    self._size += len(line)
+    if time.monotonic() - self._last_sync >= self.fsync_interval_seconds:
+      self._sync()
+
+  def _sync(self) -> None:
+    if self._file is not None:
+      self._file.flush()
+      os.fsync(self._file.fileno())
+    self._last_sync = time.monotonic()
+
+  def _delete_acknowledged_segments(self) -> None:
+    """Deletes the leading segments that hold no unacknowledged entries.
+
+    Only a prefix of segments is deleted, because acknowledgement records
+    refer to entries of the same or earlier segments.
+    """
+    while (
+        self._segments
+        and self._segments[0] != self._segment
+        and not self._unacked[self._segments[0]]
+    ):
+      segment = self._segments.pop(0)
+      del self._unacked[segment]
+      os.remove(self._segment_path(segment))
+
+  def append(self, data: str) -> int:
+    """Appends a LogEntry JSON string to the journal.
+
+    Args:
+      data: The LogEntry as a JSON string.
+
+    Returns:
+      The number identifying the entry for ack().
+    """
+    with self._lock:
+      n = self._next_n
+      self._next_n += 1
+      self._write(f'{{"n":{n},"entry":{data}}}\n'.encode("utf-8"))
+      self._segment_of[n] = self._segment
+      self._unacked[self._segment] += 1
+      return n
+
+  def ack(self, numbers: list[int]) -> None:
+    """Marks entries as accepted by Cloud Logging.
+
+    Args:
+      numbers: Numbers returned by append() or pending_entries().
+    """
+    with self._lock:
+      numbers = [n for n in numbers if n in self._segment_of]
+      if not numbers:
+        return
+      self._write(json.dumps({"ack": numbers}).encode("utf-8") + b"\n")
+      for n in numbers:
+        self._unacked[self._segment_of.pop(n)] -= 1
+      self._delete_acknowledged_segments()
+
+  def close(self) -> None:
+    """Flushes and closes the journal and releases its lock.
+
+    If all entries have been acknowledged, the journal is deleted.
+    """
+    with self._lock:
+      if self._file is not None:
+        self._sync()
+        self._file.close()
+        self._file = None
+      if not self._segment_of:
+        for segment in self._segments:
+          os.remove(self._segment_path(segment))
+        self._segments = []
+        os.remove(self._lock_file.name)
+      self._lock_file.close()
+
+
+def _read_token_cache(path: str) -> Optional[tuple[str, float]]:
+  """Returns the access token and its expiry from a token cache file.
+
+  Args:
+    path: Path of the token cache file.
+
+  Returns:
+    A (token, expiry) tuple with the expiry in seconds since the epoch, or None
+    if the file does not exist or does not hold a token. Files of other users
+    or readable by them are ignored, they may hold a planted token.
+  """
+  try:
+    with open(path) as f:
+      st = os.fstat(f.fileno())
+      if st.st_uid != os.getuid() or st.st_mode & 0o077:
+        return None
+      cached = json.load(f)
+    return cached["token"], float(cached["expiry"])
+  except (OSError, ValueError, KeyError, TypeError):
+    return None
+
+
+def _write_token_cache(path: str, token: str, expiry: float) -> None:
+  """Atomically replaces a token cache file, readable by the user only.
+
+  Args:
+    path: Path of the token cache file.
+    token: The access token.
+    expiry: Expiry of the token in seconds since the epoch.
+  """
+  directory = os.path.dirname(os.path.abspath(path))
+  os.makedirs(directory, mode=0o700, exist_ok=True)
+  fd, tmp = tempfile.mkstemp(dir=directory, prefix=".token-")
+  try:
+    with os.fdopen(fd, "w") as f:
+      json.dump({"token": token, "expiry": expiry}, f)
+    os.replace(tmp, path)
+  except OSError:
+    os.unlink(tmp)
+    raise
+
+
+class _TokenBucket:
+  """Thread-safe token bucket limiting the rate of entries:write requests.
+
+  Attributes:
+    rate: Tokens added per second.
+    capacity: Maximum number of tokens, i.e. the allowed burst.
+  """
+
+  def __init__(self, rate: float, capacity: float):
+    self.rate = rate
+    self.capacity = max(1.0, capacity)
+    self._tokens = self.capacity
+    self._updated = time.monotonic()
+    self._lock = threading.Lock()
+
+  def acquire(self, deadline: Optional[float] = None) -> bool:
+    """Takes a token, waiting until one is available.
+
+    Args:
+      deadline: time.monotonic() by which the token must be available. If
+        waiting would take longer, no token is taken and acquire() returns
+        right away.
+
+    Returns:
+      True if a token was taken, False if the deadline would have passed.
+    """
+    with self._lock:
+      now = time.monotonic()
+      self._tokens = min(
+          self.capacity, self._tokens + (now - self._updated) * self.rate
+      )
+      self._updated = now
+      delay = (1 - self._tokens) / self.rate if self._tokens < 1 else 0.0
+      if deadline is not None and now + delay > deadline:
+        return False
+      # Reserving the token before sleeping keeps concurrent callers queued
+      # behind each other instead of all waking up at the same time.
+      self._tokens -= 1
+    if delay:
+      time.sleep(delay)
+    return True
+
+
+def _retry_after_seconds(resp: Any) -> Optional[float]:
+  """Returns the delay requested by a Retry-After header, if any.
+
+  Args:
+    resp: The HTTP response.
+
+  Returns:
+    The delay in seconds, or None if the header is missing or invalid.
+  """
+  value = resp.headers.get("Retry-After") if resp is not None else None
+  if not value:
+    return None
+  try:
+    return max(0.0, float(value))
+  except ValueError:
+    pass
+  import email.utils
+
+  try:
+    retry_at = email.utils.parsedate_to_datetime(value)
+  except (TypeError, ValueError):
+    return None
+  now = datetime.datetime.now(datetime.timezone.utc)
+  return max(0.0, (retry_at - now).total_seconds())
+
+
+class PipelineMetrics:
+  """Counters and a latency histogram of the requests sent to the sink.
+
+  Thread-safe, the sender threads update it while the metrics are exported.
+
+  Attributes:
+    requests: Number of write attempts by HTTP status code, "error" for
+      attempts that raised, e.g. on connection errors and timeouts.
+    entries_sent: Number of log entries written.
+    bytes_sent: Size of the written request bodies.
+    drain_seconds: Time CloudLoggingCollector.wait() took to send the
+      remaining entries at the end of the playbook.
+    unsent_events: Number of entries left unsent when the drain timed out.
+  """
+
+  PREFIX = "ansible_cloud_logging"
+  # Upper bounds of the send latency histogram buckets in seconds.
+  LATENCY_BUCKETS = (
+      0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0
+  )
+
+  def __init__(self):
+    self.requests = collections.Counter()
+    self.entries_sent = 0
+    self.bytes_sent = 0
+    self.drain_seconds = 0.0
+    self.unsent_events = 0
+    # One more bucket than LATENCY_BUCKETS for +Inf.
+    self._buckets = [0] * (len(self.LATENCY_BUCKETS) + 1)
+    self._latencies = array.array("d")
+    self._latency_sum = 0.0
+    self._lock = threading.Lock()
+
+  def observe_request(
+      self, status: str, seconds: float, size: int, entries: int
+  ) -> None:
+    """Records a write attempt.
+
+    Args:
+      status: HTTP status code of the response, "error" if there was none.
+      seconds: Time the attempt took.
+      size: Size of the request body.
+      entries: Number of log entries in the request.
+    """
+    with self._lock:
+      self.requests[status] += 1
+      self._buckets[bisect.bisect_left(self.LATENCY_BUCKETS, seconds)] += 1
+      self._latencies.append(seconds)
+      self._latency_sum += seconds
+      if status == "200":
+        self.entries_sent += entries
+        self.bytes_sent += size
+
+  def summary(self) -> dict[str, Any]:
+    """Returns the metrics as a JSON serializable dictionary."""
+    with self._lock:
+      latencies = sorted(self._latencies)
+      summary = {
+          "requests": sum(self.requests.values()),
+          "request_errors": sum(
+              n for status, n in self.requests.items() if status != "200"
+          ),
+          "entries_sent": self.entries_sent,
+          "bytes_sent": self.bytes_sent,
+          "unsent_events": self.unsent_events,
+          "drain_seconds": round(self.drain_seconds, 3),
+          "send_latency_seconds": {},
+      }
+    if latencies:
+      summary["send_latency_seconds"] = {
+          f"p{p}": round(_percentile(latencies, p), 6) for p in (50, 90, 99)
+      }
+      summary["send_latency_seconds"]["max"] = round(latencies[-1], 6)
+    return summary
+
+  def render(
+      self, counters: dict[str, int], gauges: dict[str, float]
+  ) -> str:
+    """Returns the metrics in the Prometheus text exposition format.
+
+    Args:
+      counters: Further counters to export, by name without prefix.
+      gauges: Gauges to export, by name without prefix.
+    """
+    p = self.PREFIX
+    lines = [
+        f"# HELP {p}_requests_total Write requests sent to the sink by status code.",
+        f"# TYPE {p}_requests_total counter",
+    ]
+    with self._lock:
+      for status, n in sorted(self.requests.items()):
+        lines.append(f'{p}_requests_total{{code="{status}"}} {n}')
+      counters = dict(
+          counters,
+          entries_sent=self.entries_sent,
+          bytes_sent=self.bytes_sent,
+          unsent_events=self.unsent_events,
+      )
+      gauges = dict(gauges, drain_seconds=self.drain_seconds)
+      lines += [
+          f"# HELP {p}_send_latency_seconds Duration of write requests.",
+          f"# TYPE {p}_send_latency_seconds histogram",
+      ]
+      cumulative = 0
+      for bound, n in zip(self.LATENCY_BUCKETS + ("+Inf",), self._buckets):
+        cumulative += n
+        lines.append(f'{p}_send_latency_seconds_bucket{{le="{bound}"}} {cumulative}')
+      lines.append(f"{p}_send_latency_seconds_sum {self._latency_sum}")
+      lines.append(f"{p}_send_latency_seconds_count {cumulative}")
+    for name, value in counters.items():
+      lines.append(f"# TYPE {p}_{name}_total counter")
+      lines.append(f"{p}_{name}_total {value}")
+    for name, value in gauges.items():
+      lines.append(f"# TYPE {p}_{name} gauge")
+      lines.append(f"{p}_{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+class _SinkResponse:
+  """Response of sinks that do not talk HTTP, mimics requests.Response."""
+
+  status_code = 200
+  headers = {}
+  text = ""
+
+
+class CloudLoggingSink:
+  """Writes log entries with the entries:write method of Cloud Logging.
+
+  The GcpSession is created by the first request, so that playbooks that
+  never log do not pay for the credential lookup. It uses an access token
+  that is fetched once with the application default credentials and
+  refreshed shortly before it expires or after a 401 response. With a
+  token_cache_file, the token is shared with other processes.
+
+  Attributes:
+    params: Parameters for the GcpSession class.
+    token_cache_file: File shared with other processes caching the access token.
+    gcp_session: Handles authenticated communication with the Google Cloud
+      Logging API. Created on the first request by _session().
+  """
+
+  def __init__(self, token_cache_file: Optional[str] = None):
+    self.params = {
+        "auth_kind": "accesstoken",
+        "scopes": [LOGGING_WRITE_SCOPE],
+        "access_token": None,
+    }
+    self.token_cache_file = token_cache_file
+    self.gcp_session = None
+    self._session_expiry = math.inf
+    self._session_lock = threading.Lock()
+
+  def fail_json(self, **kwargs) -> None:
+    raise RuntimeError(kwargs.get("msg", "An error occurred, but no message was provided"))
+
+  def _access_token(self) -> tuple[str, float]:
+    """Returns a valid access token and its expiry in seconds since the epoch.
+
+    The token is taken from token_cache_file if it is valid for at least
+    TOKEN_REFRESH_MARGIN_SECONDS. Otherwise a new one is fetched with the
+    application default credentials and stored in token_cache_file.
+    """
+    now = time.time()
+    if self.token_cache_file:
+      cached = _read_token_cache(self.token_cache_file)
+      if cached and cached[1] - TOKEN_REFRESH_MARGIN_SECONDS > now:
+        return cached
+    # google.auth is only imported once a token is needed.
+    import google.auth
+    import google.auth.transport.requests
+
+    credentials, _ = google.auth.default(scopes=self.params["scopes"])
+    credentials.refresh(google.auth.transport.requests.Request())
+    if credentials.expiry is not None:
+      expiry = credentials.expiry.replace(tzinfo=datetime.timezone.utc).timestamp()
+    else:
+      expiry = now + 2 * TOKEN_REFRESH_MARGIN_SECONDS
+    if self.token_cache_file:
+      try:
+        _write_token_cache(self.token_cache_file, credentials.token, expiry)
+      except OSError as e:
+        print(f"Failed to cache the access token in {self.token_cache_file}: {e}")
+    return credentials.token, expiry
+
+  def _session(self):
+    """Returns the GcpSession, creating it with a fresh token if needed.
+
+    Sessions assigned to gcp_session directly, e.g. in tests, never expire.
+
+    Raises:
+      RuntimeError: If no access token could be obtained.
+    """
+    with self._session_lock:
+      if (
+          self.gcp_session is None
+          or self._session_expiry - TOKEN_REFRESH_MARGIN_SECONDS <= time.time()
+      ):
+        # The google.cloud collection pulls in requests and google-auth, it is
+        # only imported once there is something to send.
+        from ansible_collections.google.cloud.plugins.module_utils.gcp_utils import GcpSession
+
+        try:
+          token, self._session_expiry = self._access_token()
+        except Exception as e:
+          self.fail_json(msg=f"Failed to get an access token: {e}")
+        self.params["access_token"] = token
+        self.gcp_session = GcpSession(self, "logging")
+      return self.gcp_session
+
+  def _expire_session(self) -> None:
+    """Makes _session() fetch a new token, e.g. after a 401 response."""
+    with self._session_lock:
+      if self._session_expiry != math.inf:
+        self._session_expiry = 0
+        if self.token_cache_file:
+          try:
+            os.unlink(self.token_cache_file)
+          except OSError:
+            pass
+
+  def encode(self, entries: list[str]) -> bytes:
+    """Returns the entries:write request body for serialized log entries.
+
+    partialSuccess is set so that a single rejected entry does not cause the
+    rest of the batch to be dropped.
+    """
+    return (
+        '{"partialSuccess":true,"entries":[' + ",".join(entries) + "]}"
+    ).encode("utf-8")
+
+  def write(self, data: bytes, timeout: Optional[float] = None) -> Any:
+    """Sends an entries:write request and returns the response.
+
+    A request rejected because of its token is sent once more with a new one.
 
-  params:
-    id: Unique ID of the playbook execution.
-    event_type: Type of the event.
-    task_id: Unique ID of the task.
-    name: Name of the task.
-    host: Hostname of the host where the task is executed.
-    start_time: Timestamp when the task execution started.
-    end_time: Timestamp when the task execution ended.
-    status: Status of the task (OK, FAILED, SKIPPED, etc.)
-    result: Dictionary containing the execution result.
-  """
-  id: str
-  event_type: str
-  task_id: str
-  name: str
-  host: str
-  start_time: str
-  # WLM fields
-  deployment_name: str
-  state: str
-  timestamp: str
-  step_name: str
+    Args:
+      data: The request body returned by encode().
+      timeout: Timeout of the request in seconds, passed on to requests.
+    """
+    for attempt in range(2):
+      try:
+        resp = self._session().full_post(
+            LOGGING_WRITE_URL,
+            data=data,
+            headers={"Content-Type": "application/json"},
+            timeout=timeout,
+        )
+      except Exception as e:
+        # AuthorizedSession answers a 401 response by refreshing the
+        # credentials, which fails for a plain access token.
+        if type(e).__name__ != "RefreshError" or attempt:
+          raise
+      else:
+        if resp.status_code != 401 or attempt:
+          return resp
+      # The token may have been revoked before its expiry.
+      self._expire_session()
 
+  def close(self) -> None:
+    pass
 
-# Not supported by WLM
-class PlaybookTaskEndMessage(TypedDict):
-  """Defines the serializable message for a playbook task event.
 
-  params:
-    id: Unique ID of the playbook execution.
-    event_type: Type of the event.
-    task_id: Unique ID of the task.
-    name: Name of the task.
-    host: Hostname of the host where the task is executed.
-    start_time: Timestamp when the task execution started.
-    end_time: Timestamp when the task execution ended.
-    status: Status of the task (OK, FAILED, SKIPPED, etc.)
-    result: Dictionary containing the execution result.
-    error_message: either result.stderr or result.msg depending on what ansible module failed.
+class HttpSink:
+  """Posts entries:write request bodies to any HTTP endpoint.
+
+  Requests are not authenticated, the sink is meant for local collectors and
+  stand-ins such as fake_cloud_logging.FakeCloudLoggingServer. Connections are
+  pooled by a requests.Session shared by all sender workers.
+
+  Attributes:
+    url: URL the requests are posted to.
+    timeout: Timeout of each request in seconds.
   """
 
-  id: str
-  event_type: str
-  task_id: str
-  name: str
-  host: str
-  start_time: str
-  end_time: str
-  status: str
-  result: dict[str, Any]
-  error_message: str
+  def __init__(self, url: str, timeout: float = 30.0):
+    if not url:
+      raise ValueError("The http sink requires a URL")
+    self.url = url
+    self.timeout = timeout
+    self._http_session = None
+    self._session_lock = threading.Lock()
 
+  # The same request body as for Cloud Logging, so that local stand-ins of
+  # the API can be used.
+  encode = CloudLoggingSink.encode
 
-class PlaybookEndMessage(TypedDict):
-  """Defines the serializable message for a playbook end event.
+  def write(self, data: bytes, timeout: Optional[float] = None) -> Any:
+    """Posts a request body and returns the response.
 
-  params:
-    id: Unique ID of the playbook execution.
-    event_type: Type of the event.
-    user: Username of the user executing the playbook.
-    start_time: Timestamp when the playbook execution started.
-    end_time: Timestamp when the playbook execution ended.
-    stats: Dictionary containing summary statistics.
+    Args:
+      data: The request body returned by encode().
+      timeout: Timeout of the request in seconds, at most self.timeout.
+    """
+    with self._session_lock:
+      if self._http_session is None:
+        import requests
+
+        self._http_session = requests.Session()
+    return self._http_session.post(
+        self.url,
+        data=data,
+        headers={"Content-Type": "application/json"},
+        timeout=self.timeout if timeout is None else min(timeout, self.timeout),
+    )
+
+  def close(self) -> None:
+    if self._http_session is not None:
+      self._http_session.close()
+
+
+class FileSink:
+  """Appends log entries to a JSONL file, or to stdout.
+
+  Writes are buffered and flushed by close(), except on stdout.
+
+  Attributes:
+    path: Path of the file, None for stdout.
   """
 
-  id: str
-  event_type: str
-  user: str
-  start_time: str
-  end_time: str
-  stats: dict[str, Any]
-  # WLM fields
-  deployment_name: str
-  state: str
-  timestamp: str
-  playbook_stats: dict[str, Any]
-  file_name: str
+  BUFFER_SIZE = 1024 * 1024
+
+  def __init__(self, path: Optional[str] = None):
+    self.path = path
+    self._file = None
+    self._lock = threading.Lock()
+
+  def encode(self, entries: list[str]) -> bytes:
+    """Returns serialized log entries as JSON lines."""
+    return ("\n".join(entries) + "\n").encode("utf-8")
+
+  def write(self, data: bytes, timeout: Optional[float] = None) -> _SinkResponse:
+    """Writes JSON lines, opening the file on the first call.
+
+    Args:
+      data: The lines returned by encode().
+      timeout: Ignored, local writes are not interrupted.
+    """
+    with self._lock:
+      if self.path is None:
+        sys.stdout.buffer.write(data)
+        sys.stdout.buffer.flush()
+        return _SinkResponse()
+      if self._file is None:
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        self._file = open(self.path, "ab", buffering=self.BUFFER_SIZE)
+      self._file.write(data)
+    return _SinkResponse()
+
+  def close(self) -> None:
+    with self._lock:
+      if self._file is not None:
+        self._file.close()
+        self._file = None
 
 
 class CloudLoggingCollector:
@@ -216,11 +2354,48 @@ class CloudLoggingCollector:
   Create a new CloudLoggingCollector instance by passing the project and
   the log_name. Log messages can be submitted using CloudLoggingCollector.send(msg). 
   If enable_async_logging is set to True, messages are queued and processed by 
-  a background thread started via start_consuming(). Otherwise, messages are sent synchronously. 
-  The separate worker thread running in the background will consume the queue 
+  background threads started via start_consuming(). Otherwise, messages are sent synchronously. 
+  The separate worker threads running in the background will consume the queue 
   until a "None" message has been received. Make sure to run start_consuming() 
   after initializing the instance of CloudLoggingCollector to start all necessary worker threads.
 
+  Messages are serialized into log entries when they are submitted, so the
+  queue holds JSON strings whose size is known up front. With enable_batching
+  the worker threads group queued entries into a single entries:write request.
+  The queue is a BoundedEventQueue, see there for the overflow policies.
+
+  With several sender_workers, the queue is sharded by host so that each
+  host's messages are sent in order by a single worker. The other workers
+  start sending once the first PLAYBOOK_START message has been sent, and
+  PLAYBOOK_END messages are held back until wait() has drained all workers
+  and the journal replay, so that their logging_stats include every send.
+
+  Entries are written by a sink. CloudLoggingSink sends them to Cloud
+  Logging, HttpSink and FileSink to a local collector or file for tests and
+  load tests. All sinks go through the same queueing, batching and retries.
+
+  Transient errors are retried with capped exponential backoff and full
+  jitter, honoring Retry-After, until retry_deadline_seconds have passed.
+  Requests that still fail are reported and counted. Unless
+  ignore_gcp_api_errors is set, the playbook is then terminated from the
+  main thread on its next log message.
+
+  wait() gives the sender threads drain_timeout_seconds to send the queue.
+  Entries that are still unsent when it expires, because the sink is slow or
+  a connection hangs, are written to an overflow file in overflow_dir, or
+  kept in the journal for the next run, and reported. The sender threads are
+  daemon threads, so a hung request cannot keep Ansible from exiting.
+
+  With a journal_dir, every entry is appended to an EventJournal before it
+  is sent and acknowledged in the journal once it has been written. The
+  unacknowledged entries of earlier executions are replayed by a background
+  thread started with start_consuming().
+
+  Every write attempt is recorded in PipelineMetrics. With a metrics_file,
+  the metrics are written in the Prometheus text format every
+  metrics_interval_seconds, and with a metrics_port they are served on
+  http://127.0.0.1:<metrics_port>/metrics while the playbook runs.
+
   Attributes:
     project: The Google Cloud project ID where logs will be sent.
     log_name: The log ID of the log entry name.
@@ -228,10 +2403,32 @@ class CloudLoggingCollector:
       to avoid blocking Ansible execution. If False, messages are sent
       synchronously as they are emitted.
     ignore_gcp_api_errors: If enabled, GCP API errors are ignored and do not cause Ansible to fail.
-    params: Parameters for the GcpSession class.
-    queue: Holds log messages when async logging is enabled.
-    gcp_session: Handles authenticated communication with the Google Cloud Logging API.
-    consumer: Background thread that processes log messages from the queue.
+    enable_batching: If True, queued entries are sent in batches.
+    batch_max_entries: Maximum number of entries per entries:write request.
+    batch_max_bytes: Maximum size of the serialized entries per request.
+    batch_linger_seconds: Maximum time to wait for a batch to fill up.
+    sender_workers: Number of background threads sending log messages.
+    retry_max_attempts: Maximum number of attempts per entries:write request.
+    retry_initial_backoff_seconds: Upper bound of the delay before the first retry.
+    retry_max_backoff_seconds: Maximum delay between two attempts.
+    retry_deadline_seconds: Maximum time spent on a request including retries.
+    request_timeout_seconds: Maximum time spent on a single attempt.
+    drain_timeout_seconds: Maximum time wait() spends sending the remaining
+      messages, 0 waits until all have been sent.
+    overflow_dir: Directory of the overflow file, defaults to the system
+      temporary directory.
+    overflow_file: The overflow file written by wait(), None if there is none.
+    rate_limiter: Optional _TokenBucket shared by all sender workers.
+    journal_dir: Directory of the EventJournal, None if disabled.
+    journal: The EventJournal of this execution, None if disabled.
+    journal_replay: If True, journals of earlier executions are replayed.
+    queue: BoundedEventQueue holding serialized log entries when async logging is enabled.
+    sink: Writes batches of log entries, e.g. a CloudLoggingSink.
+    consumers: Background threads that process log messages from the queue.
+    metrics: PipelineMetrics of the requests sent to the sink.
+    metrics_file: Prometheus textfile the metrics are written to, or None.
+    metrics_port: Local port the metrics are served on, 0 if disabled.
+    metrics_interval_seconds: Time between two updates of the metrics_file.
   """
 
   def __init__(
@@ -240,6 +2437,32 @@ class CloudLoggingCollector:
       log_name: str,
       enable_async_logging: bool,
       ignore_gcp_api_errors: bool = False,
+      enable_batching: bool = False,
+      batch_max_entries: int = 500,
+      batch_max_bytes: int = 5 * 1024 * 1024,
+      batch_linger_seconds: float = 1.0,
+      queue_max_entries: int = 10000,
+      queue_max_bytes: int = 64 * 1024 * 1024,
+      queue_overflow_policy: str = "block",
+      spill_dir: Optional[str] = None,
+      sender_workers: int = 1,
+      retry_max_attempts: int = 8,
+      retry_initial_backoff_seconds: float = 0.5,
+      retry_max_backoff_seconds: float = 30.0,
+      retry_deadline_seconds: float = 60.0,
+      write_requests_per_minute: int = 0,
+      execution_id: str = "",
+      journal_dir: Optional[str] = None,
+      journal_segment_max_bytes: int = 16 * 1024 * 1024,
+      journal_fsync_interval_seconds: float = 1.0,
+      journal_replay: bool = True,
+      sink: Optional[CloudLoggingSink | HttpSink | FileSink] = None,
+      metrics_file: Optional[str] = None,
+      metrics_port: int = 0,
+      metrics_interval_seconds: float = 15.0,
+      request_timeout_seconds: float = 30.0,
+      drain_timeout_seconds: float = 120.0,
+      overflow_dir: Optional[str] = None,
   ):
     """Initializes the CloudLoggingCollector instance.
 
@@ -250,32 +2473,212 @@ class CloudLoggingCollector:
         to avoid blocking Ansible execution. If False, messages are sent
         synchronously as they are emitted.
       ignore_gcp_api_errors: If enabled, GCP API errors are ignored and do not cause Ansible to fail.
+      enable_batching: If True, the background thread groups queued entries
+        into a single entries:write request.
+      batch_max_entries: Maximum number of entries per entries:write request.
+      batch_max_bytes: Maximum size of the serialized entries per request,
+        capped to MAX_BATCH_BYTES.
+      batch_linger_seconds: Maximum time to wait for more entries before
+        flushing a partially filled batch.
+      queue_max_entries: Maximum number of entries held in memory by the queue.
+      queue_max_bytes: Maximum size of the entries held in memory by the queue.
+      queue_overflow_policy: One of BoundedEventQueue.OVERFLOW_POLICIES.
+      spill_dir: Directory for the spill file of the "spill" overflow policy.
+      sender_workers: Number of background threads sending log messages.
+      retry_max_attempts: Maximum number of attempts per entries:write request.
+      retry_initial_backoff_seconds: Upper bound of the delay before the first
+        retry, doubled with every retry.
+      retry_max_backoff_seconds: Maximum delay between two attempts.
+      retry_deadline_seconds: Maximum time spent on a request including retries.
+      write_requests_per_minute: Client-side limit of entries:write requests,
+        0 disables the limit.
+      execution_id: The ID of the playbook execution, names the journal.
+      journal_dir: Directory of the EventJournal, disabled if None.
+      journal_segment_max_bytes: Size after which the journal starts a new segment.
+      journal_fsync_interval_seconds: Minimum time between two journal fsync calls.
+      journal_replay: If True, journals of earlier executions are replayed.
+      sink: Where log entries are written to, a CloudLoggingSink if None.
+      metrics_file: Prometheus textfile the metrics are written to, or None.
+      metrics_port: Local port the metrics are served on, 0 disables it.
+      metrics_interval_seconds: Time between two updates of the metrics_file.
+      request_timeout_seconds: Maximum time spent on a single attempt.
+      drain_timeout_seconds: Maximum time wait() spends sending the remaining
+        messages, 0 waits until all have been sent.
+      overflow_dir: Directory of the overflow file, defaults to the system
+        temporary directory.
     """
     self.project = project
     self.log_name = log_name
     self.enable_async_logging = enable_async_logging
     self.ignore_gcp_api_errors = ignore_gcp_api_errors
-    self.params = {
-        "auth_kind": "application",
-        "scopes": "https://www.googleapis.com/auth/logging.write",
-    }
-    self.gcp_session = GcpSession(self, "logging")
+    self.enable_batching = enable_batching
+    self.batch_max_entries = max(1, batch_max_entries) if enable_batching else 1
+    self.batch_max_bytes = min(max(1, batch_max_bytes), MAX_BATCH_BYTES)
+    self.batch_linger_seconds = max(0.0, batch_linger_seconds)
+    self.sender_workers = max(1, sender_workers)
+    self.retry_max_attempts = max(1, retry_max_attempts)
+    self.retry_initial_backoff_seconds = max(0.0, retry_initial_backoff_seconds)
+    self.retry_max_backoff_seconds = max(0.0, retry_max_backoff_seconds)
+    self.retry_deadline_seconds = max(0.0, retry_deadline_seconds)
+    self.request_timeout_seconds = max(0.001, request_timeout_seconds)
+    self.drain_timeout_seconds = max(0.0, drain_timeout_seconds)
+    self.overflow_dir = overflow_dir
+    self.execution_id = execution_id
+    # Set when wait() gives up on the sender threads, they then stop sending.
+    self._abandoned = threading.Event()
+    self.overflow_file = None
+    # The batch each sender thread is writing, by shard.
+    self._in_flight = {}
+    self.rate_limiter = None
+    if write_requests_per_minute > 0:
+      rate = write_requests_per_minute / 60
+      self.rate_limiter = _TokenBucket(rate=rate, capacity=rate)
+    self._stats_lock = threading.Lock()
+    self._retries = 0
+    self._failed_events = 0
+    self._fatal_error = False
+    self._replayed_events = 0
+    self.journal_dir = journal_dir
+    self.journal_replay = journal_replay
+    self._journal_segment_max_bytes = journal_segment_max_bytes
+    self._journal_fsync_interval_seconds = journal_fsync_interval_seconds
+    self.journal = None
+    if journal_dir:
+      self.journal = EventJournal(
+          journal_dir,
+          execution_id or str(uuid.uuid4()),
+          segment_max_bytes=journal_segment_max_bytes,
+          fsync_interval_seconds=journal_fsync_interval_seconds,
+      )
+    self.consumers = []
+    self.replayer = None
+    self._held_payloads = []
+    self.sink = sink if sink is not None else CloudLoggingSink()
+    self.metrics = PipelineMetrics()
+    self.metrics_file = metrics_file
+    self.metrics_port = metrics_port
+    self.metrics_interval_seconds = max(0.1, metrics_interval_seconds)
+    self._metrics_stop = threading.Event()
+    self._metrics_writer = None
+    self._metrics_server = None
     if self.enable_async_logging:
-      self.queue = queue.Queue()
-
-  def fail_json(self, **kwargs) -> None:
-    raise RuntimeError(kwargs.get("msg", "An error occurred, but no message was provided"))
+      self.queue = BoundedEventQueue(
+          max_entries=queue_max_entries,
+          max_bytes=queue_max_bytes,
+          overflow_policy=queue_overflow_policy,
+          spill_dir=spill_dir,
+          shards=self.sender_workers,
+      )
+      # Set once the first PLAYBOOK_START message has been sent, or when
+      # there is no such message to wait for.
+      self._start_sent = threading.Event()
+      self._start_queued = False
 
   def start_consuming(self) -> None:
-    """Starts the background consumer thread.
+    """Starts the background consumer threads.
 
-    If enable_async_logging is False, the method, is a no-op.
+    The journal replay thread is started in both modes. Apart from that, if
+    enable_async_logging is False, the method, is a no-op.
     """
+    if self.journal and self.journal_replay:
+      self.replayer = threading.Thread(target=self.replay_journals, daemon=True)
+      self.replayer.start()
     if self.enable_async_logging:
-      self.consumer = threading.Thread(target=self.consume)
-      self.consumer.start()
+      for shard in range(self.sender_workers):
+        # wait() joins the threads within drain_timeout_seconds, daemon
+        # threads do not hold up the exit if it gives up on them.
+        consumer = threading.Thread(
+            target=self.consume, args=(shard,), daemon=True
+        )
+        consumer.start()
+        self.consumers.append(consumer)
+    if self.metrics_file:
+      # Daemon threads, so that exporting metrics never delays the exit.
+      self._metrics_writer = threading.Thread(
+          target=self._write_metrics_periodically, daemon=True
+      )
+      self._metrics_writer.start()
+    if self.metrics_port:
+      self._serve_metrics()
 
-  def _send(
+  def metrics_text(self) -> str:
+    """Returns the metrics in the Prometheus text exposition format."""
+    gauges = {}
+    if self.enable_async_logging:
+      entries, size, spilled = self.queue.depth()
+      gauges = {
+          "queue_entries": entries,
+          "queue_bytes": size,
+          "queue_spilled_entries": spilled,
+          "queue_max_entries": self.queue.max_depth,
+      }
+    return self.metrics.render(self.stats(), gauges)
+
+  def _write_metrics_file(self) -> None:
+    """Atomically replaces the metrics_file, as the textfile collector expects."""
+    directory = os.path.dirname(os.path.abspath(self.metrics_file))
+    try:
+      os.makedirs(directory, exist_ok=True)
+      fd, tmp = tempfile.mkstemp(dir=directory, prefix=".metrics-")
+      with os.fdopen(fd, "w") as f:
+        f.write(self.metrics_text())
+      os.chmod(tmp, 0o644)
+      os.replace(tmp, self.metrics_file)
+    except OSError as e:
+      print(f"Failed to write metrics to {self.metrics_file}: {e}")
+
+  def _write_metrics_periodically(self) -> None:
+    while not self._metrics_stop.wait(self.metrics_interval_seconds):
+      self._write_metrics_file()
+
+  def _serve_metrics(self) -> None:
+    """Serves metrics_text() on the loopback interface in a daemon thread."""
+    import http.server
+
+    collector = self
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+
+      def do_GET(self):
+        if self.path != "/metrics":
+          self.send_error(404)
+          return
+        body = collector.metrics_text().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+      def log_message(self, *args):
+        pass
+
+    try:
+      self._metrics_server = http.server.ThreadingHTTPServer(
+          ("127.0.0.1", self.metrics_port), Handler
+      )
+    except OSError as e:
+      print(f"Failed to serve metrics on port {self.metrics_port}: {e}")
+      return
+    self._metrics_server.daemon_threads = True
+    threading.Thread(
+        target=self._metrics_server.serve_forever, daemon=True
+    ).start()
+
+  def _stop_metrics(self) -> None:
+    """Writes the final metrics_file and stops exporting metrics."""
+    self._metrics_stop.set()
+    if self._metrics_writer is not None:
+      self._metrics_writer.join()
+      self._metrics_writer = None
+    if self.metrics_file:
+      self._write_metrics_file()
+    if self._metrics_server is not None:
+      self._metrics_server.shutdown()
+      self._metrics_server.server_close()
+      self._metrics_server = None
+
+  def _encode_entry(
       self,
       payload: (
           PlaybookStartMessage
@@ -283,35 +2686,176 @@ class CloudLoggingCollector:
           | PlaybookTaskEndMessage
           | PlaybookEndMessage
       ),
-  ) -> None:
-    """Sends a log entry to Google Cloud Logging."""
-    entry = {
-        "logName": f"projects/{self.project}/logs/{self.log_name}",
-        "resource": {
-            "type": "global",
-            "labels": {
-                "project_id": self.project,
-            },
-        },
-        "jsonPayload": payload,
-    }
-    entries = {"entries": [entry]}
-    resp = self.gcp_session.full_post(
-        "https://logging.googleapis.com/v2/entries:write",
-        json=entries,
+  ) -> str:
+    """Serializes a payload into a Cloud Logging LogEntry.
+
+    Args:
+      payload: The payload to be sent to Google Cloud Logging.
+
+    Returns:
+      The LogEntry as a JSON string.
+    """
+    result = payload.get("result")
+    if isinstance(result, _RawJSON):
+      payload = dict(payload, result=_RAW_JSON_PLACEHOLDER)
+    if self.project:
+      entry = {
+          "logName": f"projects/{self.project}/logs/{self.log_name}",
+          "resource": {
+              "type": "global",
+              "labels": {
+                  "project_id": self.project,
+              },
+          },
+          "jsonPayload": payload,
+      }
+    else:
+      # Local sinks do not need a project, their entries have no log name.
+      entry = {"jsonPayload": payload}
+    data = _json_encode(entry)
+    if isinstance(result, _RawJSON):
+      data = data.replace(f'"{_RAW_JSON_PLACEHOLDER}"', result, 1)
+    return data
+
+  def _backoff_seconds(self, attempt: int, resp: Any) -> float:
+    """Returns the delay before the next attempt of a request.
+
+    Args:
+      attempt: The number of failed attempts so far.
+      resp: The HTTP response of the last attempt, or None.
+
+    Returns:
+      The Retry-After delay if the API sent one, otherwise a random delay up
+      to the exponentially growing, capped backoff ("full jitter").
+    """
+    retry_after = _retry_after_seconds(resp)
+    if retry_after is not None:
+      return min(retry_after, self.retry_max_backoff_seconds)
+    cap = min(
+        self.retry_max_backoff_seconds,
+        self.retry_initial_backoff_seconds * 2 ** (attempt - 1),
     )
-    if resp.status_code != 200:
+    return random.uniform(0, cap)
+
+  def _write_entries(
+      self,
+      entries: list[str],
+      critical: bool = True,
+      deadline: Optional[float] = None,
+  ) -> str:
+    """Sends serialized log entries to Google Cloud Logging in one request.
+
+    partialSuccess is set so that a single rejected entry does not cause the
+    rest of the batch to be dropped. Transient errors are retried until
+    retry_max_attempts or retry_deadline_seconds is reached.
+
+    Args:
+      entries: LogEntry JSON strings as returned by _encode_entry().
+      critical: If False, a failure never terminates the playbook.
+      deadline: time.monotonic() by which to give up, if earlier than
+        retry_deadline_seconds from now.
+
+    Returns:
+      WRITE_OK if the entries have been written, WRITE_REJECTED if the sink
+      rejected them with a non-retryable status, WRITE_FAILED otherwise.
+    """
+    body = self.sink.encode(entries)
+    retry_deadline = time.monotonic() + self.retry_deadline_seconds
+    deadline = retry_deadline if deadline is None else min(deadline, retry_deadline)
+    attempt = 0
+    while True:
+      if self._abandoned.is_set():
+        return WRITE_FAILED
+      resp, error = None, None
+      if self.rate_limiter and not self.rate_limiter.acquire(deadline):
+        error = (
+            "write_requests_per_minute does not allow another request"
+            " within retry_deadline_seconds"
+        )
+        break
+      sent = time.monotonic()
+      try:
+        # A hung connection must not hold up the playbook past the deadline.
+        resp = self.sink.write(
+            body,
+            timeout=max(0.001, min(self.request_timeout_seconds, deadline - sent)),
+        )
+      except Exception as e:
+        # Sinks raise on connection and I/O errors, treat them like any other
+        # transient error.
+        error = e
+      self.metrics.observe_request(
+          str(resp.status_code) if resp is not None else "error",
+          time.monotonic() - sent,
+          len(body),
+          len(entries),
+      )
+      if self._abandoned.is_set():
+        # wait() has already reported the entries as unsent.
+        return WRITE_FAILED
+      if resp is not None and resp.status_code == 200:
+        return WRITE_OK
+      attempt += 1
+      retryable = resp is None or resp.status_code in RETRYABLE_STATUS_CODES
+      delay = self._backoff_seconds(attempt, resp)
+      if (
+          not retryable
+          or attempt >= self.retry_max_attempts
+          or time.monotonic() + delay > deadline
+      ):
+        break
+      with self._stats_lock:
+        self._retries += 1
+      time.sleep(delay)
+
+    if resp is not None:
       print(
           f"Received status code: {resp.status_code}\n"
-          f"Response: {resp.json()}"
+          f"Response: {resp.text}"
       )
-      if not self.ignore_gcp_api_errors:
-        print(
-            "The Ansible playbook execution was terminated due to an error"
-            " encountered while attempting to send execution logs to Google Cloud Logging.",
-            file=sys.stderr,
-        )
-        sys.exit(1)
+    else:
+      print(f"Failed to send execution logs to Google Cloud Logging: {error}")
+    with self._stats_lock:
+      self._failed_events += len(entries)
+      if critical and not self.ignore_gcp_api_errors:
+        self._fatal_error = True
+    if resp is not None and resp.status_code not in RETRYABLE_STATUS_CODES:
+      return WRITE_REJECTED
+    return WRITE_FAILED
+
+  def _terminate(self) -> None:
+    """Terminates the playbook after a Cloud Logging error.
+
+    Must be called from the main thread, sys.exit() in a worker thread
+    would only end that thread.
+    """
+    print(
+        "The Ansible playbook execution was terminated due to an error"
+        " encountered while attempting to send execution logs to Google Cloud Logging.",
+        file=sys.stderr,
+    )
+    if self.enable_async_logging:
+      # Let the workers finish, non-daemon threads would keep the process alive.
+      self.queue.close()
+    sys.exit(1)
+
+  def _send(
+      self,
+      payload: (
+          PlaybookStartMessage
+          | PlaybookTaskStartMessage
+          | PlaybookTaskEndMessage
+          | PlaybookEndMessage
+      ),
+  ) -> None:
+    """Sends a log entry to Google Cloud Logging."""
+    data = self._encode_entry(payload)
+    journal_id = self.journal.append(data) if self.journal else 0
+    if self._write_entries([data]) == WRITE_OK:
+      if self.journal:
+        self.journal.ack([journal_id])
+    elif not self.ignore_gcp_api_errors:
+      self._terminate()
 
   def send(
       self,
@@ -328,28 +2872,295 @@ class CloudLoggingCollector:
     Args:
       payload: The payload to be sent to Google Cloug Logging.
     """
+    if payload is not None and payload["event_type"] == "PLAYBOOK_END":
+      # Sent by wait(), once the counters in its logging_stats are final.
+      self._held_payloads.append(payload)
+      return
     if self.enable_async_logging:
-      self.queue.put(payload)
+      if self._fatal_error:
+        self._terminate()
+      if payload is None:
+        self.queue.close()
+        return
+      event_type = payload["event_type"]
+      data = self._encode_entry(payload)
+      entry = _QueuedEntry(
+          event_type,
+          data,
+          self._shard_for(payload),
+          self.journal.append(data) if self.journal else 0,
+      )
+      if event_type == "PLAYBOOK_START":
+        self._start_queued = True
+      elif not self._start_queued:
+        self._start_sent.set()
+      self.queue.put(entry)
       return
     self._send(payload)
 
-  def consume(self):
-    """Consumes messages from the queue and sends them to Google Cloug Logging."""
-    while True:
-      msg = self.queue.get()
-      # if msg is None ensures that we break out of the loop to finish the
-      # consumer thread, because join() only finishes when the consumer thread
-      # is dead.
-      if msg is None:
+  def _shard_for(self, payload: dict[str, Any]) -> int:
+    """Returns the sender worker for a payload.
+
+    Messages with a host are distributed by host, all other messages go to
+    the first worker.
+    """
+    host = payload.get("host")
+    if not host or self.sender_workers == 1:
+      return 0
+    return hash(host) % self.sender_workers
+
+  def stats(self) -> dict[str, int]:
+    """Returns counters about log messages that did not take the normal path.
+
+    Returns:
+      A dictionary with the number of dropped, spilled and failed log
+      messages, and the number of retried requests.
+    """
+    with self._stats_lock:
+      stats = {
+          "dropped_events": 0,
+          "spilled_events": 0,
+          "failed_events": self._failed_events,
+          "retries": self._retries,
+          "replayed_events": self._replayed_events,
+      }
+    if self.enable_async_logging:
+      stats["dropped_events"] = self.queue.dropped
+      stats["spilled_events"] = self.queue.spilled
+    return stats
+
+  def _next_batch(
+      self, shard: int, first: _QueuedEntry
+  ) -> tuple[list[_QueuedEntry], Optional[_QueuedEntry], bool]:
+    """Collects entries of a shard into a batch starting with the given entry.
+
+    The batch is complete when it holds batch_max_entries entries, when the
+    next entry would exceed batch_max_bytes, or when batch_linger_seconds have
+    passed since the first entry was taken from the queue.
+
+    Args:
+      shard: The shard to take the entries from.
+      first: The entry that opens the batch.
+
+    Returns:
+      A tuple of the batch, the entry that did not fit into the batch (or
+      None) and whether the end-of-queue marker has been received.
+    """
+    batch = [first]
+    size = first.size
+    deadline = time.monotonic() + self.batch_linger_seconds
+    while len(batch) < self.batch_max_entries:
+      remaining = deadline - time.monotonic()
+      if remaining <= 0:
         break
-      self._send(msg)
-      self.queue.task_done()
+      try:
+        entry = self.queue.get(shard, timeout=remaining)
+      except queue.Empty:
+        break
+      if entry is None:
+        return batch, None, True
+      # +1 for the separating comma in the request body.
+      if size + entry.size + 1 > self.batch_max_bytes:
+        return batch, entry, False
+      batch.append(entry)
+      size += entry.size + 1
+    return batch, None, False
+
+  def consume(self, shard: int = 0):
+    """Consumes messages from a shard of the queue and sends them to Google Cloug Logging.
+
+    Args:
+      shard: The shard of the queue owned by this consumer.
+    """
+    pending = None
+    try:
+      while not self._fatal_error and not self._abandoned.is_set():
+        if pending is None:
+          entry = self.queue.get(shard)
+        else:
+          entry, pending = pending, None
+        # if entry is None ensures that we break out of the loop to finish the
+        # consumer thread, because join() only finishes when the consumer thread
+        # is dead.
+        if entry is None:
+          break
+        batch, pending, done = self._next_batch(shard, entry)
+        if shard:
+          self._start_sent.wait()
+        self._in_flight[shard] = batch
+        self._write_batch(batch)
+        self._in_flight.pop(shard, None)
+        if not shard:
+          # PLAYBOOK_START messages are queued in the first shard, so its
+          # first batch carries the first of them.
+          self._start_sent.set()
+        if done:
+          break
+    finally:
+      if not shard:
+        self._start_sent.set()
+      if self._fatal_error:
+        # Wake up a producer blocked on a full queue, so that the main thread
+        # can terminate the playbook.
+        self.queue.close()
+
+  def _write_batch(
+      self, batch: list[_QueuedEntry], deadline: Optional[float] = None
+  ) -> None:
+    """Sends queued entries and acknowledges them in the journal."""
+    outcome = self._write_entries([e.data for e in batch], deadline=deadline)
+    if outcome == WRITE_OK and self.journal:
+      self.journal.ack([e.journal_id for e in batch])
+
+  def _overflow(self, entries: list[_QueuedEntry]) -> None:
+    """Reports the entries that could not be sent within drain_timeout_seconds.
+
+    With a journal, the entries are already in it and sent by the next run.
+    Otherwise, they are written to an overflow file in overflow_dir, one
+    LogEntry per line like the file sink writes them.
+
+    Args:
+      entries: The unsent entries.
+    """
+    reason = (
+        f"{len(entries)} log messages could not be sent within"
+        f" drain_timeout_seconds ({self.drain_timeout_seconds:g}s)"
+    )
+    if self.journal:
+      print(f"{reason}, they are kept in the journal in {self.journal_dir}.")
+      return
+    directory = self.overflow_dir or tempfile.gettempdir()
+    path = os.path.join(
+        directory,
+        f"ansible_cloud_logging-{self.execution_id or uuid.uuid4()}.overflow.jsonl",
+    )
+    try:
+      os.makedirs(directory, exist_ok=True)
+      fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+      with os.fdopen(fd, "w") as f:
+        for e in entries:
+          f.write(e.data + "\n")
+    except OSError as e:
+      print(f"{reason} and are lost, writing {path} failed: {e}")
+      return
+    self.overflow_file = path
+    print(f"{reason}, they were written to {path}.")
+
+  def replay_journals(self) -> None:
+    """Uploads the unacknowledged entries of earlier executions.
+
+    Journals that are still locked by a running playbook are skipped. A
+    journal is deleted once all its entries have been uploaded. A batch that
+    the sink rejects with a non-retryable status would be rejected again on
+    every run, so it is acknowledged, counted as failed and the replay goes
+    on. A transient or transport failure stops the replay, the remaining
+    entries are kept for the next run.
+    """
+    for execution_id in EventJournal.execution_ids(self.journal_dir):
+      if execution_id == self.journal.execution_id:
+        continue
+      try:
+        journal = EventJournal(
+            self.journal_dir,
+            execution_id,
+            segment_max_bytes=self._journal_segment_max_bytes,
+            fsync_interval_seconds=self._journal_fsync_interval_seconds,
+        )
+      except OSError:
+        continue
+      try:
+        for batch in self._replay_batches(journal.pending_entries()):
+          outcome = self._write_entries(
+              [data for _, data in batch], critical=False
+          )
+          if outcome == WRITE_FAILED:
+            return
+          journal.ack([n for n, _ in batch])
+          if outcome == WRITE_OK:
+            with self._stats_lock:
+              self._replayed_events += len(batch)
+      finally:
+        journal.close()
+
+  def _replay_batches(
+      self, pending: list[tuple[int, str]]
+  ) -> Iterator[list[tuple[int, str]]]:
+    """Splits journal entries into batches within the batch limits."""
+    batch, size = [], 0
+    for n, data in pending:
+      if batch and (
+          len(batch) >= self.batch_max_entries
+          or size + len(data) + 1 > self.batch_max_bytes
+      ):
+        yield batch
+        batch, size = [], 0
+      batch.append((n, data))
+      size += len(data) + 1
+    if batch:
+      yield batch
 
   def wait(self):
-    """Waits for the consumer thread to finish."""
+    """Waits for the consumer threads to finish and sends held back messages.
+
+    Also waits for the journal replay and closes the journal. All of this
+    takes at most drain_timeout_seconds, messages that are unsent by then are
+    handed to _overflow().
+    """
+    started = time.monotonic()
+    deadline = None
+    if self.drain_timeout_seconds:
+      deadline = started + self.drain_timeout_seconds
+
+    def remaining() -> Optional[float]:
+      return None if deadline is None else max(0.0, deadline - time.monotonic())
+
     # join() only finishes when the consumer thread finishes not when the queue
     # itself is empty.
-    self.consumer.join()
+    for consumer in self.consumers:
+      consumer.join(remaining())
+    if self.replayer:
+      self.replayer.join(remaining())
+    unsent = []
+    if any(t.is_alive() for t in self.consumers + [self.replayer] if t):
+      # The journals of earlier runs are only read by the replay, they keep
+      # whatever it has not sent yet.
+      self._abandoned.set()
+      if self.enable_async_logging:
+        # Batches in flight may still make it, they are written to the
+        # overflow file as well.
+        unsent = self.queue.take_all() + [
+            e for batch in list(self._in_flight.values()) for e in batch
+        ]
+    self.metrics.unsent_events = len(unsent)
+    self.metrics.drain_seconds = time.monotonic() - started
+    if self._held_payloads and not self._fatal_error:
+      entries = []
+      for payload in self._held_payloads:
+        if "logging_stats" in payload:
+          payload["logging_stats"] = self.stats()
+        if "logging_metrics" in payload:
+          payload["logging_metrics"] = self.metrics.summary()
+        data = self._encode_entry(payload)
+        entries.append(_QueuedEntry(
+            payload["event_type"],
+            data,
+            journal_id=self.journal.append(data) if self.journal else 0,
+        ))
+      if self._abandoned.is_set() or remaining() == 0:
+        unsent += entries
+        self.metrics.unsent_events = len(unsent)
+      else:
+        self._write_batch(entries, deadline)
+      self._held_payloads = []
+    if unsent:
+      self._overflow(unsent)
+    self.metrics.drain_seconds = time.monotonic() - started
+    if self.journal:
+      self.journal.close()
+    self.sink.close()
+    self._stop_metrics()
+    if self._fatal_error:
+      self._terminate()
 
 
 class CallbackModule(callback.CallbackBase):
@@ -360,6 +3171,7 @@ class CallbackModule(callback.CallbackBase):
     # Required for collecting options set via environment variables.
     self.id = str(uuid.uuid4())
     self.start_time = self._time_now()
+    self.started = time.monotonic()
     self.user = getpass.getuser()
     self.start_msg = PlaybookStartMessage(
         id="",
@@ -374,14 +3186,22 @@ class CallbackModule(callback.CallbackBase):
         limit="",
         env={},
     )
-    # self.tasks is a dictionary of tasks where key is (host, task_id).
-    # We use (host, task_id) for identifying a task because a task with
-    # the same ID can run on multiple hosts.
+    # self.tasks is a dictionary of running tasks where key is (host, task_id)
+    # and value is a _TaskRecord. We use (host, task_id) for identifying a
+    # task because a task with the same ID can run on multiple hosts. Records
+    # are removed as soon as the task end event has been sent, so the
+    # dictionary only grows with the number of tasks running in parallel.
     self.tasks = {}
     # The DOCUMENTATION string works as default for the options specified
     # here.
     self.set_options()
     self.project = self.get_option("project")
+    self.sink = self.get_option("sink")
+    if not self.project and self.sink == "cloud_logging":
+      # Without a project there is nowhere to send logs to. Ansible skips
+      # disabled callback plugins, so none of the v2_* functions is called.
+      self.disabled = True
+      return
     self.log_name = self.get_option("log_name")
     # Convert string value from ansible.cfg to a proper boolean
     self.ignore_gcp_api_errors = convert_bool.boolean(self.get_option("ignore_gcp_api_errors"))
@@ -389,6 +3209,7 @@ class CallbackModule(callback.CallbackBase):
     self.enable_async_logging = convert_bool.boolean(
         self.get_option("enable_async_logging")
     )
+    self.enable_batching = convert_bool.boolean(self.get_option("enable_batching"))
     # The optional deployment_name is passed in by Terraform.
     self.deployment_name = os.environ.get("DEPLOYMENT_NAME", "UNSET_DEPLOYMENT_NAME")
 
@@ -397,8 +3218,70 @@ class CallbackModule(callback.CallbackBase):
         log_name=self.log_name,
         enable_async_logging=self.enable_async_logging,
         ignore_gcp_api_errors=self.ignore_gcp_api_errors,
+        enable_batching=self.enable_batching,
+        batch_max_entries=int(self.get_option("batch_max_entries")),
+        batch_max_bytes=int(self.get_option("batch_max_bytes")),
+        batch_linger_seconds=float(self.get_option("batch_linger_seconds")),
+        queue_max_entries=int(self.get_option("queue_max_entries")),
+        queue_max_bytes=int(self.get_option("queue_max_bytes")),
+        queue_overflow_policy=self.get_option("queue_overflow_policy"),
+        spill_dir=self.get_option("spill_dir"),
+        sender_workers=int(self.get_option("sender_workers")),
+        retry_max_attempts=int(self.get_option("retry_max_attempts")),
+        retry_initial_backoff_seconds=float(
+            self.get_option("retry_initial_backoff_seconds")
+        ),
+        retry_max_backoff_seconds=float(
+            self.get_option("retry_max_backoff_seconds")
+        ),
+        retry_deadline_seconds=float(self.get_option("retry_deadline_seconds")),
+        write_requests_per_minute=int(
+            self.get_option("write_requests_per_minute")
+        ),
+        execution_id=self.id,
+        journal_dir=self.get_option("journal_dir"),
+        journal_segment_max_bytes=int(
+            self.get_option("journal_segment_max_bytes")
+        ),
+        journal_fsync_interval_seconds=float(
+            self.get_option("journal_fsync_interval_seconds")
+        ),
+        journal_replay=convert_bool.boolean(self.get_option("journal_replay")),
+        sink=self._make_sink(),
+        metrics_file=self.get_option("metrics_file"),
+        metrics_port=int(self.get_option("metrics_port")),
+        metrics_interval_seconds=float(
+            self.get_option("metrics_interval_seconds")
+        ),
+        request_timeout_seconds=float(
+            self.get_option("request_timeout_seconds")
+        ),
+        drain_timeout_seconds=float(self.get_option("drain_timeout_seconds")),
+        overflow_dir=self.get_option("overflow_dir"),
     )
     self.logging_collector.start_consuming()
+    self.profile_top_n = int(self.get_option("profile_top_n"))
+    self.profile_dir = self.get_option("profile_dir")
+    self.profiler = TaskProfiler(self.profile_top_n)
+    self.history = None
+    if self.get_option("history_db"):
+      self.history = PerformanceHistory(
+          self.get_option("history_db"),
+          baseline_runs=int(self.get_option("history_baseline_runs")),
+          threshold=float(self.get_option("history_slowdown_threshold")),
+      )
+    self.tracer = None
+    if self.get_option("trace_file") or self.get_option("trace_url"):
+      self.tracer = TraceExporter(
+          self.id,
+          path=self.get_option("trace_file"),
+          url=self.get_option("trace_url"),
+          resource_attributes={
+              "service.name": "ansible",
+              "deployment.name": self.deployment_name,
+              "enduser.id": self.user,
+          },
+      )
 
     if self.print_uuid:
       # We register the _print_uuid function with atexit, because we want to
@@ -427,6 +3310,18 @@ class CallbackModule(callback.CallbackBase):
         task_keys=task_keys, var_options=var_options, direct=direct
     )
 
+  def _make_sink(self) -> CloudLoggingSink | HttpSink | FileSink:
+    """Returns the sink selected by the sink option."""
+    if self.sink == "http":
+      return HttpSink(self.get_option("sink_url"))
+    if self.sink == "file":
+      if not self.get_option("sink_path"):
+        raise ValueError("The file sink requires sink_path")
+      return FileSink(self.get_option("sink_path"))
+    if self.sink == "stdout":
+      return FileSink()
+    return CloudLoggingSink(token_cache_file=self.get_option("token_cache_file"))
+
   def _time_now(self) -> str:
     """Returns the current ISO 8601 timestamp for the UTC timezone.
 
@@ -451,12 +3346,76 @@ class CallbackModule(callback.CallbackBase):
         if k.startswith(wanted_prefix) or k in {"PATH", "USER"}
     }
 
+  def _role_name(self, task: ansible.playbook.task.Task) -> str:
+    """Returns the name of the role of a task, empty for playbook tasks."""
+    role = getattr(task, "_role", None)
+    return role.get_name() if role is not None else ""
+
+  def _write_profile(self, profile: dict[str, Any]) -> None:
+    """Writes the profile of the playbook execution to profile_dir.
+
+    Args:
+      profile: The profile returned by TaskProfiler.report().
+    """
+    playbook = self.start_msg["playbook_name"].rpartition(".")[0] or "playbook"
+    path = os.path.join(self.profile_dir, f"{playbook}-{self.id}.json")
+    try:
+      os.makedirs(self.profile_dir, exist_ok=True)
+      with open(path, "w") as f:
+        json.dump(
+            {
+                "id": self.id,
+                "deployment_name": self.deployment_name,
+                "playbook_name": self.start_msg["playbook_name"],
+                "start_time": self.start_time,
+                "end_time": self._time_now(),
+                "profile": profile,
+            },
+            f,
+            indent=2,
+        )
+    except OSError as e:
+      print(f"Failed to write the task profile to {path}: {e}")
+
+  def _check_history(self, end_time: str) -> list[dict[str, Any]]:
+    """Records the task durations in the history and reports regressions.
+
+    Args:
+      end_time: Timestamp when the playbook execution ended.
+
+    Returns:
+      The regressions found by PerformanceHistory.record().
+    """
+    import sqlite3
+
+    durations = self.profiler.task_durations()
+    durations[PerformanceHistory.PLAYBOOK_TASK] = time.monotonic() - self.started
+    try:
+      regressions = self.history.record(
+          self.deployment_name,
+          self.start_msg["file_name"],
+          self.id,
+          end_time,
+          durations,
+      )
+    except (sqlite3.Error, OSError) as e:
+      print(f"Failed to update the performance history {self.history.path}: {e}")
+      return []
+    for r in regressions:
+      self._display.warning(
+          f"Task '{r['task']}' took {r['duration_seconds']:.1f}s, slower than"
+          f" the mean of {r['baseline_mean_seconds']:.1f}s over the last"
+          f" {r['baseline_runs']} runs of {self.start_msg['file_name']}"
+      )
+    return regressions
+
   def _store_result_in_task(
       self, result: ansible.executor.task_result.TaskResult, status: str
   ) -> None:
-    """Helper function to store a result into an already existing task.
+    """Helper function to send the end event of a running task.
 
-    We find the correct task by looking it up via the task ID and the host name.
+    We find the correct task by looking it up via the task ID and the host
+    name, and remove it from the running tasks.
 
     Args:
       result: The result object of type ansible.executor.result.Result
@@ -464,28 +3423,59 @@ class CallbackModule(callback.CallbackBase):
     """
     host = result._host
     task = result._task
+    ended = time.monotonic()
+    end_time = self._time_now()
+    record = self.tasks.pop((host.get_name(), task._uuid), None)
+    if record is None:
+      # Results without a preceding v2_runner_on_start, e.g. of tasks
+      # skipped before they were started.
+      record = _TaskRecord(
+          task._uuid,
+          task.get_name(),
+          self._role_name(task),
+          host.get_name(),
+          end_time,
+          ended,
+      )
+    self.profiler.add(record, status, ended - record.started)
 
-    result_data = result._result.copy()
-    # Replace results that exceed Cloud Logging's 256KB payload limit with a warning
-    serialized = json.dumps(result_data)
-    if len(serialized.encode('utf-8')) > MAX_RESULT_SIZE:
-        result_data = {
-            "warning": f"Result omitted because it exceeded {MAX_RESULT_SIZE} bytes",
-        }
-    self.tasks[(host.get_name(), task._uuid)]["result"] = result_data
-    self.tasks[(host.get_name(), task._uuid)]["end_time"] = self._time_now()
-    self.tasks[(host.get_name(), task._uuid)]["status"] = status
+    result_data = result._result
+    t = PlaybookTaskEndMessage(
+        id=self.id,
+        event_type="PLAYBOOK_TASK_END",
+        task_id=record.task_id,
+        name=record.name,
+        host=record.host,
+        start_time=record.start_time,
+        end_time=end_time,
+        status=status,
+        # Results are serialized here, truncated to Cloud Logging's 256KB
+        # payload limit if needed, and embedded as is into the log entry.
+        result=_serialize_result(result_data),
+        # WLM fields
+        state="",
+        step_name=record.name,
+        timestamp=record.start_time,
+        deployment_name=self.deployment_name,
+        error_message="",
+        loop_stats=record.loop.report() if record.loop is not None else {},
+    )
      # Setting WLM fields
     if status == "failed":
-      self.tasks[(host.get_name(), task._uuid)]["state"] = "failed"
-      self.tasks[(host.get_name(), task._uuid)]["error_message"] = result_data.get("stderr") or result_data.get("msg") or "No error message found in result (neither 'stderr' nor 'msg' present)."
+      t["state"] = "failed"
+      error_message = result_data.get("stderr") or result_data.get("msg") or "No error message found in result (neither 'stderr' nor 'msg' present)."
+      if isinstance(error_message, str):
+        error_message = _tail(error_message, MAX_ERROR_MESSAGE_SIZE)
+      t["error_message"] = error_message
     elif status == "unreachable":
-      self.tasks[(host.get_name(), task._uuid)]["state"] = "failed"
-      self.tasks[(host.get_name(), task._uuid)]["error_message"] = "unreachable host"
+      t["state"] = "failed"
+      t["error_message"] = "unreachable host"
     elif status == "ok" or status == "skipped":
-      self.tasks[(host.get_name(), task._uuid)]["state"] = "success"
+      t["state"] = "success"
 
-    self.logging_collector.send(self.tasks[(host.get_name(), task._uuid)])
+    if self.tracer is not None:
+      self.tracer.add_host(record, status, ended, str(t["error_message"]))
+    self.logging_collector.send(t)
 
   def v2_playbook_on_start(self, playbook: ansible.playbook.Playbook) -> None:
     """Plugin function that gets called when a playbook starts.
@@ -529,6 +3519,8 @@ class CallbackModule(callback.CallbackBase):
     vm = play.get_variable_manager()
     self.start_msg["extra_vars"] = vm.extra_vars
     self.logging_collector.send(self.start_msg)
+    if self.tracer is not None:
+      self.tracer.start_play(play.get_name(), time.monotonic())
 
   def v2_runner_on_start(
       self, host: ansible.inventory.host.Host, task: ansible.playbook.task.Task
@@ -539,6 +3531,7 @@ class CallbackModule(callback.CallbackBase):
       host: The host object of type ansible.host.host
       task: The task object of type ansible.executor.task.Task
     """
+    started = time.monotonic()
     time_now = self._time_now()
     self.logging_collector.send(
         PlaybookTaskStartMessage(
@@ -556,34 +3549,79 @@ class CallbackModule(callback.CallbackBase):
         )
     )
 
-    # Starts constructing event for task end.
-    t = PlaybookTaskEndMessage(
-        id="",
-        event_type="PLAYBOOK_TASK_END",
-        task_id="",
-        name="",
-        host="",
-        start_time="",
-        end_time="",
-        status="",
-        result={},
-        # WLM fields
-        state="",
-        step_name="",
-        timestamp="",
-        deployment_name="",
-        error_message="",
+    # Only keeps what is needed to construct the event for task end.
+    self.tasks[(host.get_name(), task._uuid)] = _TaskRecord(
+        task._uuid,
+        task.get_name(),
+        self._role_name(task),
+        host.get_name(),
+        time_now,
+        started,
     )
-    t["id"] = self.id
-    t["task_id"] = task._uuid
-    t["name"] = task.get_name()
-    t["host"] = host.get_name()
-    t["start_time"] = time_now
-    # WLM fields
-    t["step_name"] = task.get_name()
-    t["timestamp"] = time_now
-    t["deployment_name"] = self.deployment_name
-    self.tasks[(host.get_name(), task._uuid)] = t
+
+  def _loop_stats(
+      self, result: ansible.executor.task_result.TaskResult
+  ) -> Optional[_LoopStats]:
+    """Returns the _LoopStats of a running task, creating them if needed.
+
+    Args:
+      result: The item or retry result object of the task.
+
+    Returns:
+      None if the task is not running, e.g. if its start was not reported.
+    """
+    record = self.tasks.get((result._host.get_name(), result._task._uuid))
+    if record is None:
+      return None
+    if record.loop is None:
+      record.loop = _LoopStats(record.started)
+    return record.loop
+
+  def _store_item_result(
+      self, result: ansible.executor.task_result.TaskResult, status: str
+  ) -> None:
+    """Helper function to add the result of a loop item to its task.
+
+    Items are not logged individually, they are aggregated and sent with the
+    end event of their task.
+
+    Args:
+      result: The result object of type ansible.executor.result.Result
+      status: The status of the item (ok, failed or skipped)
+    """
+    loop = self._loop_stats(result)
+    if loop is not None:
+      loop.add_item(status, time.monotonic())
+
+  def v2_runner_item_on_ok(
+      self, result: ansible.executor.task_result.TaskResult
+  ) -> None:
+    """Plugin function that gets called when a loop item succeeds."""
+    self._store_item_result(result, "ok")
+
+  def v2_runner_item_on_failed(
+      self, result: ansible.executor.task_result.TaskResult
+  ) -> None:
+    """Plugin function that gets called when a loop item fails."""
+    self._store_item_result(result, "failed")
+
+  def v2_runner_item_on_skipped(
+      self, result: ansible.executor.task_result.TaskResult
+  ) -> None:
+    """Plugin function that gets called when a loop item is skipped."""
+    self._store_item_result(result, "skipped")
+
+  def v2_runner_retry(
+      self, result: ansible.executor.task_result.TaskResult
+  ) -> None:
+    """Plugin function that gets called when a task or item is retried.
+
+    Args:
+      result: The result object of the failed attempt.
+    """
+    loop = self._loop_stats(result)
+    if loop is not None:
+      loop.retries += 1
 
   def v2_runner_on_failed(
       self,
@@ -645,6 +3683,10 @@ class CallbackModule(callback.CallbackBase):
         start_time="",
         end_time="",
         stats={},
+        logging_stats={},
+        logging_metrics={},
+        profile={},
+        regressions=[],
         # WLM fields
         state="playbook_end",
         deployment_name="",
@@ -662,6 +3704,14 @@ class CallbackModule(callback.CallbackBase):
     msg["start_time"] = self.start_time
     msg["end_time"] = self._time_now()
     msg["stats"] = summary
+    msg["logging_stats"] = self.logging_collector.stats()
+    msg["logging_metrics"] = self.logging_collector.metrics.summary()
+    if self.profile_top_n > 0:
+      msg["profile"] = self.profiler.report()
+      if self.profile_dir:
+        self._write_profile(msg["profile"])
+    if self.history is not None:
+      msg["regressions"] = self._check_history(msg["end_time"])
     # WLM fields
     msg["deployment_name"] = self.deployment_name
     msg["timestamp"] = self._time_now()
@@ -674,7 +3724,25 @@ class CallbackModule(callback.CallbackBase):
       'skipped': stats.skipped,
     }
     msg["file_name"] = self.start_msg["file_name"]
+    if self.tracer is not None:
+      self.tracer.finish(
+          self.start_msg["playbook_name"],
+          self.started,
+          time.monotonic(),
+          {"ansible.execution_id": self.id, "ansible.check": self.start_msg["check"]},
+      )
     self.logging_collector.send(msg)
     if self.enable_async_logging:
       self.logging_collector.send(None)
-      self.logging_collector.wait()
+    self.logging_collector.wait()
+    summary = self.logging_collector.metrics.summary()
+    latency = summary["send_latency_seconds"]
+    self._display.v(
+        f"ansible_cloud_logging: {summary['entries_sent']} entries and"
+        f" {summary['bytes_sent']} bytes sent in {summary['requests']} requests,"
+        f" {summary['request_errors']} failed requests,"
+        f" {self.logging_collector.stats()['retries']} retries, send latency"
+        f" p50 {latency.get('p50', 0):.3f}s p99 {latency.get('p99', 0):.3f}s,"
+        f" drained in {summary['drain_seconds']:.1f}s with"
+        f" {summary['unsent_events']} entries left unsent"
+    )
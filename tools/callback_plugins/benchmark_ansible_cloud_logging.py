@@ -0,0 +1,257 @@
+#!/usr/bin/python3
+"""Benchmarks the ansible_cloud_logging callback plugin with a synthetic playbook run.
+
+The plugin is loaded through Ansible's callback loader and driven with fake
+hosts, tasks and results. By default, log entries are sent to a session that
+accepts every request without network I/O, so the numbers reflect the
+controller side of the plugin only. With --sink http, they are posted by the
+http sink to a local FakeCloudLoggingServer, and with --sink file written by
+the file sink to a temporary file.
+
+With --startup, it instead measures how long loading the plugin takes in a
+fresh interpreter, which is paid by every ansible-playbook call, with and
+without a project configured.
+
+Sample usage:
+
+  python3 tools/callback_plugins/benchmark_ansible_cloud_logging.py --events 100000
+  python3 tools/callback_plugins/benchmark_ansible_cloud_logging.py --startup
+"""
+import argparse
+import os
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from unittest import mock
+import uuid
+
+from ansible.executor.stats import AggregateStats
+from ansible.plugins.loader import callback_loader
+
+from fake_cloud_logging import FakeCloudLoggingServer
+
+PLUGIN_DIR = os.path.dirname(os.path.abspath(__file__))
+GCP_UTILS = 'ansible_collections.google.cloud.plugins.module_utils.gcp_utils'
+
+# Loads the plugin in a fresh interpreter and prints the time it took, and
+# whether the google.cloud collection was imported.
+STARTUP_SCRIPT = f"""
+import sys, time
+from ansible.plugins.loader import callback_loader
+callback_loader.add_directory({PLUGIN_DIR!r})
+started = time.perf_counter()
+plugin = callback_loader.get('ansible_cloud_logging')
+elapsed = time.perf_counter() - started
+imported = {GCP_UTILS!r} in sys.modules
+if not plugin.disabled:
+    plugin.logging_collector.send(None)
+    plugin.logging_collector.wait()
+print(elapsed, imported)
+"""
+
+
+class FakeResponse:
+    status_code = 200
+    headers = {}
+    text = '{}'
+
+
+class NullSession:
+    """Accepts every entries:write request without sending it."""
+
+    def __init__(self):
+        self.requests = 0
+
+    def full_post(self, url, data=None, **kwargs):
+        self.requests += 1
+        return FakeResponse()
+
+
+class FakeHost:
+
+    def __init__(self, name):
+        self.name = name
+
+    def get_name(self):
+        return self.name
+
+
+class FakeTask:
+
+    def __init__(self, name):
+        self._uuid = str(uuid.uuid4())
+        self.name = name
+
+    def get_name(self):
+        return self.name
+
+
+class FakeResult:
+
+    def __init__(self, host, task, result):
+        self._host = host
+        self._task = task
+        self._result = result
+
+
+class FakePlaybook:
+    _file_name = '/toolkit/install-sw.yml'
+    _basedir = '/toolkit'
+
+
+class FakePlay:
+
+    def get_variable_manager(self):
+        return mock.Mock(extra_vars={})
+
+
+def rss_mb() -> float:
+    """Returns the current resident set size of the process in MB."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except OSError:
+        # Peak instead of current RSS, in KB on Linux and bytes on macOS.
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss / 2**20 if sys.platform == 'darwin' else maxrss / 2**10
+
+
+def load_plugin():
+    """Loads the callback plugin, with a NullSession for the cloud_logging sink."""
+    os.environ.setdefault('ANSIBLE_CLOUD_LOGGING_PROJECT', 'benchmark-project')
+    callback_loader.add_directory(PLUGIN_DIR)
+    plugin = callback_loader.get('ansible_cloud_logging')
+    if plugin.sink == 'cloud_logging':
+        plugin.logging_collector.sink.gcp_session = NullSession()
+    return plugin
+
+
+def startup(runs: int) -> None:
+    """Prints the median time it takes to load the plugin in a new process.
+
+    Args:
+      runs: Number of processes started per configuration.
+    """
+    print(f'{"project":>18} {"load_ms":>10} {"gcp_utils_imported":>20}')
+    for project in ('benchmark-project', ''):
+        env = dict(os.environ, ANSIBLE_CLOUD_LOGGING_PROJECT=project)
+        times = []
+        for _ in range(runs):
+            out = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT], env=env,
+                                 check=True, capture_output=True, text=True).stdout
+            elapsed, imported = out.split()[-2:]
+            times.append(float(elapsed))
+        print(f'{project or "unset":>18} {statistics.median(times) * 1000:>10.1f} {imported:>20}')
+
+
+def run(events: int, hosts: int, result_size: int, samples: int) -> tuple[list[tuple[int, float]], dict]:
+    """Runs a synthetic playbook and samples the RSS along the way.
+
+    Args:
+      events: Number of task start and task end events, in total.
+      hosts: Number of hosts each task runs on.
+      result_size: Size of the stdout of each task result in bytes.
+      samples: Number of RSS samples.
+
+    Returns:
+      A list of (events sent, RSS in MB) tuples, and the summary of the
+      plugin's PipelineMetrics.
+    """
+    plugin = load_plugin()
+    plugin.v2_playbook_on_start(FakePlaybook())
+    plugin.v2_playbook_on_play_start(FakePlay())
+    host_objs = [FakeHost(f'node-{i}') for i in range(hosts)]
+    stats = AggregateStats()
+    rss = [(0, rss_mb())]
+    sent = 0
+    interval = max(1, events // samples)
+    task_no = 0
+    while sent < events:
+        task = FakeTask(f'task {task_no % 500}')
+        task_no += 1
+        for host in host_objs:
+            plugin.v2_runner_on_start(host, task)
+        for host in host_objs:
+            result = {'rc': 0, 'changed': True, 'stdout': 'x' * result_size}
+            plugin.v2_runner_on_ok(FakeResult(host, task, result))
+            stats.increment('ok', host.get_name())
+        for _ in range(2 * hosts):
+            sent += 1
+            if sent % interval == 0:
+                rss.append((sent, rss_mb()))
+    plugin.v2_playbook_on_stats(stats)
+    rss.append((sent, rss_mb()))
+    return rss, plugin.logging_collector.metrics.summary()
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument('--events', type=int, default=100000, help='Number of task events')
+    ap.add_argument('--hosts', type=int, default=4, help='Number of hosts per task')
+    ap.add_argument('--result-size', type=int, default=4096, help='Size of each task result in bytes')
+    ap.add_argument('--samples', type=int, default=10, help='Number of RSS samples')
+    ap.add_argument('--max-growth-mb', type=float,
+                    help='Fail if RSS grows by more than this after the first sample, 32 MB by'
+                         ' default, plus the queue_max_bytes of 64 MB with --sink http or file')
+    ap.add_argument('--sink', choices=['null', 'http', 'file'], default='null',
+                    help='Send entries nowhere, to a local FakeCloudLoggingServer or to a file')
+    ap.add_argument('--startup', action='store_true', help='Measure the time to load the plugin instead')
+    ap.add_argument('--startup-runs', type=int, default=10, help='Number of processes per --startup configuration')
+    args = ap.parse_args()
+    if args.max_growth_mb is None:
+        # Sinks slower than the playbook fill the queue up to queue_max_bytes.
+        args.max_growth_mb = 32 if args.sink == 'null' else 32 + 64
+
+    if args.startup:
+        startup(args.startup_runs)
+        return
+
+    server, directory = None, None
+    if args.sink == 'http':
+        server = FakeCloudLoggingServer(record=False).start()
+        os.environ['ANSIBLE_CLOUD_LOGGING_SINK'] = 'http'
+        os.environ['ANSIBLE_CLOUD_LOGGING_SINK_URL'] = server.url
+    elif args.sink == 'file':
+        directory = tempfile.mkdtemp()
+        os.environ['ANSIBLE_CLOUD_LOGGING_SINK'] = 'file'
+        os.environ['ANSIBLE_CLOUD_LOGGING_SINK_PATH'] = os.path.join(directory, 'entries.jsonl')
+
+    started = time.monotonic()
+    rss, metrics = run(args.events, args.hosts, args.result_size, args.samples)
+    elapsed = time.monotonic() - started
+
+    if server:
+        server.stop()
+        print(f'Server received {server.requests} requests ({server.requests / elapsed:.0f}/s),'
+              f' {server.entry_count} entries ({server.entry_count / elapsed:.0f}/s),'
+              f' {server.bytes / 2**20:.1f} MB ({server.bytes / 2**20 / elapsed:.1f} MB/s)')
+    if metrics['requests']:
+        latency = metrics['send_latency_seconds']
+        print(f'Send latency p50 {latency["p50"] * 1000:.1f} ms, p99 {latency["p99"] * 1000:.1f} ms,'
+              f' max {latency["max"] * 1000:.1f} ms, {metrics["request_errors"]} failed requests,'
+              f' end-of-playbook drain {metrics["drain_seconds"]:.2f}s, {metrics["unsent_events"]} unsent')
+    if directory:
+        size = os.path.getsize(os.environ['ANSIBLE_CLOUD_LOGGING_SINK_PATH'])
+        print(f'File sink wrote {size / 2**20:.1f} MB ({size / 2**20 / elapsed:.1f} MB/s)')
+        shutil.rmtree(directory)
+
+    print(f'{"events":>10} {"rss_mb":>10}')
+    for events, mb in rss:
+        print(f'{events:>10} {mb:>10.1f}')
+    # The first sample after warm-up is the baseline: it includes the queue
+    # filling up to its steady state.
+    baseline = rss[1][1]
+    growth = max(mb for _, mb in rss[1:]) - baseline
+    print(f'{args.events} events in {elapsed:.1f}s ({args.events / elapsed:.0f} events/s),'
+          f' RSS growth after warm-up: {growth:.1f} MB')
+    if growth > args.max_growth_mb:
+        print(f'RSS grew by more than {args.max_growth_mb} MB', file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
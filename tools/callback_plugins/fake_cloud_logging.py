@@ -0,0 +1,101 @@
+#!/usr/bin/python3
+"""Local stand-in for the entries:write method of Google Cloud Logging.
+
+Used by the tests and benchmarks of the ansible_cloud_logging callback
+plugin, with its http sink pointed at the server. It can also be started on
+its own to receive the log entries of a real playbook run:
+
+  python3 tools/callback_plugins/fake_cloud_logging.py --port 8080
+  ANSIBLE_CLOUD_LOGGING_SINK=http \
+  ANSIBLE_CLOUD_LOGGING_SINK_URL=http://127.0.0.1:8080/v2/entries:write \
+  ansible-playbook ...
+"""
+import argparse
+import http.server
+import json
+import threading
+import time
+
+
+class FakeCloudLoggingServer:
+    """Accepts entries:write requests on a local port.
+
+    The first `throttled` requests are answered with `status` and a
+    Retry-After header, -1 rejects all requests. Accepted requests are
+    counted, and their entries recorded unless record is False. With a delay,
+    every response is held back for that many seconds, like a hung
+    connection.
+    """
+
+    def __init__(self, port=0, throttled=0, status=429, retry_after='0.05', record=True, delay=0):
+        self.throttled = throttled
+        self.status = status
+        self.retry_after = retry_after
+        self.record = record
+        self.delay = delay
+        self.entries = []
+        self.requests = 0
+        self.entry_count = 0
+        self.bytes = 0
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                if server.delay:
+                    time.sleep(server.delay)
+                with server.lock:
+                    rejected = server.throttled != 0
+                    if rejected:
+                        server.throttled -= 1
+                    else:
+                        entries = json.loads(body)['entries']
+                        server.requests += 1
+                        server.entry_count += len(entries)
+                        server.bytes += len(body)
+                        if server.record:
+                            server.entries.extend(entries)
+                self.send_response(server.status if rejected else 200)
+                if rejected and server.retry_after is not None:
+                    self.send_header('Retry-After', server.retry_after)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', '2')
+                self.end_headers()
+                self.wfile.write(b'{}')
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.httpd.daemon_threads = True
+        self.url = 'http://127.0.0.1:%d/v2/entries:write' % self.httpd.server_port
+
+    def start(self):
+        """Serves requests in a background thread."""
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument('--port', type=int, default=8080, help='Port to listen on')
+    args = ap.parse_args()
+
+    server = FakeCloudLoggingServer(port=args.port, record=False)
+    print(f'Listening on {server.url}')
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(f'{server.requests} requests, {server.entry_count} entries, {server.bytes} bytes')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,1058 @@
+import datetime
+import http.server
+import json
+import os
+import queue
+import random
+import shutil
+import socket
+import stat
+import tempfile
+import threading
+import time
+import unittest
+import urllib.request
+import uuid
+from unittest.mock import Mock, patch
+
+from ansible.executor.stats import AggregateStats
+from ansible.plugins.loader import callback_loader
+
+import ansible_cloud_logging
+from ansible_cloud_logging import BoundedEventQueue
+from ansible_cloud_logging import CloudLoggingCollector
+from ansible_cloud_logging import CloudLoggingSink
+from ansible_cloud_logging import EventJournal
+from ansible_cloud_logging import FileSink
+from ansible_cloud_logging import HttpSink
+from ansible_cloud_logging import PerformanceHistory
+from ansible_cloud_logging import TaskProfiler
+from ansible_cloud_logging import TraceExporter
+from ansible_cloud_logging import _LoopStats
+from ansible_cloud_logging import _QueuedEntry
+from ansible_cloud_logging import _TaskRecord
+from ansible_cloud_logging import _TokenBucket
+from ansible_cloud_logging import _retry_after_seconds
+from ansible_cloud_logging import _serialize_result
+from fake_cloud_logging import FakeCloudLoggingServer
+
+
+class FakeResponse:
+
+    def __init__(self, status_code=200, body=None, headers=None):
+        self.status_code = status_code
+        self._body = body or {}
+        self.headers = headers or {}
+        self.text = json.dumps(self._body)
+
+    def json(self):
+        return self._body
+
+
+class FakeSession:
+    """Records entries:write requests instead of sending them."""
+
+    def __init__(self, delay=0):
+        self.requests = []
+        self.delay = delay
+        self.lock = threading.Lock()
+
+    def full_post(self, url, data=None, **kwargs):
+        if self.delay:
+            time.sleep(random.uniform(0, self.delay))
+        with self.lock:
+            self.requests.append(json.loads(data))
+        return FakeResponse()
+
+    def entries(self):
+        return [e for r in self.requests for e in r['entries']]
+
+
+class TestCloudLoggingCollector(unittest.TestCase):
+
+    def _make_collector(self, **kwargs):
+        collector = CloudLoggingCollector(
+            project='my-project',
+            log_name='ansible_cloud_logging',
+            **kwargs,
+        )
+        if isinstance(collector.sink, CloudLoggingSink):
+            collector.sink.gcp_session = FakeSession()
+        return collector
+
+    def _payload(self, i, size=0):
+        return {'id': 'run', 'event_type': 'PLAYBOOK_TASK_START', 'task_id': str(i), 'pad': 'x' * size}
+
+    def _run(self, collector, payloads):
+        collector.start_consuming()
+        for p in payloads:
+            collector.send(p)
+        collector.send(None)
+        collector.wait()
+
+    def test_sync_sends_one_request_per_event(self):
+        collector = self._make_collector(enable_async_logging=False)
+        for i in range(3):
+            collector.send(self._payload(i))
+        self.assertEqual(len(collector.sink.gcp_session.requests), 3)
+        entry = collector.sink.gcp_session.requests[0]['entries'][0]
+        self.assertEqual(entry['logName'], 'projects/my-project/logs/ansible_cloud_logging')
+        self.assertEqual(entry['jsonPayload']['task_id'], '0')
+
+    def test_batching_groups_entries_by_count(self):
+        collector = self._make_collector(
+            enable_async_logging=True, enable_batching=True,
+            batch_max_entries=10, batch_linger_seconds=5)
+        self._run(collector, [self._payload(i) for i in range(25)])
+        session = collector.sink.gcp_session
+        self.assertEqual([len(r['entries']) for r in session.requests], [10, 10, 5])
+        self.assertEqual([e['jsonPayload']['task_id'] for e in session.entries()],
+                         [str(i) for i in range(25)])
+
+    def test_batching_respects_byte_budget(self):
+        collector = self._make_collector(
+            enable_async_logging=True, enable_batching=True,
+            batch_max_entries=100, batch_max_bytes=3000, batch_linger_seconds=5)
+        self._run(collector, [self._payload(i, size=1000) for i in range(6)])
+        session = collector.sink.gcp_session
+        self.assertEqual([len(r['entries']) for r in session.requests], [2, 2, 2])
+        self.assertEqual(len(session.entries()), 6)
+
+    def test_sender_workers_keep_host_order_and_playbook_bracket(self):
+        collector = self._make_collector(
+            enable_async_logging=True, enable_batching=True,
+            batch_max_entries=3, batch_linger_seconds=0.01, sender_workers=4)
+        collector.sink.gcp_session = FakeSession(delay=0.01)
+        payloads = [{'event_type': 'PLAYBOOK_START'}]
+        for task in range(20):
+            for host in ('node1', 'node2', 'node3', 'node4', 'node5'):
+                payloads.append({'event_type': 'PLAYBOOK_TASK_START', 'host': host, 'task_id': str(task)})
+                payloads.append({'event_type': 'PLAYBOOK_TASK_END', 'host': host, 'task_id': str(task)})
+        payloads.append({'event_type': 'PLAYBOOK_END'})
+        self._run(collector, payloads)
+
+        sent = [e['jsonPayload'] for e in collector.sink.gcp_session.entries()]
+        self.assertEqual(len(sent), len(payloads))
+        self.assertEqual(sent[0]['event_type'], 'PLAYBOOK_START')
+        self.assertEqual(sent[-1]['event_type'], 'PLAYBOOK_END')
+        for host in ('node1', 'node2', 'node3', 'node4', 'node5'):
+            self.assertEqual([p for p in sent if p.get('host') == host],
+                             [p for p in payloads if p.get('host') == host])
+
+    def test_retries_throttled_requests_without_losing_events(self):
+        server = FakeCloudLoggingServer(throttled=6, status=429, retry_after='0.05').start()
+        self.addCleanup(server.stop)
+        collector = self._make_collector(
+            enable_async_logging=True, enable_batching=True, batch_max_entries=5,
+            batch_linger_seconds=0.01, sender_workers=2, retry_deadline_seconds=2,
+            retry_initial_backoff_seconds=0.01, queue_max_entries=10,
+            sink=HttpSink(server.url, timeout=5))
+        payloads = [{'event_type': 'PLAYBOOK_START'}]
+        payloads += [{'event_type': 'PLAYBOOK_TASK_END', 'host': f'node{i % 3}', 'task_id': str(i)}
+                     for i in range(60)]
+        collector.start_consuming()
+        slowest = 0
+        for p in payloads:
+            started = time.monotonic()
+            collector.send(p)
+            slowest = max(slowest, time.monotonic() - started)
+        collector.send(None)
+        collector.wait()
+
+        self.assertLess(slowest, collector.retry_deadline_seconds)
+        sent = [e['jsonPayload'] for e in server.entries]
+        self.assertCountEqual(sent, payloads)
+        stats = collector.stats()
+        self.assertGreaterEqual(stats['retries'], 6)
+        self.assertEqual(stats['failed_events'], 0)
+
+    def test_gives_up_at_retry_deadline(self):
+        server = FakeCloudLoggingServer(throttled=-1, status=503, retry_after=None).start()
+        self.addCleanup(server.stop)
+        collector = self._make_collector(
+            enable_async_logging=False, ignore_gcp_api_errors=True,
+            retry_max_attempts=100, retry_initial_backoff_seconds=0.05,
+            retry_max_backoff_seconds=0.1, retry_deadline_seconds=0.5,
+            sink=HttpSink(server.url, timeout=5))
+        started = time.monotonic()
+        collector.send(self._payload(0))
+        self.assertLess(time.monotonic() - started, 1.5)
+        self.assertEqual(collector.stats()['failed_events'], 1)
+        self.assertGreater(collector.stats()['retries'], 0)
+
+    def test_http_sink_batches_to_local_server(self):
+        server = FakeCloudLoggingServer().start()
+        self.addCleanup(server.stop)
+        collector = self._make_collector(
+            enable_async_logging=True, enable_batching=True, batch_max_entries=10,
+            batch_linger_seconds=0.01, sink=HttpSink(server.url, timeout=5))
+        payloads = [self._payload(i) for i in range(25)]
+        self._run(collector, payloads)
+        self.assertEqual(server.requests, 3)
+        self.assertEqual([e['jsonPayload'] for e in server.entries], payloads)
+
+    def test_file_sink_appends_json_lines(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'logs', 'entries.jsonl')
+        for _ in range(2):
+            collector = self._make_collector(
+                enable_async_logging=True, enable_batching=True, batch_max_entries=4,
+                batch_linger_seconds=0.01, sink=FileSink(path))
+            self._run(collector, [self._payload(i) for i in range(10)])
+        with open(path) as f:
+            sent = [json.loads(line)['jsonPayload']['task_id'] for line in f]
+        self.assertEqual(sent, [str(i) for i in range(10)] * 2)
+
+    def test_sink_errors_are_retried(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        collector = self._make_collector(
+            enable_async_logging=False, retry_initial_backoff_seconds=0,
+            sink=FileSink(os.path.join(directory, 'entries.jsonl')))
+        with patch('builtins.open', side_effect=[OSError('disk full'), OSError('disk full'),
+                                                 open(os.devnull, 'ab')]):
+            collector.send(self._payload(0))
+        self.assertEqual(collector.stats()['retries'], 2)
+        self.assertEqual(collector.stats()['failed_events'], 0)
+
+    def test_client_errors_are_not_retried(self):
+        collector = self._make_collector(enable_async_logging=False, ignore_gcp_api_errors=True)
+        collector.sink.gcp_session.full_post = lambda *args, **kwargs: FakeResponse(400)
+        collector.send(self._payload(0))
+        self.assertEqual(collector.stats(), {
+            'dropped_events': 0, 'spilled_events': 0, 'failed_events': 1, 'retries': 0,
+            'replayed_events': 0})
+
+    def test_api_error_terminates_playbook_from_main_thread(self):
+        collector = self._make_collector(
+            enable_async_logging=True, ignore_gcp_api_errors=False, sender_workers=2)
+        collector.sink.gcp_session.full_post = lambda *args, **kwargs: FakeResponse(403)
+        collector.start_consuming()
+        collector.send({'event_type': 'PLAYBOOK_START'})
+        collector.send(None)
+        with self.assertRaises(SystemExit):
+            collector.wait()
+        for consumer in collector.consumers:
+            self.assertFalse(consumer.is_alive())
+
+    def test_retry_after_header(self):
+        self.assertEqual(_retry_after_seconds(FakeResponse(429, headers={'Retry-After': '2'})), 2)
+        self.assertEqual(_retry_after_seconds(
+            FakeResponse(429, headers={'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'})), 0)
+        self.assertIsNone(_retry_after_seconds(FakeResponse(429)))
+        self.assertIsNone(_retry_after_seconds(None))
+
+    def test_token_bucket_limits_rate(self):
+        bucket = _TokenBucket(rate=50, capacity=1)
+        started = time.monotonic()
+        for _ in range(6):
+            bucket.acquire()
+        self.assertGreaterEqual(time.monotonic() - started, 0.09)
+
+    def test_token_bucket_respects_deadline(self):
+        bucket = _TokenBucket(rate=1, capacity=1)
+        self.assertTrue(bucket.acquire(deadline=time.monotonic() + 0.1))
+        started = time.monotonic()
+        self.assertFalse(bucket.acquire(deadline=started + 0.5))
+        self.assertLess(time.monotonic() - started, 0.1)
+
+    def test_rate_limit_does_not_wait_past_deadline(self):
+        collector = self._make_collector(
+            enable_async_logging=False, ignore_gcp_api_errors=True,
+            write_requests_per_minute=1, retry_deadline_seconds=0.5)
+        started = time.monotonic()
+        collector.send(self._payload(0))
+        collector.send(self._payload(1))
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertEqual(collector.stats()['failed_events'], 1)
+
+    def test_hung_request_times_out_at_deadline(self):
+        server = FakeCloudLoggingServer(delay=5).start()
+        self.addCleanup(server.stop)
+        collector = self._make_collector(
+            enable_async_logging=False, ignore_gcp_api_errors=True,
+            retry_deadline_seconds=0.5, sink=HttpSink(server.url))
+        started = time.monotonic()
+        collector.send(self._payload(0))
+        self.assertLess(time.monotonic() - started, 1.5)
+        self.assertEqual(collector.stats()['failed_events'], 1)
+
+    def test_each_attempt_has_request_timeout(self):
+        server = FakeCloudLoggingServer(delay=5).start()
+        self.addCleanup(server.stop)
+        collector = self._make_collector(
+            enable_async_logging=False, ignore_gcp_api_errors=True, retry_max_attempts=2,
+            retry_initial_backoff_seconds=0, request_timeout_seconds=0.2,
+            sink=HttpSink(server.url))
+        started = time.monotonic()
+        collector.send(self._payload(0))
+        self.assertLess(time.monotonic() - started, 1.5)
+        self.assertEqual(collector.metrics.requests['error'], 2)
+
+    def _drain_hung_sink(self, **kwargs):
+        server = FakeCloudLoggingServer(delay=5).start()
+        self.addCleanup(server.stop)
+        collector = self._make_collector(
+            enable_async_logging=True, ignore_gcp_api_errors=True, sender_workers=2,
+            drain_timeout_seconds=0.5, execution_id='6f1c2b8e-run', sink=HttpSink(server.url),
+            **kwargs)
+        collector.start_consuming()
+        for i in range(5):
+            collector.send(dict(self._payload(i), host=f'node-{i}'))
+        collector.send({'id': 'run', 'event_type': 'PLAYBOOK_END', 'logging_metrics': {}})
+        collector.send(None)
+        started = time.monotonic()
+        collector.wait()
+        self.assertLess(time.monotonic() - started, 1.5)
+        self.assertEqual(collector.metrics.unsent_events, 6)
+        self.assertGreaterEqual(collector.metrics.drain_seconds, 0.5)
+        return collector
+
+    def test_drain_timeout_writes_unsent_entries_to_overflow_file(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        collector = self._drain_hung_sink(overflow_dir=directory)
+        self.assertEqual(collector.overflow_file,
+                         os.path.join(directory, 'ansible_cloud_logging-6f1c2b8e-run.overflow.jsonl'))
+        with open(collector.overflow_file) as f:
+            payloads = [json.loads(line)['jsonPayload'] for line in f]
+        self.assertCountEqual([p.get('task_id') for p in payloads], ['0', '1', '2', '3', '4', None])
+        self.assertEqual(payloads[-1]['event_type'], 'PLAYBOOK_END')
+        self.assertEqual(payloads[-1]['logging_metrics']['unsent_events'], 5)
+
+    def test_drain_timeout_keeps_unsent_entries_in_journal(self):
+        journal_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, journal_dir)
+        collector = self._drain_hung_sink(journal_dir=journal_dir, journal_replay=False)
+        self.assertIsNone(collector.overflow_file)
+        self.assertEqual(EventJournal.execution_ids(journal_dir), ['6f1c2b8e-run'])
+
+    def test_playbook_end_reports_final_logging_stats(self):
+        collector = self._make_collector(
+            enable_async_logging=True, ignore_gcp_api_errors=True, sender_workers=2,
+            retry_initial_backoff_seconds=0)
+        collector.sink.gcp_session.full_post = lambda *args, **kwargs: FakeResponse(400)
+        collector.start_consuming()
+        for i in range(5):
+            collector.send(self._payload(i))
+        collector.send({'id': 'run', 'event_type': 'PLAYBOOK_END', 'logging_stats': {},
+                        'logging_metrics': {}})
+        sent = []
+        collector.sink.encode, encode = (lambda entries: sent.extend(entries) or encode(entries),
+                                         collector.sink.encode)
+        collector.send(None)
+        collector.wait()
+        end = json.loads(sent[-1])['jsonPayload']
+        self.assertEqual(end['event_type'], 'PLAYBOOK_END')
+        self.assertEqual(end['logging_stats']['failed_events'], 5)
+        self.assertEqual(end['logging_metrics']['request_errors'], 5)
+
+    def test_metrics_are_exported(self):
+        server = FakeCloudLoggingServer(throttled=1).start()
+        self.addCleanup(server.stop)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        metrics_file = os.path.join(directory, 'textfile', 'ansible.prom')
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+        collector = self._make_collector(
+            enable_async_logging=True, enable_batching=True, batch_max_entries=10,
+            batch_linger_seconds=0.01, sink=HttpSink(server.url, timeout=5),
+            metrics_file=metrics_file, metrics_port=port, metrics_interval_seconds=0.1)
+        collector.start_consuming()
+        for i in range(25):
+            collector.send(self._payload(i))
+        with urllib.request.urlopen(f'http://127.0.0.1:{port}/metrics', timeout=5) as resp:
+            self.assertIn('ansible_cloud_logging_queue_entries ', resp.read().decode())
+        collector.send(None)
+        collector.wait()
+
+        with open(metrics_file) as f:
+            metrics = dict(line.rsplit(' ', 1) for line in f.read().splitlines() if not line.startswith('#'))
+        self.assertEqual(metrics['ansible_cloud_logging_requests_total{code="429"}'], '1')
+        self.assertEqual(metrics['ansible_cloud_logging_requests_total{code="200"}'], '3')
+        self.assertEqual(metrics['ansible_cloud_logging_send_latency_seconds_count'], '4')
+        self.assertEqual(metrics['ansible_cloud_logging_send_latency_seconds_bucket{le="+Inf"}'], '4')
+        self.assertEqual(metrics['ansible_cloud_logging_entries_sent_total'], '25')
+        self.assertEqual(metrics['ansible_cloud_logging_bytes_sent_total'], str(server.bytes))
+        self.assertEqual(metrics['ansible_cloud_logging_retries_total'], '1')
+        self.assertEqual(metrics['ansible_cloud_logging_queue_entries'], '0')
+        summary = collector.metrics.summary()
+        self.assertEqual((summary['requests'], summary['request_errors']), (4, 1))
+        self.assertEqual(sorted(summary['send_latency_seconds']), ['max', 'p50', 'p90', 'p99'])
+        # The endpoint is gone once the playbook has ended.
+        with self.assertRaises(OSError):
+            urllib.request.urlopen(f'http://127.0.0.1:{port}/metrics', timeout=1)
+
+    def test_journal_replays_unsent_entries_of_earlier_runs(self):
+        journal_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, journal_dir)
+        # First run: the API rejects everything and errors are ignored.
+        first = self._make_collector(
+            enable_async_logging=True, ignore_gcp_api_errors=True, sender_workers=2,
+            execution_id='run-1', journal_dir=journal_dir)
+        first.sink.gcp_session.full_post = lambda *args, **kwargs: FakeResponse(403)
+        self._run(first, [self._payload(i) for i in range(5)])
+        self.assertEqual(first.stats()['failed_events'], 5)
+        self.assertEqual(EventJournal.execution_ids(journal_dir), ['run-1'])
+
+        # Second run: succeeds and uploads the entries of the first run.
+        second = self._make_collector(
+            enable_async_logging=True, enable_batching=True, batch_linger_seconds=0.01,
+            execution_id='run-2', journal_dir=journal_dir)
+        self._run(second, [self._payload(i) for i in range(5, 8)])
+        sent = sorted(int(e['jsonPayload']['task_id']) for e in second.sink.gcp_session.entries())
+        self.assertEqual(sent, list(range(8)))
+        self.assertEqual(second.stats()['replayed_events'], 5)
+        self.assertEqual(os.listdir(journal_dir), [])
+
+    def _journal_failed_run(self, journal_dir, execution_id, ids):
+        collector = self._make_collector(
+            enable_async_logging=True, ignore_gcp_api_errors=True, retry_max_attempts=1,
+            execution_id=execution_id, journal_dir=journal_dir)
+        # A transient error, so that the journals of earlier runs are kept.
+        collector.sink.gcp_session.full_post = lambda *args, **kwargs: FakeResponse(503)
+        self._run(collector, [self._payload(i) for i in ids])
+
+    def test_replay_skips_rejected_batches_and_continues(self):
+        journal_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, journal_dir)
+        self._journal_failed_run(journal_dir, 'run-1', range(3))
+        self._journal_failed_run(journal_dir, 'run-2', range(3, 6))
+
+        collector = self._make_collector(
+            enable_async_logging=True, enable_batching=True,
+            execution_id='run-3', journal_dir=journal_dir)
+        session = collector.sink.gcp_session
+        accept = session.full_post
+
+        def full_post(url, data=None, **kwargs):
+            if b'"task_id":"0"' in data.replace(b' ', b''):
+                return FakeResponse(400)
+            return accept(url, data=data, **kwargs)
+
+        session.full_post = full_post
+        self._run(collector, [])
+        sent = sorted(int(e['jsonPayload']['task_id']) for e in session.entries())
+        self.assertEqual(sent, [3, 4, 5])
+        self.assertEqual(collector.stats()['failed_events'], 3)
+        self.assertEqual(collector.stats()['replayed_events'], 3)
+        self.assertEqual(os.listdir(journal_dir), [])
+
+    def test_replay_stops_on_transient_failure(self):
+        journal_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, journal_dir)
+        self._journal_failed_run(journal_dir, 'run-1', range(3))
+        self._journal_failed_run(journal_dir, 'run-2', range(3, 6))
+
+        collector = self._make_collector(
+            enable_async_logging=True, retry_max_attempts=1,
+            execution_id='run-3', journal_dir=journal_dir)
+        collector.sink.gcp_session.full_post = lambda *args, **kwargs: FakeResponse(503)
+        self._run(collector, [])
+        self.assertEqual(collector.stats()['replayed_events'], 0)
+        self.assertEqual(EventJournal.execution_ids(journal_dir), ['run-1', 'run-2'])
+
+    def test_serialized_result_is_embedded_in_entry(self):
+        collector = self._make_collector(enable_async_logging=False)
+        result = {'rc': 0, 'stdout': 'ok', 'nested': {'a': [1, None]}}
+        collector.send({'event_type': 'PLAYBOOK_TASK_END', 'result': _serialize_result(result)})
+        entry = collector.sink.gcp_session.requests[0]['entries'][0]
+        self.assertEqual(entry['jsonPayload']['result'], result)
+
+    def test_batching_disabled_sends_one_entry_per_request(self):
+        collector = self._make_collector(
+            enable_async_logging=True, enable_batching=False)
+        self._run(collector, [self._payload(i) for i in range(4)])
+        self.assertEqual([len(r['entries']) for r in collector.sink.gcp_session.requests], [1, 1, 1, 1])
+
+
+class FakeHost:
+
+    def __init__(self, name):
+        self.name = name
+
+    def get_name(self):
+        return self.name
+
+
+class FakeTask:
+
+    def __init__(self, name):
+        self._uuid = name + '-uuid'
+        self.name = name
+
+    def get_name(self):
+        return self.name
+
+
+class FakeResult:
+
+    def __init__(self, host, task, result=None):
+        self._host = host
+        self._task = task
+        self._result = result or {}
+
+
+class FakePlaybook:
+    _file_name = '/toolkit/install-sw.yml'
+    _basedir = '/toolkit'
+
+
+class FakePlay:
+
+    def get_name(self):
+        return 'Install software'
+
+    def get_variable_manager(self):
+        return Mock(extra_vars={})
+
+
+class TestCallbackModule(unittest.TestCase):
+
+    def _load_plugin(self, **env):
+        callback_loader.add_directory(os.path.dirname(os.path.abspath(__file__)))
+        with patch.dict(os.environ, env):
+            return callback_loader.get('ansible_cloud_logging')
+
+    def setUp(self):
+        self.plugin = self._load_plugin(
+            ANSIBLE_CLOUD_LOGGING_PROJECT='my-project',
+            ANSIBLE_CLOUD_LOGGING_ENABLE_ASYNC_LOGGING='false',
+        )
+        self.session = FakeSession()
+        self.plugin.logging_collector.sink.gcp_session = self.session
+        self.plugin.v2_playbook_on_start(FakePlaybook())
+        self.plugin.v2_playbook_on_play_start(FakePlay())
+
+    def _payloads(self, event_type):
+        return [e['jsonPayload'] for e in self.session.entries()
+                if e['jsonPayload']['event_type'] == event_type]
+
+    def test_loop_items_and_retries_are_aggregated_in_task_end(self):
+        host, task = FakeHost('node-1'), FakeTask('copy swlib')
+        self.plugin.v2_runner_on_start(host, task)
+        for status in ('ok', 'ok', 'skipped', 'failed'):
+            getattr(self.plugin, f'v2_runner_item_on_{status}')(FakeResult(host, task))
+        self.plugin.v2_runner_retry(FakeResult(host, task))
+        self.plugin.v2_runner_on_failed(FakeResult(host, task, {'msg': 'One or more items failed'}))
+        self.plugin.v2_playbook_on_stats(AggregateStats())
+
+        self.assertEqual(len(self.session.entries()), 4)
+        loop_stats = self._payloads('PLAYBOOK_TASK_END')[0]['loop_stats']
+        self.assertEqual(
+            {k: v for k, v in loop_stats.items() if k != 'item_duration_seconds'},
+            {'items': 4, 'ok': 2, 'failed': 1, 'skipped': 1, 'retries': 1})
+        self.assertEqual(sorted(loop_stats['item_duration_seconds']), ['max', 'p50', 'p90', 'p99'])
+
+    def test_disabled_without_project(self):
+        with patch.dict(os.environ):
+            os.environ.pop('ANSIBLE_CLOUD_LOGGING_PROJECT', None)
+            plugin = self._load_plugin()
+        self.assertTrue(plugin.disabled)
+        self.assertFalse(hasattr(plugin, 'logging_collector'))
+
+    def test_local_sinks_do_not_need_project(self):
+        with patch.dict(os.environ, ANSIBLE_CLOUD_LOGGING_SINK='stdout'):
+            os.environ.pop('ANSIBLE_CLOUD_LOGGING_PROJECT', None)
+            plugin = self._load_plugin()
+        self.assertFalse(plugin.disabled)
+        collector = plugin.logging_collector
+        if collector.enable_async_logging:
+            # Stops the sender threads even if an assertion fails.
+            self.addCleanup(collector.wait)
+            self.addCleanup(collector.send, None)
+        # The loader imports the plugin as a module of its own, so its classes
+        # are not the ones imported by this test.
+        self.assertEqual(type(collector.sink).__name__, 'FileSink')
+        self.assertIsNone(collector.sink.path)
+        self.assertNotIn('logName', json.loads(collector._encode_entry({'event_type': 'PLAYBOOK_START'})))
+
+    def test_task_without_loop_has_empty_loop_stats(self):
+        host, task = FakeHost('node-1'), FakeTask('ping')
+        self.plugin.v2_runner_on_start(host, task)
+        self.plugin.v2_runner_on_ok(FakeResult(host, task))
+        self.assertEqual(self._payloads('PLAYBOOK_TASK_END')[0]['loop_stats'], {})
+
+    def test_trace_spans_are_written(self):
+        trace_file = os.path.join(tempfile.mkdtemp(), 'traces.jsonl')
+        self.addCleanup(shutil.rmtree, os.path.dirname(trace_file))
+        plugin = self._load_plugin(
+            ANSIBLE_CLOUD_LOGGING_PROJECT='my-project',
+            ANSIBLE_CLOUD_LOGGING_ENABLE_ASYNC_LOGGING='false',
+            ANSIBLE_CLOUD_LOGGING_TRACE_FILE=trace_file,
+        )
+        plugin.logging_collector.sink.gcp_session = FakeSession()
+        plugin.v2_playbook_on_start(FakePlaybook())
+        plugin.v2_playbook_on_play_start(FakePlay())
+        task = FakeTask('ping')
+        for name in ('node-1', 'node-2'):
+            plugin.v2_runner_on_start(FakeHost(name), task)
+        plugin.v2_runner_on_ok(FakeResult(FakeHost('node-1'), task))
+        plugin.v2_runner_on_unreachable(FakeResult(FakeHost('node-2'), task))
+        plugin.v2_playbook_on_stats(AggregateStats())
+
+        with open(trace_file) as f:
+            spans = {s['name']: s for s in json.load(f)['resourceSpans'][0]['scopeSpans'][0]['spans']}
+        self.assertEqual(sorted(spans), ['Install software', 'install-sw.yml', 'node-1', 'node-2', 'ping'])
+        self.assertEqual(spans['install-sw.yml']['traceId'], plugin.id.replace('-', ''))
+        self.assertEqual(spans['node-2']['parentSpanId'], spans['ping']['spanId'])
+        self.assertEqual(spans['ping']['parentSpanId'], spans['Install software']['spanId'])
+        self.assertEqual(spans['node-2']['status']['message'], 'unreachable host')
+
+    def test_finished_tasks_are_not_kept(self):
+        for i, status in enumerate(('ok', 'failed', 'skipped', 'unreachable')):
+            host, task = FakeHost(f'node-{i}'), FakeTask(status)
+            self.plugin.v2_runner_on_start(host, task)
+            getattr(self.plugin, f'v2_runner_on_{status}')(FakeResult(host, task))
+        self.assertEqual(self.plugin.tasks, {})
+        self.assertEqual(len(self._payloads('PLAYBOOK_TASK_END')), 4)
+
+
+class FakeCredentials:
+    """Stand-in for application default credentials, counting refreshes."""
+
+    refreshes = 0
+
+    def __init__(self, lifetime=3600):
+        self.lifetime = lifetime
+        self.token = None
+        self.expiry = None
+
+    def refresh(self, request):
+        FakeCredentials.refreshes += 1
+        self.token = f'token-{FakeCredentials.refreshes}'
+        self.expiry = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None) + \
+            datetime.timedelta(seconds=self.lifetime)
+
+
+class TestAccessToken(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.cache = os.path.join(self.directory, 'token.json')
+        FakeCredentials.refreshes = 0
+        self.lifetime = 3600
+        self.responses = []
+        self.tokens = []
+        patchers = [
+            patch('google.auth.default', lambda scopes: (FakeCredentials(self.lifetime), 'my-project')),
+            patch('google.auth.transport.requests.AuthorizedSession.post',
+                  lambda session, *args, **kwargs: self._post(session, *args, **kwargs)),
+        ]
+        for p in patchers:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def _post(self, session, url, data=None, json=None, **kwargs):
+        self.tokens.append(session.credentials.token)
+        return self.responses.pop(0) if self.responses else FakeResponse()
+
+    def _send(self, **kwargs):
+        collector = CloudLoggingCollector(
+            project='my-project',
+            log_name='ansible_cloud_logging',
+            enable_async_logging=False,
+            retry_initial_backoff_seconds=0,
+            sink=CloudLoggingSink(token_cache_file=self.cache),
+            **kwargs,
+        )
+        self.assertIsNone(collector.sink.gcp_session)
+        collector.send({'id': 'run', 'event_type': 'PLAYBOOK_START'})
+        collector.send({'id': 'run', 'event_type': 'PLAYBOOK_END'})
+        collector.wait()
+        return collector
+
+    def test_token_is_shared_between_collectors(self):
+        self._send()
+        self._send()
+        self.assertEqual(FakeCredentials.refreshes, 1)
+        self.assertEqual(self.tokens, ['token-1'] * 4)
+
+    def test_expiring_token_is_refreshed(self):
+        self.lifetime = ansible_cloud_logging.TOKEN_REFRESH_MARGIN_SECONDS - 1
+        self._send()
+        self.assertEqual(self.tokens, ['token-1', 'token-2'])
+
+    def test_rejected_token_is_refreshed(self):
+        self.responses = [FakeResponse(401)]
+        self._send()
+        self.assertEqual(self.tokens, ['token-1', 'token-2', 'token-2'])
+
+    def test_cache_readable_by_others_is_ignored(self):
+        self.cache = os.path.join(self.directory, 'ansible', 'token.json')
+        self._send()
+        self.assertEqual(stat.S_IMODE(os.stat(self.cache).st_mode), 0o600)
+        os.chmod(self.cache, 0o644)
+        self._send()
+        self.assertEqual(FakeCredentials.refreshes, 2)
+
+
+class TestLoopStats(unittest.TestCase):
+
+    def test_item_durations(self):
+        loop = _LoopStats(started=100.0)
+        now = 100.0
+        for i in range(1, 101):
+            now += i
+            loop.add_item('ok', now)
+        report = loop.report()
+        self.assertEqual(report['items'], 100)
+        self.assertEqual(report['ok'], 100)
+        self.assertEqual(report['item_duration_seconds'], {'p50': 50.0, 'p90': 90.0, 'p99': 99.0, 'max': 100.0})
+
+
+class TestBoundedEventQueue(unittest.TestCase):
+
+    def _drain(self, q):
+        q.close()
+        drained = []
+        while (entry := q.get()) is not None:
+            drained.append(entry)
+        return drained
+
+    def test_block_policy_waits_for_room(self):
+        q = BoundedEventQueue(max_entries=2, max_bytes=1024, overflow_policy='block')
+        q.put(_QueuedEntry('PLAYBOOK_TASK_START', 'a'))
+        q.put(_QueuedEntry('PLAYBOOK_TASK_START', 'b'))
+        producer = threading.Thread(target=q.put, args=(_QueuedEntry('PLAYBOOK_TASK_END', 'c'),))
+        producer.start()
+        producer.join(0.2)
+        self.assertTrue(producer.is_alive())
+        self.assertEqual(q.get().data, 'a')
+        producer.join(1)
+        self.assertFalse(producer.is_alive())
+        self.assertEqual([e.data for e in self._drain(q)], ['b', 'c'])
+
+    def test_drop_policy_drops_oldest_task_start_first(self):
+        q = BoundedEventQueue(max_entries=3, max_bytes=1024, overflow_policy='drop_task_start')
+        q.put(_QueuedEntry('PLAYBOOK_START', 'start'))
+        q.put(_QueuedEntry('PLAYBOOK_TASK_START', 'ts1'))
+        q.put(_QueuedEntry('PLAYBOOK_TASK_START', 'ts2'))
+        q.put(_QueuedEntry('PLAYBOOK_TASK_END', 'te1'))
+        q.put(_QueuedEntry('PLAYBOOK_TASK_END', 'te2'))
+        self.assertEqual(q.dropped, 2)
+        self.assertEqual([e.data for e in self._drain(q)], ['start', 'te1', 'te2'])
+
+    def test_drop_policy_respects_byte_cap(self):
+        q = BoundedEventQueue(max_entries=100, max_bytes=10, overflow_policy='drop_task_start')
+        q.put(_QueuedEntry('PLAYBOOK_TASK_START', 'aaaa'))
+        q.put(_QueuedEntry('PLAYBOOK_TASK_END', 'bbbb'))
+        q.put(_QueuedEntry('PLAYBOOK_TASK_END', 'cccccc'))
+        self.assertEqual(q.dropped, 1)
+        self.assertEqual([e.data for e in self._drain(q)], ['bbbb', 'cccccc'])
+
+    def test_drop_policy_drops_oldest_across_shards(self):
+        q = BoundedEventQueue(max_entries=4, max_bytes=1024, overflow_policy='drop_task_start', shards=2)
+        q.put(_QueuedEntry('PLAYBOOK_TASK_START', 'ts1', shard=1))
+        q.put(_QueuedEntry('PLAYBOOK_TASK_START', 'ts2', shard=0))
+        q.put(_QueuedEntry('PLAYBOOK_TASK_START', 'ts3', shard=1))
+        q.put(_QueuedEntry('PLAYBOOK_TASK_END', 'te1', shard=0))
+        self.assertEqual(q.get(shard=1).data, 'ts1')
+        q.put(_QueuedEntry('PLAYBOOK_TASK_END', 'te2', shard=1))
+        q.put(_QueuedEntry('PLAYBOOK_TASK_END', 'te3', shard=1))
+        q.put(_QueuedEntry('PLAYBOOK_TASK_END', 'te4', shard=0))
+        self.assertEqual(q.dropped, 2)
+        self.assertEqual(len(q), 4)
+        q.close()
+        self.assertEqual([e.data for e in iter(lambda: q.get(shard=0), None)], ['te1', 'te4'])
+        self.assertEqual([e.data for e in iter(lambda: q.get(shard=1), None)], ['te2', 'te3'])
+
+    def test_drop_policy_cost_does_not_grow_with_queue(self):
+        timings = []
+        for size in (1000, 10000):
+            q = BoundedEventQueue(max_entries=size, max_bytes=2**30, overflow_policy='drop_task_start')
+            for i in range(size):
+                q.put(_QueuedEntry('PLAYBOOK_TASK_START', 'x'))
+            # The best of several rounds, other threads may still be busy.
+            rounds = []
+            for _ in range(5):
+                started = time.perf_counter()
+                for i in range(200):
+                    q.put(_QueuedEntry('PLAYBOOK_TASK_END', 'y'))
+                rounds.append(time.perf_counter() - started)
+            timings.append(min(rounds))
+            self.assertEqual(q.dropped, 1000)
+        self.assertLess(timings[1], timings[0] * 5)
+
+    def test_spill_policy_keeps_order(self):
+        with tempfile.TemporaryDirectory() as spill_dir:
+            q = BoundedEventQueue(max_entries=2, max_bytes=1024, overflow_policy='spill', spill_dir=spill_dir)
+            for i in range(10):
+                q.put(_QueuedEntry('PLAYBOOK_TASK_END', f'{{"n": {i}}}'))
+            self.assertEqual(q.spilled, 8)
+            self.assertEqual(len(q), 10)
+            self.assertEqual([e.data for e in self._drain(q)], [f'{{"n": {i}}}' for i in range(10)])
+            self.assertEqual(q.dropped, 0)
+
+    def test_take_all_returns_queued_and_spilled_entries(self):
+        with tempfile.TemporaryDirectory() as spill_dir:
+            q = BoundedEventQueue(max_entries=3, max_bytes=1024, overflow_policy='spill',
+                                  spill_dir=spill_dir, shards=2)
+            for i in range(6):
+                q.put(_QueuedEntry('PLAYBOOK_TASK_START', str(i), shard=i % 2))
+            self.assertEqual(q.get(1).data, '1')
+            self.assertEqual([e.data for e in q.take_all()], ['0', '2', '3', '4', '5'])
+            self.assertEqual(q.depth(), (0, 0, 0))
+            self.assertIsNone(q.get(0))
+
+    def test_get_times_out(self):
+        q = BoundedEventQueue(max_entries=2, max_bytes=1024)
+        with self.assertRaises(queue.Empty):
+            q.get(timeout=0.05)
+
+    def test_invalid_policy(self):
+        with self.assertRaises(ValueError):
+            BoundedEventQueue(max_entries=2, max_bytes=1024, overflow_policy='discard')
+
+
+class TestSerializeResult(unittest.TestCase):
+
+    def test_small_result_is_serialized_unchanged(self):
+        result = {'rc': 0, 'changed': False, 'stdout': 'done\n', 'stdout_lines': ['done'], 'x': 1.5}
+        self.assertEqual(json.loads(_serialize_result(result)), result)
+
+    def test_large_result_keeps_status_and_output_tails(self):
+        result = {
+            'rc': 1,
+            'failed': True,
+            'msg': 'non-zero return code',
+            'stdout': 'progress\n' * 100000 + 'OPatch failed with error code 73',
+            'stdout_lines': ['progress'] * 100000,
+            'stderr': 'ü' * 50000 + 'Prerequisite check failed',
+            'invocation': {'module_args': {'_raw_params': 'opatch apply'}},
+        }
+        serialized = _serialize_result(result, budget=16 * 1024)
+        self.assertLessEqual(len(serialized.encode('utf-8')), 16 * 1024)
+        truncated = json.loads(serialized)
+        self.assertEqual(truncated['rc'], 1)
+        self.assertTrue(truncated['failed'])
+        self.assertEqual(truncated['msg'], 'non-zero return code')
+        self.assertTrue(truncated['stdout'].endswith('OPatch failed with error code 73'))
+        self.assertTrue(truncated['stderr'].endswith('Prerequisite check failed'))
+        self.assertIn('truncated', truncated['warning'])
+        self.assertEqual(truncated['omitted_keys'], ['stdout_lines', 'invocation'])
+
+    def test_result_at_budget_boundary(self):
+        for size in range(380, 400):
+            result = {'stdout': 'x' * size}
+            serialized = _serialize_result(result, budget=400)
+            self.assertLessEqual(len(serialized), 400)
+            self.assertTrue(json.loads(serialized)['stdout'].endswith('x'))
+
+
+class TestEventJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def _segments(self):
+        return sorted(n for n in os.listdir(self.directory) if n.endswith('.jsonl'))
+
+    def test_rotates_and_deletes_acknowledged_segments(self):
+        journal = EventJournal(self.directory, 'run', segment_max_bytes=100, fsync_interval_seconds=0)
+        ids = [journal.append('{"i": %d, "pad": "%s"}' % (i, 'x' * 30)) for i in range(6)]
+        self.assertGreater(len(self._segments()), 2)
+        journal.ack(ids[:4])
+        self.assertLess(len(self._segments()), 4)
+        journal.close()
+        self.assertTrue(self._segments())
+
+        recovered = EventJournal(self.directory, 'run')
+        self.assertEqual([json.loads(d)['i'] for _, d in recovered.pending_entries()], [4, 5])
+        recovered.ack(ids[4:])
+        recovered.close()
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_journal_of_running_execution_is_locked(self):
+        journal = EventJournal(self.directory, 'run')
+        journal.append('{}')
+        with self.assertRaises(OSError):
+            EventJournal(self.directory, 'run')
+        journal.close()
+
+    def test_ignores_torn_last_line(self):
+        journal = EventJournal(self.directory, 'run', fsync_interval_seconds=0)
+        journal.append('{"i": 1}')
+        journal.close()
+        with open(os.path.join(self.directory, self._segments()[-1]), 'ab') as f:
+            f.write(b'{"n":2,"entry":{"i"')
+        recovered = EventJournal(self.directory, 'run')
+        self.assertEqual(recovered.pending_entries(), [(1, '{"i": 1}')])
+        recovered.close()
+
+
+class TestTaskProfiler(unittest.TestCase):
+
+    def _add(self, profiler, task_id, host, duration, role='', status='ok'):
+        record = _TaskRecord(task_id, f'task {task_id}', role, host, '', 0.0)
+        profiler.add(record, status, duration)
+
+    def test_report(self):
+        profiler = TaskProfiler(top_n=3)
+        self._add(profiler, 'swlib', 'node-1', 10.0, role='swlib')
+        self._add(profiler, 'swlib', 'node-2', 30.0, role='swlib')
+        self._add(profiler, 'gi', 'node-1', 50.0, role='gi-setup')
+        self._add(profiler, 'gi', 'node-2', 20.0, role='gi-setup')
+        self._add(profiler, 'facts', 'node-1', 1.0)
+        self._add(profiler, 'facts', 'node-2', 2.0, status='failed')
+        report = profiler.report()
+
+        self.assertEqual(
+            [(t['name'], t['host'], t['duration_seconds']) for t in report['slowest_tasks']],
+            [('task gi', 'node-1', 50.0), ('task swlib', 'node-2', 30.0), ('task gi', 'node-2', 20.0)])
+        self.assertEqual(report['roles'], {
+            'gi-setup': {'tasks': 2, 'total_seconds': 70.0},
+            'swlib': {'tasks': 2, 'total_seconds': 40.0},
+            TaskProfiler.NO_ROLE: {'tasks': 2, 'total_seconds': 3.0},
+        })
+        # The playbook waits for node-2 on swlib and facts, and for node-1 on gi.
+        self.assertEqual(report['critical_path_seconds'], 82.0)
+        self.assertEqual(report['hosts'], {
+            'node-1': {'tasks': 3, 'total_seconds': 61.0,
+                       'critical_path_tasks': 1, 'critical_path_seconds': 50.0},
+            'node-2': {'tasks': 3, 'total_seconds': 52.0,
+                       'critical_path_tasks': 2, 'critical_path_seconds': 32.0},
+        })
+
+    def test_top_n_is_bounded(self):
+        profiler = TaskProfiler(top_n=5)
+        durations = list(range(1000))
+        random.shuffle(durations)
+        for i, duration in enumerate(durations):
+            self._add(profiler, str(i), 'node-1', float(duration))
+        self.assertEqual(len(profiler.slowest), 5)
+        self.assertEqual([t['duration_seconds'] for t in profiler.report()['slowest_tasks']],
+                         [999.0, 998.0, 997.0, 996.0, 995.0])
+
+
+class TestPerformanceHistory(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.history = PerformanceHistory(os.path.join(self.directory, 'history.db'), baseline_runs=5)
+        self.runs = 0
+
+    def _record(self, durations, file_name='install-sw.yml'):
+        self.runs += 1
+        return self.history.record('deployment', file_name, f'run-{self.runs}', '', durations)
+
+    def test_flags_significant_slowdowns_only(self):
+        for i in range(5):
+            self.assertEqual(self._record({
+                'gi install': 600.0 + i,
+                'noisy': 100.0 + 40 * (i % 2),
+                'fast': 0.1,
+            }), [])
+        regressions = self._record({'gi install': 800.0, 'noisy': 150.0, 'fast': 0.9, 'new': 60.0})
+        self.assertEqual([r['task'] for r in regressions], ['gi install'])
+        self.assertEqual(regressions[0]['baseline_runs'], 5)
+        self.assertEqual(regressions[0]['baseline_mean_seconds'], 602.0)
+        self.assertAlmostEqual(regressions[0]['slowdown'], 0.329, places=3)
+
+    def test_needs_minimum_number_of_runs(self):
+        for _ in range(PerformanceHistory.HISTORY_MIN_RUNS - 1):
+            self._record({'dbca': 100.0})
+        self.assertEqual(self._record({'dbca': 1000.0}), [])
+
+    def test_baseline_is_per_playbook(self):
+        for _ in range(5):
+            self._record({'task': 10.0})
+        self.assertEqual(self._record({'task': 100.0}, file_name='config-db.yml'), [])
+
+    def test_keeps_last_runs_only(self):
+        with patch.object(PerformanceHistory, 'HISTORY_MAX_RUNS', 3):
+            for i in range(6):
+                self._record({'task': float(i)})
+        conn = self.history._connect()
+        self.assertEqual(conn.execute('SELECT count(*) FROM runs').fetchone()[0], 3)
+        self.assertEqual(sorted(d for d, in conn.execute('SELECT duration_seconds FROM task_durations')),
+                         [3.0, 4.0, 5.0])
+        conn.close()
+
+
+class TestTraceExporter(unittest.TestCase):
+
+    EXECUTION_ID = '0b7e1bcd-52d5-4d6c-9a1b-2f5b4c1d9e10'
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'traces', 'spans.jsonl')
+
+    def _requests(self):
+        with open(self.path) as f:
+            return [json.loads(line) for line in f]
+
+    def _spans(self, request):
+        return request['resourceSpans'][0]['scopeSpans'][0]['spans']
+
+    def test_spans_are_nested(self):
+        tracer = TraceExporter(self.EXECUTION_ID, path=self.path,
+                               resource_attributes={'service.name': 'ansible', 'empty': ''})
+        tracer.start_play('play 1', 10.0)
+        tracer.add_host(_TaskRecord('t1', 'gi', 'gi-setup', 'node-1', '', 11.0), 'ok', 20.0)
+        tracer.add_host(_TaskRecord('t1', 'gi', 'gi-setup', 'node-2', '', 10.5), 'failed', 25.0, 'boom')
+        tracer.start_play('play 2', 30.0)
+        tracer.add_host(_TaskRecord('t2', 'ping', '', 'node-1', '', 31.0), 'ok', 32.0)
+        tracer.finish('site.yml', 9.0, 40.0, {'ansible.check': False})
+
+        first, last = self._requests()
+        self.assertEqual(first['resourceSpans'][0]['resource']['attributes'],
+                         [{'key': 'service.name', 'value': {'stringValue': 'ansible'}}])
+        spans = {s['name']: s for s in self._spans(first)}
+        self.assertEqual(sorted(spans), ['gi', 'node-1', 'node-2', 'play 1'])
+        gi = spans['gi']
+        self.assertEqual(gi['parentSpanId'], spans['play 1']['spanId'])
+        self.assertEqual(spans['play 1']['parentSpanId'], tracer.span_id)
+        self.assertEqual({spans['node-1']['parentSpanId'], spans['node-2']['parentSpanId']}, {gi['spanId']})
+        # The task span covers the task on all hosts.
+        self.assertEqual(gi['startTimeUnixNano'], spans['node-2']['startTimeUnixNano'])
+        self.assertEqual(gi['endTimeUnixNano'], spans['node-2']['endTimeUnixNano'])
+        self.assertEqual(int(gi['endTimeUnixNano']) - int(gi['startTimeUnixNano']), 14_500_000_000)
+        self.assertEqual(spans['node-2']['status'], {'code': TraceExporter.STATUS_CODE_ERROR, 'message': 'boom'})
+        self.assertNotIn('status', spans['node-1'])
+        self.assertIn({'key': 'ansible.failed_hosts', 'value': {'intValue': '1'}}, gi['attributes'])
+
+        spans = {s['name']: s for s in self._spans(last)}
+        self.assertEqual(sorted(spans), ['node-1', 'ping', 'play 2', 'site.yml'])
+        self.assertEqual(spans['site.yml']['parentSpanId'], '')
+        self.assertEqual(spans['site.yml']['spanId'], tracer.span_id)
+        self.assertEqual({s['traceId'] for s in spans.values()}, {uuid.UUID(self.EXECUTION_ID).hex})
+
+    def test_spans_are_posted_to_url(self):
+        received = []
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            def do_POST(self):
+                received.append(json.loads(self.rfile.read(int(self.headers['Content-Length']))))
+                self.send_response(200)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        httpd = http.server.HTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        self.addCleanup(httpd.server_close)
+        self.addCleanup(httpd.shutdown)
+        tracer = TraceExporter(self.EXECUTION_ID, url=f'http://127.0.0.1:{httpd.server_port}/v1/traces')
+        tracer.add_host(_TaskRecord('t1', 'ping', '', 'node-1', '', 1.0), 'ok', 2.0)
+        tracer.finish('site.yml', 0.0, 3.0, {})
+        self.assertEqual(len(received), 1)
+        self.assertEqual(sorted(s['name'] for s in self._spans(received[0])), ['node-1', 'ping', 'site.yml'])
+
+    def test_unreachable_url_is_reported(self):
+        tracer = TraceExporter(self.EXECUTION_ID, url='http://127.0.0.1:9/v1/traces', timeout=1)
+        tracer.finish('site.yml', 0.0, 1.0, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,14 +1,27 @@
 #!/usr/bin/python3
 """gen_patch_metadata.py is a helper script for toolkit maintainers to add metadata for upstream patches.
+
+Several patches can be processed in one run, given with --patch or listed in
+a file with --patch-list: they share one authenticated session, are looked
+up and downloaded concurrently, and OPatch is downloaded once per release
+line. Downloads are fetched in parallel Range requests and resume where they
+stopped when interrupted. They are hashed as they arrive, and the digests of
+downloaded patches are cached. With --remote, patches are parsed from the
+zips on the server, and only downloaded when their MD5 digest is unknown.
 """
 import argparse
 import base64
+import concurrent.futures
 import getpass
 import hashlib
+import io
+import json
 import logging
 import os
 import re
-import shutil
+import sys
+import threading
+import time
 import typing
 import urllib
 import zipfile
@@ -20,6 +33,36 @@ USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTM
 SEARCH_FORM = 'https://updates.oracle.com/Orion/SimpleSearch/process_form?search_type=patch&patch_number=%d&plat_lang=226P'
 DOWNLOAD_URL = r'https://updates[.]oracle[.]com/Orion/Download/process_form[^\"]*'
 LOGIN_FORM = r'https://updates[.]oracle[.]com/Orion/SavedSearches/switch_to_simple'
+OPATCH_PATCHNUM = 6880880
+GI_PATCHES = 'roles/common/defaults/main/gi_patches.yml'
+RDBMS_PATCHES = 'roles/common/defaults/main/rdbms_patches.yml'
+BASE_OVERRIDES = {
+    '23.0.0.0.0': '23.26.1.0.0',
+    '21.0.0.0.0': '21.3.0.0.0',
+    '19.0.0.0.0': '19.3.0.0.0'
+}
+# Downloads are fetched in segments of Range requests over parallel connections
+SEGMENT_SIZE = 16*1024*1024
+CHUNK_SIZE = 1024*1024
+DOWNLOAD_CONNECTIONS = 4
+SEGMENT_RETRIES = 5
+RETRY_DELAY = 1.0
+# Reads of remote zips fetch at least as many bytes, enough for the end of central directory records
+READ_AHEAD = 64*1024 + 22 + 56 + 20
+# Digests computed on downloads, the md5 one being listed in the patch catalogs
+HASH_ALGORITHMS = ('md5',)
+HASH_CACHE = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+                          'gen_patch_metadata', 'hashes.json')
+
+def get_session(mosuser: str, password: str, connections: int) -> requests.Session:
+    """Returns an authenticated session pooling the given number of connections."""
+    s = requests.Session()
+    s.headers.update({'User-Agent': USER_AGENT})
+    s.auth = (mosuser, password)
+    adapter = requests.adapters.HTTPAdapter(pool_connections=connections, pool_maxsize=connections, max_retries=3)
+    s.mount('https://', adapter)
+    s.mount('http://', adapter)
+    return s
 
 def get_patch_auth(s: requests.Session) -> typing.List[str]:
     """Obtains auth for login in order to download patches."""
@@ -40,15 +83,246 @@ def get_patch_url(s: requests.Session, patchnum: int) -> typing.List[str]:
     assert url, f'Could not get a download URL from the patch form {SEARCH_FORM}; is the patch number correct?'
     return url
 
-def download_patch(s: requests.Session, url: str, patch_file: str) -> None:
-    """Downloads a given URL to a local file."""
+def get_download_size(s: requests.Session, url: str) -> (str, int, bool):
+    """Returns the URL of a download after redirects, its size, and whether it can be fetched in ranges."""
+    with s.get(url, headers={'Range': 'bytes=0-0'}, stream=True) as r:
+        assert r.status_code in (200, 206), f'Got HTTP code {r.status_code} retrieving {url}'
+        if r.status_code == 206:
+            return r.url, int(r.headers['Content-Range'].rsplit('/', 1)[1]), True
+        return r.url, int(r.headers.get('Content-Length', -1)), False
+
+def get_server_md5(s: requests.Session, url: str) -> typing.Optional[str]:
+    """Returns the base64 MD5 digest of a download given by the server, if any."""
+    r = s.head(url, allow_redirects=True)
+    for value in r.headers.get('x-goog-hash', '').split(','):
+        name, _, digest = value.strip().partition('=')
+        if name == 'md5':
+            return digest
+    # Unlike x-goog-hash, Content-MD5 is that of the body sent, and only of the whole file in a full response
+    if r.status_code == 200:
+        return r.headers.get('Content-MD5')
+    return None
+
+class RemoteFile(io.RawIOBase):
+    """A read-only file over HTTP Range requests, for zipfile to read parts of remote zips.
+
+    zipfile reads the end of central directory record, then the central
+    directory and the members opened. Each read fetches at least READ_AHEAD
+    bytes, kept for the next reads, and those near the end of the file fetch
+    the whole tail, in which the central directory usually is.
+    """
+
+    def __init__(self, s: requests.Session, url: str, size: int, name: str):
+        super().__init__()
+        self._s = s
+        self._url = url
+        self._size = size
+        self._pos = 0
+        self._buffer_start = 0
+        self._buffer = b''
+        self.name = name
+        self.requests = 0
+        self.bytes = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        pos = {io.SEEK_SET: 0, io.SEEK_CUR: self._pos, io.SEEK_END: self._size}[whence] + offset
+        if pos < 0:
+            raise ValueError(f'Negative seek position {pos} in {self.name}')
+        self._pos = pos
+        return pos
+
+    def readinto(self, b) -> int:
+        n = min(len(b), self._size - self._pos)
+        if n <= 0:
+            return 0
+        if not (self._buffer_start <= self._pos and self._pos + n <= self._buffer_start + len(self._buffer)):
+            self._fetch(self._pos, max(n, READ_AHEAD))
+        start = self._pos - self._buffer_start
+        b[:n] = self._buffer[start:start + n]
+        self._pos += n
+        return n
+
+    def _fetch(self, start: int, length: int) -> None:
+        start = max(0, min(start, self._size - length))
+        end = min(start + length, self._size) - 1
+        r = self._s.get(self._url, headers={'Range': f'bytes={start}-{end}'})
+        assert r.status_code == 206, f'Got HTTP code {r.status_code} retrieving bytes {start}-{end} of {self._url}'
+        assert len(r.content) == end - start + 1, f'Got {len(r.content)} of bytes {start}-{end} of {self._url}'
+        self._buffer_start, self._buffer = start, r.content
+        self.requests += 1
+        self.bytes += len(r.content)
+
+def open_remote_file(s: requests.Session, url: str, name: str) -> RemoteFile:
+    """Returns a remote file reading a download over HTTP Range requests."""
+    url, size, ranges = get_download_size(s, url)
+    assert ranges, f'{url} cannot be fetched in ranges, run without --remote'
+    return RemoteFile(s, url, size, name)
+
+def load_download_state(state_file: str, size: int, segment_size: int) -> typing.Optional[typing.Dict]:
+    """Returns the progress of a download from its sidecar file, if it is still the same download."""
+    try:
+        with open(state_file) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if state.get('size') != size or state.get('segment_size') != segment_size:
+        logging.info('Discarding %s, the download changed', state_file)
+        return None
+    return state
+
+def save_download_state(state_file: str, state: typing.Dict) -> None:
+    """Replaces the sidecar file of a download, so that it is never left half written."""
+    with open(state_file + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(state_file + '.tmp', state_file)
+
+class DownloadHasher:
+    """Hashes a download in file order while its segments arrive out of order.
+
+    Chunks past the hashed prefix are held in memory until it reaches them,
+    that is up to a segment per other connection. The ranges already in the
+    partial file when a download resumes are read back from it.
+    """
+
+    def __init__(self, part_file: str, present: typing.List[typing.Tuple[int, int]]):
+        self._part_file = part_file
+        self._present = {start: end for start, end in present if end > start}
+        self._pending = {}
+        self._hashes = [hashlib.new(name) for name in HASH_ALGORITHMS]
+        self._lock = threading.Lock()
+        self.offset = 0
+        with self._lock:
+            self._advance()
+
+    def update(self, offset: int, chunk: bytes) -> None:
+        """Hashes a chunk downloaded at the given offset, once all the bytes before it are."""
+        with self._lock:
+            self._pending[offset] = chunk
+            self._advance()
+
+    def _advance(self) -> None:
+        while True:
+            if self.offset in self._pending:
+                self._hash(self._pending.pop(self.offset))
+            elif self.offset in self._present:
+                end = self._present.pop(self.offset)
+                with open(self._part_file, 'rb') as f:
+                    f.seek(self.offset)
+                    while self.offset < end:
+                        self._hash(f.read(min(CHUNK_SIZE, end - self.offset)))
+            else:
+                return
+
+    def _hash(self, chunk: bytes) -> None:
+        for h in self._hashes:
+            h.update(chunk)
+        self.offset += len(chunk)
+
+    def digests(self) -> typing.Dict[str, str]:
+        """Returns the base64 digests by algorithm."""
+        assert not self._pending, f'Could not hash {self._part_file} past byte {self.offset}'
+        return {name: base64.b64encode(h.digest()).decode('ascii') for name, h in zip(HASH_ALGORITHMS, self._hashes)}
+
+def download_segment(s: requests.Session, url: str, part_file: str, state_file: str, state: typing.Dict,
+                     lock: threading.Lock, hasher: DownloadHasher, segment: int) -> None:
+    """Downloads the rest of a segment of a download into its partial file, retrying failures."""
+    start = segment * state['segment_size']
+    end = min(start + state['segment_size'], state['size'])
+    for attempt in range(SEGMENT_RETRIES + 1):
+        offset = start + state['done'][segment]
+        if offset >= end:
+            return
+        try:
+            with s.get(url, headers={'Range': f'bytes={offset}-{end - 1}'}, stream=True) as r:
+                assert r.status_code == 206, f'Got HTTP code {r.status_code} retrieving bytes {offset}-{end - 1} of {url}'
+                with open(part_file, 'r+b') as f:
+                    f.seek(offset)
+                    for chunk in r.iter_content(CHUNK_SIZE):
+                        chunk = chunk[:end - offset]
+                        f.write(chunk)
+                        # Flushed before being recorded, for the state to never run ahead of the data
+                        f.flush()
+                        hasher.update(offset, chunk)
+                        offset += len(chunk)
+                        with lock:
+                            state['done'][segment] = offset - start
+                            save_download_state(state_file, state)
+            assert offset == end, f'Got {offset - start} of the {end - start} bytes of segment {segment} of {url}'
+        except (requests.exceptions.RequestException, AssertionError) as e:
+            if attempt == SEGMENT_RETRIES:
+                raise
+            logging.warning('Retrying segment %d of %s at byte %d: %s', segment, url, offset, e)
+            time.sleep(RETRY_DELAY * 2**attempt)
+
+def download_patch(s: requests.Session, url: str, patch_file: str,
+                   connections: int = DOWNLOAD_CONNECTIONS) -> typing.Optional[typing.Dict[str, str]]:
+    """Downloads a given URL to a local file, and returns the digests of the bytes downloaded.
+
+    The file is fetched in segments of HTTP Range requests over parallel
+    connections into patch_file.part, and the progress is kept in
+    patch_file.part.json, so that an interrupted download resumes where it
+    stopped. The partial file only becomes patch_file once its size matches
+    the size announced by the server. A patch_file of that size is kept,
+    and None returned.
+    """
+    url, size, ranges = get_download_size(s, url)
+    if os.path.exists(patch_file) and os.path.getsize(patch_file) == size:
+        logging.info('Using the downloaded %s', patch_file)
+        return None
     logging.info('Downloading %s', url)
-    s.mount(url, requests.adapters.HTTPAdapter(max_retries=3))
-    with s.get(url, stream=True) as r:
-        with open(patch_file, 'wb') as f:
-            shutil.copyfileobj(r.raw, f)
+    part_file, state_file = patch_file + '.part', patch_file + '.part.json'
+
+    if not ranges:
+        logging.info('%s cannot be fetched in ranges, downloading it over one connection', url)
+        hasher = DownloadHasher(part_file, [])
+        with s.get(url, stream=True) as r:
+            assert r.status_code == 200, f'Got HTTP code {r.status_code} retrieving {url}'
+            with open(part_file, 'wb') as f:
+                for chunk in r.iter_content(CHUNK_SIZE):
+                    f.write(chunk)
+                    hasher.update(hasher.offset, chunk)
+        if size < 0:
+            logging.warning('The size of %s is unknown and could not be checked', url)
+        assert size < 0 or os.path.getsize(part_file) == size, \
+            f'Got {os.path.getsize(part_file)} of the {size} bytes of {url}'
+        os.replace(part_file, patch_file)
+        return hasher.digests()
+
+    state = load_download_state(state_file, size, SEGMENT_SIZE)
+    if state is None or not os.path.exists(part_file) or os.path.getsize(part_file) != size:
+        state = {'size': size, 'segment_size': SEGMENT_SIZE, 'done': [0] * max(1, -(-size // SEGMENT_SIZE))}
+        with open(part_file, 'wb') as f:
+            f.truncate(size)
+    else:
+        logging.info('Resuming %s at %d of %d bytes', patch_file, sum(state['done']), size)
+    save_download_state(state_file, state)
+
+    lock = threading.Lock()
+    hasher = DownloadHasher(part_file, [(segment * SEGMENT_SIZE, segment * SEGMENT_SIZE + done)
+                                        for segment, done in enumerate(state['done'])])
+    with concurrent.futures.ThreadPoolExecutor(max_workers=connections) as executor:
+        futures = [executor.submit(download_segment, s, url, part_file, state_file, state, lock, hasher, segment)
+                   for segment in range(len(state['done']))]
+        for future in futures:
+            future.result()
 
-def get_min_opatch_version(op_patch_file: str) -> str:
+    assert sum(state['done']) == size and os.path.getsize(part_file) == size, \
+        f'Got {sum(state["done"])} of the {size} bytes of {url}'
+    assert hasher.offset == size, f'Hashed {hasher.offset} of the {size} bytes of {url}'
+    os.replace(part_file, patch_file)
+    os.remove(state_file)
+    return hasher.digests()
+
+def get_min_opatch_version(op_patch_file: typing.Union[str, typing.BinaryIO]) -> str:
     """Extracts numeric version from version.txt in OPatch zip."""
     with zipfile.ZipFile(op_patch_file, 'r') as z:
         try:
@@ -60,7 +334,7 @@ def get_min_opatch_version(op_patch_file: str) -> str:
             logging.warning('Could not find OPatch/version.txt in %s', op_patch_file)
             return "unknown"
 
-def parse_patch(patch_file: str, patchnum: int) -> (str, str, str, str, str, bool):
+def parse_patch(patch_file: typing.Union[str, typing.BinaryIO], patchnum: int) -> (str, str, str, str, str, bool):
     """Parses patch metadata and identifies subdirectories."""
     is_gi = False
     with zipfile.ZipFile(patch_file, 'r') as z:
@@ -105,62 +379,210 @@ def parse_patch(patch_file: str, patchnum: int) -> (str, str, str, str, str, boo
     logging.debug('Final selection - GI: %s, DB: %s, OJVM: %s. is_gi: %s', gi_subdir, db_subdir, ojvm_subdir, is_gi)
     return (release, patch_release, ojvm_subdir, gi_subdir, db_subdir, is_gi)
 
-def main():
-    ap = argparse.ArgumentParser()
-    ap.add_argument('--patch', type=int, help='Patch number', required=True)
-    ap.add_argument('--mosuser', type=str, help='MOS username', required=True)
-    ap.add_argument('--debug', help='Debug logging', action=argparse.BooleanOptionalAction)
-    args = ap.parse_args()
-    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
+class OPatchCatalog:
+    """Downloads OPatch once per release line for all the patches of a run.
+
+    The download URLs of every release line are looked up once, on first use.
+    With remote, the version is read from the remote zip instead.
+    """
+
+    def __init__(self, s: requests.Session, connections: int = DOWNLOAD_CONNECTIONS, remote: bool = False):
+        self._s = s
+        self._connections = connections
+        self._remote = remote
+        self._lock = threading.Lock()
+        self._urls = None
+        self._line_locks = {}
+        self._versions = {}
+
+    def get_min_opatch_version(self, release_line: str) -> str:
+        """Returns the OPatch version of a release line, such as 190000, downloading it if needed."""
+        with self._lock:
+            if self._urls is None:
+                self._urls = get_patch_url(self._s, OPATCH_PATCHNUM)
+            line_lock = self._line_locks.setdefault(release_line, threading.Lock())
+        with line_lock:
+            if release_line not in self._versions:
+                op_match = [k for k in self._urls if release_line in k][0]
+                op_patch_file = get_patch_file(op_match)
+                if self._remote:
+                    with open_remote_file(self._s, op_match, op_patch_file) as f:
+                        self._versions[release_line] = get_min_opatch_version(f)
+                else:
+                    download_patch(self._s, op_match, op_patch_file, self._connections)
+                    self._versions[release_line] = get_min_opatch_version(op_patch_file)
+            return self._versions[release_line]
+
+def get_patch_file(url: str) -> str:
+    """Returns the file name of a patch download URL."""
+    return urllib.parse.parse_qs(urllib.parse.urlparse(url).query)['patch_file'][0]
+
+def get_file_digests(patch_file: str) -> typing.Dict[str, str]:
+    """Returns the base64 digests of a file by algorithm, reading it whole."""
+    hasher = DownloadHasher(patch_file, [(0, os.path.getsize(patch_file))])
+    return hasher.digests()
+
+class HashCache:
+    """Digests of downloaded files, kept in a JSON file.
+
+    Entries are keyed by absolute path, and only used while the size and
+    modification time of the file are unchanged. Without a cache file, they
+    are only kept for the run.
+    """
+
+    def __init__(self, cache_file: typing.Optional[str] = None):
+        self._cache_file = cache_file
+        self._lock = threading.Lock()
+        self._entries = {}
+        if cache_file:
+            try:
+                with open(cache_file) as f:
+                    self._entries = json.load(f)
+            except FileNotFoundError:
+                pass
+            except ValueError:
+                logging.warning('Ignoring the corrupt hash cache %s', cache_file)
+
+    @staticmethod
+    def _key(path: str) -> (str, typing.List[int]):
+        st = os.stat(path)
+        return os.path.abspath(path), [st.st_size, st.st_mtime_ns]
+
+    def put(self, path: str, digests: typing.Dict[str, str]) -> None:
+        """Records the digests of a file as it is now."""
+        key, stat = self._key(path)
+        with self._lock:
+            self._entries[key] = {'stat': stat, 'digests': digests}
+            if self._cache_file:
+                os.makedirs(os.path.dirname(os.path.abspath(self._cache_file)), exist_ok=True)
+                with open(self._cache_file + '.tmp', 'w') as f:
+                    json.dump(self._entries, f, indent=1, sort_keys=True)
+                os.replace(self._cache_file + '.tmp', self._cache_file)
+
+    def get_digests(self, path: str) -> typing.Dict[str, str]:
+        """Returns the digests of a file, only reading it if they are not cached."""
+        key, stat = self._key(path)
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry and entry['stat'] == stat and all(name in entry['digests'] for name in HASH_ALGORITHMS):
+            return entry['digests']
+        logging.info('Hashing %s', path)
+        digests = get_file_digests(path)
+        self.put(path, digests)
+        return digests
+
+def get_patch_digests(s: requests.Session, url: str, patch_file: str, hash_cache: HashCache,
+                      connections: int = DOWNLOAD_CONNECTIONS) -> typing.Dict[str, str]:
+    """Downloads a patch unless it already is, and returns its digests."""
+    digests = download_patch(s, url, patch_file, connections)
+    if digests:
+        hash_cache.put(patch_file, digests)
+        return digests
+    return hash_cache.get_digests(patch_file)
+
+def process_patch(s: requests.Session, patchnum: int, opatch: OPatchCatalog, hash_cache: HashCache,
+                  connections: int = DOWNLOAD_CONNECTIONS, remote: bool = False) -> typing.List[typing.Tuple[str, str]]:
+    """Downloads and parses a patch, and returns its (catalog file, catalog line) pairs.
+
+    With remote, the patch is parsed from the remote zip, and only downloaded
+    if the server does not give its MD5 digest.
+    """
+    url_list = get_patch_url(s, patchnum)
+    patch_file = get_patch_file(url_list[0])
+
+    if remote:
+        with open_remote_file(s, url_list[0], patch_file) as f:
+            parsed = parse_patch(f, patchnum)
+            logging.info('Parsed %s with %d requests of %d bytes', patch_file, f.requests, f.bytes)
+        md5_digest = get_server_md5(s, url_list[0])
+        if md5_digest:
+            logging.info('Using the MD5 digest of %s given by the server', patch_file)
+        else:
+            md5_digest = get_patch_digests(s, url_list[0], patch_file, hash_cache, connections)['md5']
+    else:
+        md5_digest = get_patch_digests(s, url_list[0], patch_file, hash_cache, connections)['md5']
+        parsed = parse_patch(patch_file, patchnum)
+    (release_name, patch_release, ojvm_subdir, gi_subdir, db_subdir, is_gi) = parsed
 
-    s = requests.Session()
-    s.headers.update({'User-Agent': USER_AGENT})
-    s.auth = (args.mosuser, getpass.getpass(prompt='MOS Password: '))
-
-    url_list = get_patch_url(s, args.patch)
-    patch_file = urllib.parse.parse_qs(urllib.parse.urlparse(url_list[0]).query)['patch_file'][0]
-    
-    if not (os.path.exists(patch_file) and os.path.getsize(patch_file) > 100*1024*1024):
-        download_patch(s, url_list[0], patch_file)
-
-    md5 = hashlib.md5()
-    with open(patch_file, 'rb') as f:
-        while chunk := f.read(1024*1024):
-            md5.update(chunk)
-    md5_digest = base64.b64encode(md5.digest()).decode('ascii')
-
-    (release_name, patch_release, ojvm_subdir, gi_subdir, db_subdir, is_gi) = parse_patch(patch_file, args.patch)
-
-    BASE_OVERRIDES = {
-        '23.0.0.0.0': '23.26.1.0.0',
-        '21.0.0.0.0': '21.3.0.0.0',
-        '19.0.0.0.0': '19.3.0.0.0'
-    }
     major_ver = int(release_name.split('.')[0])
     base_release = BASE_OVERRIDES.get(release_name, release_name)
     prereq_flag = 'false' if major_ver >= 21 else 'true'
     upgrade_flag = 'false' if major_ver >= 21 else 'true'
 
-    op_url = get_patch_url(s, 6880880)
-    major_ver = patch_file.split('_')[1][:5]
-    op_match = [k for k in op_url if major_ver in k][0]
-    op_patch_file = urllib.parse.parse_qs(urllib.parse.urlparse(op_match).query)['patch_file'][0]
-    if not os.path.exists(op_patch_file):
-        download_patch(s, op_match, op_patch_file)
-    min_opatch = get_min_opatch_version(op_patch_file)
+    min_opatch = opatch.get_min_opatch_version(patch_file.split('_')[1][:5])
 
+    lines = []
     if is_gi:
-        print(f"Add to roles/common/defaults/main/gi_patches.yml:")
-        print(f'  - {{ category: "RU", base: "{base_release}", release: "{patch_release}", patchnum: "{args.patch}", patchfile: "{patch_file}", patch_subdir: "/{gi_subdir if gi_subdir is not None else ""}", prereq_check: false, method: "opatchauto apply", ocm: false, upgrade: false, md5sum: "{md5_digest}", minimum_opatch: "{min_opatch}" }}')
+        lines.append((GI_PATCHES, f'  - {{ category: "RU", base: "{base_release}", release: "{patch_release}", patchnum: "{patchnum}", patchfile: "{patch_file}", patch_subdir: "/{gi_subdir if gi_subdir is not None else ""}", prereq_check: false, method: "opatchauto apply", ocm: false, upgrade: false, md5sum: "{md5_digest}", minimum_opatch: "{min_opatch}" }}'))
         if release_name.startswith('19') and ojvm_subdir:
-            print(f"\nAdd to roles/common/defaults/main/rdbms_patches.yml:")
-            print(f'  - {{ category: "RU_Combo", base: "{base_release}", release: "{patch_release}", patchnum: "{args.patch}", patchfile: "{patch_file}", patch_subdir: "/{ojvm_subdir}", prereq_check: {prereq_flag}, method: "opatch apply", ocm: false, upgrade: {upgrade_flag}, md5sum: "{md5_digest}", minimum_opatch: "{min_opatch}" }}')
+            lines.append((RDBMS_PATCHES, f'  - {{ category: "RU_Combo", base: "{base_release}", release: "{patch_release}", patchnum: "{patchnum}", patchfile: "{patch_file}", patch_subdir: "/{ojvm_subdir}", prereq_check: {prereq_flag}, method: "opatch apply", ocm: false, upgrade: {upgrade_flag}, md5sum: "{md5_digest}", minimum_opatch: "{min_opatch}" }}'))
     else:
-        print(f"Add to roles/common/defaults/main/rdbms_patches.yml:")
         if release_name.startswith('19') and ojvm_subdir:
-            print(f'  - {{ category: "DB_OJVM_RU", base: "{base_release}", release: "{patch_release}", patchnum: "{args.patch}", patchfile: "{patch_file}", patch_subdir: "/{ojvm_subdir}", prereq_check: {prereq_flag}, method: "opatch apply", ocm: false, upgrade: {upgrade_flag}, md5sum: "{md5_digest}", minimum_opatch: "{min_opatch}" }}')
+            lines.append((RDBMS_PATCHES, f'  - {{ category: "DB_OJVM_RU", base: "{base_release}", release: "{patch_release}", patchnum: "{patchnum}", patchfile: "{patch_file}", patch_subdir: "/{ojvm_subdir}", prereq_check: {prereq_flag}, method: "opatch apply", ocm: false, upgrade: {upgrade_flag}, md5sum: "{md5_digest}", minimum_opatch: "{min_opatch}" }}'))
         if db_subdir is not None:
-            print(f'  - {{ category: "DB_RU", base: "{base_release}", release: "{patch_release}", patchnum: "{args.patch}", patchfile: "{patch_file}", patch_subdir: "/{db_subdir}", prereq_check: {prereq_flag}, method: "opatch apply", ocm: false, upgrade: {upgrade_flag}, md5sum: "{md5_digest}", minimum_opatch: "{min_opatch}" }}')
+            lines.append((RDBMS_PATCHES, f'  - {{ category: "DB_RU", base: "{base_release}", release: "{patch_release}", patchnum: "{patchnum}", patchfile: "{patch_file}", patch_subdir: "/{db_subdir}", prereq_check: {prereq_flag}, method: "opatch apply", ocm: false, upgrade: {upgrade_flag}, md5sum: "{md5_digest}", minimum_opatch: "{min_opatch}" }}'))
+    return lines
+
+def process_patches(s: requests.Session, patchnums: typing.List[int], workers: int,
+                    connections: int = DOWNLOAD_CONNECTIONS, hash_cache: typing.Optional[HashCache] = None,
+                    remote: bool = False) -> (typing.Dict[str, typing.List[str]], typing.Dict[int, Exception]):
+    """Processes patches concurrently.
+
+    Returns the catalog lines by catalog file, in the order of the patches,
+    and the errors of the patches that failed.
+    """
+    opatch = OPatchCatalog(s, connections, remote)
+    hash_cache = hash_cache or HashCache()
+    catalogs, errors = {}, {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [(patchnum, executor.submit(process_patch, s, patchnum, opatch, hash_cache, connections, remote))
+                   for patchnum in patchnums]
+        for patchnum, future in futures:
+            try:
+                lines = future.result()
+            except Exception as e:
+                logging.error('Patch %d failed: %s', patchnum, e)
+                errors[patchnum] = e
+                continue
+            for catalog, line in lines:
+                catalogs.setdefault(catalog, []).append(line)
+    return catalogs, errors
+
+def read_patch_list(path: str) -> typing.List[int]:
+    """Reads patch numbers from a file, one per line, ignoring blank lines and # comments."""
+    with open(path) as f:
+        return [int(line) for line in (line.split('#')[0].strip() for line in f) if line]
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--patch', type=int, nargs='+', default=[], help='Patch numbers')
+    ap.add_argument('--patch-list', type=str, help='File listing patch numbers, one per line')
+    ap.add_argument('--mosuser', type=str, help='MOS username', required=True)
+    ap.add_argument('--workers', type=int, default=4, help='Number of patches processed concurrently')
+    ap.add_argument('--connections', type=int, default=DOWNLOAD_CONNECTIONS, help='Number of connections per download')
+    ap.add_argument('--hash-cache', type=str, default=HASH_CACHE, help='File caching the digests of downloaded patches')
+    ap.add_argument('--remote', help='Parse patches without downloading them, unless their MD5 digest is unknown',
+                    action=argparse.BooleanOptionalAction)
+    ap.add_argument('--debug', help='Debug logging', action=argparse.BooleanOptionalAction)
+    args = ap.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO, format='%(levelname)s:%(threadName)s:%(message)s')
+
+    patchnums = args.patch + (read_patch_list(args.patch_list) if args.patch_list else [])
+    if not patchnums:
+        ap.error('at least one patch is required, with --patch or --patch-list')
+    patchnums = list(dict.fromkeys(patchnums))
+
+    s = get_session(args.mosuser, getpass.getpass(prompt='MOS Password: '), args.workers * args.connections)
+    catalogs, errors = process_patches(s, patchnums, args.workers, args.connections, HashCache(args.hash_cache),
+                                       args.remote)
+
+    for catalog in (GI_PATCHES, RDBMS_PATCHES):
+        if catalog in catalogs:
+            print(f"Add to {catalog}:")
+            print('\n'.join(catalogs[catalog]))
+            print()
+    if errors:
+        sys.exit(f'Failed patches: {" ".join(str(patchnum) for patchnum in errors)}')
 
 if __name__ == '__main__':
     main()
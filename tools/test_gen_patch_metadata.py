@@ -0,0 +1,459 @@
+import base64
+import hashlib
+import http.server
+import io
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import zipfile
+from unittest import mock
+
+import gen_patch_metadata
+from gen_patch_metadata import GI_PATCHES
+from gen_patch_metadata import OPATCH_PATCHNUM
+from gen_patch_metadata import RDBMS_PATCHES
+from gen_patch_metadata import DownloadHasher
+from gen_patch_metadata import HashCache
+from gen_patch_metadata import RemoteFile
+from gen_patch_metadata import download_patch
+from gen_patch_metadata import get_server_md5
+from gen_patch_metadata import get_session
+from gen_patch_metadata import parse_patch
+from gen_patch_metadata import process_patches
+from gen_patch_metadata import read_patch_list
+
+DOWNLOAD_URL = 'https://updates.oracle.com/Orion/Download/process_form/%s?aru=1&patch_file=%s'
+
+
+def make_patch(abstract, release, subdirs, padding=0, comment=b''):
+    """Returns the content of a patch zip with the given README titles by subdir.
+
+    A stored member of padding random bytes stands for the bulk of the patch.
+    """
+    patchnum = abstract.split()[0]
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, 'w') as z:
+        z.comment = comment
+        z.writestr('PatchSearch.xml', f'<results><patch><abstract>{abstract}</abstract>'
+                                      f'<release name="{release}"/></patch></results>')
+        if padding:
+            z.writestr(f'{patchnum}/files/padding.bin', random.Random(0).randbytes(padding))
+        for subdir, title in subdirs.items():
+            z.writestr(f'{patchnum}/{subdir}/README.html', f'<html><head><title>{title}</title></head></html>')
+    return data.getvalue()
+
+
+def make_opatch(version):
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, 'w') as z:
+        z.writestr('OPatch/version.txt', f'OPATCH_VERSION:{version}\n')
+    return data.getvalue()
+
+
+class FakeResponse:
+
+    def __init__(self, url, content=b'', status_code=200, headers=None):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.content = content
+
+    def iter_content(self, chunk_size):
+        return (self.content[i:i + chunk_size] for i in range(0, len(self.content), chunk_size))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+class FakeMosSession:
+    """Serves the patch search form and downloads of My Oracle Support from memory.
+
+    files maps patch numbers to {file name: content}. Every request takes
+    latency seconds, and the requests are recorded with their Range header.
+    With md5, HEAD requests give the MD5 digest of the files in x-goog-hash.
+    """
+
+    def __init__(self, files, latency=0.0, md5=False):
+        self.files = files
+        self.latency = latency
+        self.md5 = md5
+        self.requests = []
+        self.max_concurrency = 0
+        self._concurrency = 0
+        self._lock = threading.Lock()
+
+    def get(self, url, allow_redirects=True, stream=False, headers=None):
+        byte_range = (headers or {}).get('Range')
+        with self._lock:
+            self.requests.append((url, byte_range))
+            self._concurrency += 1
+            self.max_concurrency = max(self.max_concurrency, self._concurrency)
+        try:
+            if self.latency:
+                time.sleep(self.latency)
+            if 'patch_number=' in url:
+                patchnum = int(url.split('patch_number=')[1].split('&')[0])
+                links = ''.join(f'<a href="{DOWNLOAD_URL % (name, name)}">{name}</a>'
+                                for name in self.files.get(patchnum, {}))
+                return FakeResponse(url, f'<html>{links}</html>'.encode())
+            name = url.split('patch_file=')[1]
+            content = next(files[name] for files in self.files.values() if name in files)
+            if not byte_range:
+                return FakeResponse(url, content)
+            start, end = (int(i) for i in byte_range.split('=')[1].split('-'))
+            return FakeResponse(url, content[start:end + 1], 206, {'Content-Range': f'bytes {start}-{end}/{len(content)}'})
+        finally:
+            with self._lock:
+                self._concurrency -= 1
+
+    def head(self, url, allow_redirects=True):
+        content = next(files[name] for files in self.files.values() for name in files if url.endswith(name))
+        headers = {'Content-Length': str(len(content))}
+        if self.md5:
+            headers['x-goog-hash'] = f'crc32c=AAAAAA==,md5={base64.b64encode(hashlib.md5(content).digest()).decode()}'
+        return FakeResponse(url, headers=headers)
+
+    def downloads(self):
+        """Returns the names of the files downloaded, beyond looking up their size."""
+        return sorted(url.split('patch_file=')[1] for url, byte_range in self.requests
+                      if 'patch_file=' in url and byte_range != 'bytes=0-0')
+
+
+class RangeServer:
+    """Serves files on a local port, with HTTP Range requests unless ranges is False.
+
+    The first `drops` responses are cut off after half of their bytes, and
+    the next `errors` ones are answered with a 503. The bytes served and the
+    highest number of responses served at the same time are counted.
+    """
+
+    def __init__(self, files, ranges=True, drops=0, errors=0, md5=False):
+        self.files = files
+        self.md5 = md5
+        self.ranges = ranges
+        self.drops = drops
+        self.errors = errors
+        self.bytes = 0
+        self.max_concurrency = 0
+        self._concurrency = 0
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_HEAD(self):
+                content = server.files[self.path.lstrip('/')]
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(content)))
+                if server.md5:
+                    self.send_header('Content-MD5', base64.b64encode(hashlib.md5(content).digest()).decode())
+                self.end_headers()
+
+            def do_GET(self):
+                content = server.files[self.path.lstrip('/')]
+                start, end = 0, len(content) - 1
+                byte_range = self.headers.get('Range')
+                if server.ranges and byte_range:
+                    start, end = (int(i) for i in byte_range.split('=')[1].split('-'))
+                    end = min(end, len(content) - 1)
+                body = content[start:end + 1]
+                with server.lock:
+                    # Size lookups are never failed, so that the count of failures is exact
+                    probe = byte_range == 'bytes=0-0'
+                    drop = not probe and server.drops > 0
+                    error = not probe and not drop and server.errors > 0
+                    server.drops -= drop
+                    server.errors -= error
+                    sent = body[:len(body) // 2] if drop else b'' if error else body
+                    server.bytes += len(sent)
+                    server._concurrency += 1
+                    server.max_concurrency = max(server.max_concurrency, server._concurrency)
+                try:
+                    if error:
+                        self.send_response(503)
+                        self.send_header('Content-Length', '0')
+                        self.end_headers()
+                        return
+                    self.send_response(206 if server.ranges and byte_range else 200)
+                    if server.ranges and byte_range:
+                        self.send_header('Content-Range', f'bytes {start}-{end}/{len(content)}')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.close_connection = drop
+                    # Written in pieces, so that concurrent ranges overlap
+                    for i in range(0, len(sent), 16384):
+                        self.wfile.write(sent[i:i + 16384])
+                        time.sleep(0.001)
+                finally:
+                    with server.lock:
+                        server._concurrency -= 1
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = 'http://127.0.0.1:%d/' % self.httpd.server_port
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@mock.patch.multiple(gen_patch_metadata, SEGMENT_SIZE=65536, CHUNK_SIZE=8192, RETRY_DELAY=0)
+class TestDownloadPatch(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        os.chdir(self.tmpdir)
+        self.content = random.Random(0).randbytes(1000000)
+        self.s = get_session('user', 'password', 8)
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def _serve(self, **kwargs):
+        server = RangeServer({'patch.zip': self.content}, **kwargs)
+        self.servers.append(server)
+        return server
+
+    def _downloaded(self):
+        with open('patch.zip', 'rb') as f:
+            return f.read()
+
+    def _md5(self):
+        return {'md5': base64.b64encode(hashlib.md5(self.content).digest()).decode('ascii')}
+
+    def test_downloads_ranges_in_parallel(self):
+        server = self._serve()
+        digests = download_patch(self.s, server.url + 'patch.zip', 'patch.zip', connections=4)
+
+        self.assertEqual(self._downloaded(), self.content)
+        self.assertEqual(digests, self._md5())
+        self.assertGreater(server.max_concurrency, 1)
+        self.assertEqual(sorted(os.listdir()), ['patch.zip'])
+
+    def test_retries_dropped_and_failed_ranges(self):
+        server = self._serve(drops=3, errors=3)
+        digests = download_patch(self.s, server.url + 'patch.zip', 'patch.zip', connections=4)
+
+        self.assertEqual(self._downloaded(), self.content)
+        self.assertEqual(digests, self._md5())
+        self.assertEqual((server.drops, server.errors), (0, 0))
+
+    def test_resumes_interrupted_download(self):
+        server = self._serve(drops=1000)
+        with mock.patch.object(gen_patch_metadata, 'SEGMENT_RETRIES', 1):
+            with self.assertRaises(Exception):
+                download_patch(self.s, server.url + 'patch.zip', 'patch.zip', connections=4)
+        self.assertFalse(os.path.exists('patch.zip'))
+        with open('patch.zip.part.json') as f:
+            done = sum(json.load(f)['done'])
+        self.assertGreater(done, 0)
+
+        server = self._serve()
+        digests = download_patch(self.s, server.url + 'patch.zip', 'patch.zip', connections=4)
+
+        self.assertEqual(self._downloaded(), self.content)
+        # The bytes of the first run were hashed from the partial file
+        self.assertEqual(digests, self._md5())
+        # Only the missing bytes were fetched again, besides the size lookup
+        self.assertEqual(server.bytes, len(self.content) - done + 1)
+        self.assertEqual(sorted(os.listdir()), ['patch.zip'])
+
+    def test_replaces_truncated_download(self):
+        with open('patch.zip', 'wb') as f:
+            f.write(self.content[:1000])
+        server = self._serve()
+        download_patch(self.s, server.url + 'patch.zip', 'patch.zip')
+
+        self.assertEqual(self._downloaded(), self.content)
+
+    def test_keeps_complete_download(self):
+        with open('patch.zip', 'wb') as f:
+            f.write(self.content)
+        server = self._serve()
+        self.assertIsNone(download_patch(self.s, server.url + 'patch.zip', 'patch.zip'))
+
+        self.assertEqual(server.bytes, 1)
+
+    def test_checks_size_without_ranges(self):
+        server = self._serve(ranges=False, drops=1)
+        with self.assertRaises(Exception):
+            download_patch(self.s, server.url + 'patch.zip', 'patch.zip')
+        self.assertFalse(os.path.exists('patch.zip'))
+
+        server = self._serve(ranges=False)
+        digests = download_patch(self.s, server.url + 'patch.zip', 'patch.zip')
+        self.assertEqual(self._downloaded(), self.content)
+        self.assertEqual(digests, self._md5())
+
+    def test_hashes_chunks_in_file_order(self):
+        chunks = [(i, self.content[i:i + 1000]) for i in range(0, len(self.content), 1000)]
+        hasher = DownloadHasher('patch.zip', [])
+        for offset, chunk in reversed(chunks):
+            hasher.update(offset, chunk)
+
+        self.assertEqual(hasher.offset, len(self.content))
+        self.assertEqual(hasher.digests(), self._md5())
+
+
+class TestRemoteFile(unittest.TestCase):
+
+    def setUp(self):
+        self.patch = make_patch('33515361 DATABASE RELEASE UPDATE 19.14.0.0.0', '19.0.0.0.0',
+                                {'33515361': 'Database Release Update 19.14.0.0.220118'},
+                                padding=4000000, comment=b'c' * 1000)
+        self.server = RangeServer({'patch.zip': self.patch, 'small.zip': make_opatch('12.2.0.1.40')}, md5=True)
+        self.s = get_session('user', 'password', 1)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def _open(self, name):
+        return RemoteFile(self.s, self.server.url + name, len(self.server.files[name]), name)
+
+    def test_parses_patch_from_few_ranges(self):
+        with self._open('patch.zip') as f:
+            self.assertEqual(parse_patch(f, 33515361), parse_patch(io.BytesIO(self.patch), 33515361))
+            self.assertLessEqual(f.requests, 4)
+            self.assertLess(f.bytes, 300000)
+        self.assertEqual(self.server.bytes, f.bytes)
+
+    def test_reads_members_like_a_local_zip(self):
+        for name in ('patch.zip', 'small.zip'):
+            with self._open(name) as f, zipfile.ZipFile(f) as remote, \
+                    zipfile.ZipFile(io.BytesIO(self.server.files[name])) as local:
+                self.assertEqual(remote.comment, local.comment)
+                self.assertEqual(remote.namelist(), local.namelist())
+                for member in local.namelist():
+                    self.assertEqual(remote.read(member), local.read(member))
+
+    def test_server_md5(self):
+        self.assertEqual(get_server_md5(self.s, self.server.url + 'patch.zip'),
+                         base64.b64encode(hashlib.md5(self.patch).digest()).decode())
+        self.server.md5 = False
+        self.assertIsNone(get_server_md5(self.s, self.server.url + 'patch.zip'))
+
+
+class TestProcessPatches(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        os.chdir(self.tmpdir)
+        self.files = {
+            33567274: {'p33567274_190000_Linux-x86-64.zip': make_patch(
+                '33567274 COMBO OF OJVM RU COMPONENT 19.14.0.0.220118 + GI RU 19.14.0.0.220118', '19.0.0.0.0',
+                {'33509923': 'GI Release Update 19.14.0.0.220118', '33561310': 'Oracle JavaVM Component Release Update'})},
+            33515361: {'p33515361_190000_Linux-x86-64.zip': make_patch(
+                '33515361 DATABASE RELEASE UPDATE 19.14.0.0.0', '19.0.0.0.0',
+                {'33515361': 'Database Release Update 19.14.0.0.220118'})},
+            36352352: {'p36352352_210000_Linux-x86-64.zip': make_patch(
+                '36352352 DATABASE RELEASE UPDATE 21.14.0.0.0', '21.0.0.0.0', {})},
+            OPATCH_PATCHNUM: {
+                'p6880880_190000_Linux-x86-64.zip': make_opatch('12.2.0.1.40'),
+                'p6880880_210000_Linux-x86-64.zip': make_opatch('12.2.0.1.41'),
+            },
+        }
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def test_batch_shares_opatch_per_release_line(self):
+        s = FakeMosSession(self.files, latency=0.02)
+        catalogs, errors = process_patches(s, [33567274, 33515361, 36352352], workers=4)
+
+        self.assertEqual(errors, {})
+        self.assertEqual(len(catalogs[GI_PATCHES]), 1)
+        self.assertIn('category: "RU", base: "19.3.0.0.0", release: "19.14.0.0.220118", patchnum: "33567274"',
+                      catalogs[GI_PATCHES][0])
+        self.assertIn('patch_subdir: "/33509923"', catalogs[GI_PATCHES][0])
+        self.assertIn('minimum_opatch: "12.2.0.1.40"', catalogs[GI_PATCHES][0])
+        # In the order of the patches, whichever finished first
+        self.assertEqual([line.split('patchnum: "')[1][:8] for line in catalogs[RDBMS_PATCHES]],
+                         ['33567274', '33515361', '36352352'])
+        self.assertIn('category: "RU_Combo"', catalogs[RDBMS_PATCHES][0])
+        self.assertIn('category: "DB_RU"', catalogs[RDBMS_PATCHES][1])
+        self.assertIn('base: "21.3.0.0.0"', catalogs[RDBMS_PATCHES][2])
+        self.assertIn('minimum_opatch: "12.2.0.1.41"', catalogs[RDBMS_PATCHES][2])
+
+        opatch_lookups = [url for url, _ in s.requests if f'patch_number={OPATCH_PATCHNUM}' in url]
+        self.assertEqual(len(opatch_lookups), 1)
+        self.assertEqual(s.downloads(), sorted(name for files in self.files.values() for name in files))
+        self.assertGreater(s.max_concurrency, 1)
+
+    def test_remote_skips_downloads_given_server_md5(self):
+        patchnums = [33567274, 33515361, 36352352]
+        remote, errors = process_patches(FakeMosSession(self.files, md5=True), patchnums, 4, remote=True)
+
+        self.assertEqual(errors, {})
+        self.assertEqual(os.listdir(), [])
+        self.assertEqual(remote, process_patches(FakeMosSession(self.files), patchnums, 4)[0])
+
+    def test_remote_downloads_for_md5(self):
+        remote, errors = process_patches(FakeMosSession(self.files), [33515361], 1, remote=True)
+
+        self.assertEqual(errors, {})
+        # Only the patch, OPatch was read remotely
+        self.assertEqual(os.listdir(), ['p33515361_190000_Linux-x86-64.zip'])
+        self.assertIn('md5sum: "', remote[RDBMS_PATCHES][0])
+        self.assertEqual(remote, process_patches(FakeMosSession(self.files), [33515361], 1)[0])
+
+    def test_failed_patch_does_not_stop_the_batch(self):
+        s = FakeMosSession(self.files)
+        catalogs, errors = process_patches(s, [33515361, 12345678], workers=2)
+
+        self.assertEqual(list(errors), [12345678])
+        self.assertIsInstance(errors[12345678], AssertionError)
+        self.assertEqual(len(catalogs[RDBMS_PATCHES]), 1)
+        self.assertNotIn(GI_PATCHES, catalogs)
+
+    def test_md5_digest(self):
+        with open('patch.zip', 'wb') as f:
+            f.write(b'x' * 3000000)
+        self.assertEqual(gen_patch_metadata.get_file_digests('patch.zip'), {'md5': 'jjLiJkK93IlpjiWk6b9Siw=='})
+
+    def test_rerun_reads_digests_from_cache(self):
+        patchnums = [33567274, 33515361]
+        with mock.patch.object(gen_patch_metadata, 'get_file_digests',
+                               wraps=gen_patch_metadata.get_file_digests) as get_file_digests:
+            first, _ = process_patches(FakeMosSession(self.files), patchnums, 2, hash_cache=HashCache('hashes.json'))
+            # Hashed while downloading
+            self.assertEqual(get_file_digests.call_count, 0)
+
+            s = FakeMosSession(self.files)
+            second, _ = process_patches(s, patchnums, 2, hash_cache=HashCache('hashes.json'))
+            self.assertEqual(second, first)
+            self.assertEqual(s.downloads(), [])
+            self.assertEqual(get_file_digests.call_count, 0)
+
+            os.utime('p33515361_190000_Linux-x86-64.zip', ns=(0, 0))
+            third, _ = process_patches(FakeMosSession(self.files), patchnums, 2, hash_cache=HashCache('hashes.json'))
+            self.assertEqual(third, first)
+            get_file_digests.assert_called_once_with('p33515361_190000_Linux-x86-64.zip')
+
+    def test_read_patch_list(self):
+        with open('patches.txt', 'w') as f:
+            f.write('# 2024 Q1\n33567274\n\n33515361  # DB RU\n')
+        self.assertEqual(read_patch_list('patches.txt'), [33567274, 33515361])
+
+
+if __name__ == '__main__':
+    unittest.main()